@@ -1,6 +1,9 @@
+import os
 import sys
+import copy
 import yaml
 from pprint import pprint
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 from tqdm import tqdm
 import torch
@@ -30,7 +33,305 @@ from GANDLF.metrics.segmentation import (
 )
 
 
-def generate_metrics_dict(input_csv: str, config: str, outputfile: str = None) -> dict:
+def _fix_2d_tensor(input_tensor):
+    """
+    This function checks for 2d images and change the shape to [B, C, H, W]
+
+    Args:
+        input_tensor (torch.Tensor): The input tensor.
+
+    Returns:
+        torch.Tensor: The output tensor in the format that torchmetrics expects.
+    """
+    if input_tensor.shape[-1] == 1:
+        return input_tensor.squeeze(-1).unsqueeze(0)
+    else:
+        return input_tensor
+
+
+def _percentile_clip(
+    input_tensor,
+    reference_tensor=None,
+    p_min=0.5,
+    p_max=99.5,
+    strictlyPositive=True,
+):
+    """Normalizes a tensor based on percentiles. Clips values below and above the percentile.
+    Percentiles for normalization can come from another tensor.
+
+    Args:
+        input_tensor (torch.Tensor): Tensor to be normalized based on the data from the reference_tensor.
+            If reference_tensor is None, the percentiles from this tensor will be used.
+        reference_tensor (torch.Tensor, optional): The tensor used for obtaining the percentiles.
+        p_min (float, optional): Lower end percentile. Defaults to 0.5.
+        p_max (float, optional): Upper end percentile. Defaults to 99.5.
+        strictlyPositive (bool, optional): Ensures that really all values are above 0 before normalization. Defaults to True.
+
+    Returns:
+        torch.Tensor: The input_tensor normalized based on the percentiles of the reference tensor.
+    """
+    reference_tensor = input_tensor if reference_tensor is None else reference_tensor
+    v_min, v_max = np.percentile(
+        reference_tensor, [p_min, p_max]
+    )  # get p_min percentile and p_max percentile
+
+    # set lower bound to be 0 if strictlyPositive is enabled
+    v_min = max(v_min, 0.0) if strictlyPositive else v_min
+    output_tensor = np.clip(
+        input_tensor, v_min, v_max
+    )  # clip values to percentiles from reference_tensor
+    output_tensor = (output_tensor - v_min) / (
+        v_max - v_min
+    )  # normalizes values to [0;1]
+    return output_tensor
+
+
+def _generate_metrics_segmentation_subject(row, headers, parameters) -> dict:
+    """
+    This function calculates the segmentation metrics of a single subject.
+
+    Args:
+        row (pandas.Series): The row of the input csv for this subject.
+        headers (dict): The mapping of the required columns to the columns of the input csv.
+        parameters (dict): The parameters from the config.
+
+    Returns:
+        dict: The metrics of the subject.
+    """
+    # the parameters are modified per class, so work on a copy to keep subjects independent
+    parameters = copy.deepcopy(parameters)
+    class_list = parameters["model"]["class_list"]
+    subject_stats = {}
+    label_image = torchio.LabelMap(row[headers["target"]])
+    pred_image = torchio.LabelMap(row[headers["prediction"]])
+    label_tensor = label_image.data
+    pred_tensor = pred_image.data
+    spacing = label_image.spacing
+    if label_tensor.data.shape[-1] == 1:
+        spacing = spacing[0:2]
+    # add dimension for batch
+    parameters["subject_spacing"] = torch.Tensor(spacing).unsqueeze(0)
+    label_tensor = label_tensor.unsqueeze(0)
+    pred_tensor = pred_tensor.unsqueeze(0)
+
+    # one hot encode with batch_size = 1
+    label_image_one_hot = one_hot(label_tensor, class_list)
+    pred_image_one_hot = one_hot(pred_tensor, class_list)
+
+    for class_index, _ in enumerate(class_list):
+        current_target = label_image_one_hot[:, class_index, ...].unsqueeze(0)
+        current_prediction = pred_image_one_hot[:, class_index, ...].unsqueeze(0)
+        subject_stats[str(class_index)] = {}
+        # this is inconsequential, since one_hot will ensure that the classes are present
+        parameters["model"]["class_list"] = [1]
+        parameters["model"]["num_classes"] = 1
+        subject_stats[str(class_index)]["dice"] = dice(
+            current_prediction,
+            current_target,
+        ).item()
+        nsd, hd100, hd95 = _calculator_generic_all_surface_distances(
+            current_prediction,
+            current_target,
+            parameters,
+        )
+        subject_stats[str(class_index)]["nsd"] = nsd.item()
+        subject_stats[str(class_index)]["hd100"] = hd100.item()
+        subject_stats[str(class_index)]["hd95"] = hd95.item()
+
+        (
+            s,
+            p,
+        ) = _calculator_sensitivity_specificity(
+            current_prediction,
+            current_target,
+            parameters,
+        )
+        subject_stats[str(class_index)]["sensitivity"] = s.item()
+        subject_stats[str(class_index)]["specificity"] = p.item()
+        subject_stats["jaccard_" + str(class_index)] = _calculator_jaccard(
+            current_prediction,
+            current_target,
+            parameters,
+        ).item()
+        current_target_image = sitk.GetImageFromArray(current_target[0, 0, ...].long())
+        current_prediction_image = sitk.GetImageFromArray(
+            current_prediction[0, 0, ...].long()
+        )
+        label_overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
+        label_overlap_filter.Execute(current_target_image, current_prediction_image)
+        # subject_stats[
+        #     "falseDiscoveryRate_" + str(class_index)
+        # ] = label_overlap_filter.GetFalseDiscoveryRate()
+        subject_stats[
+            "falseNegativeError_" + str(class_index)
+        ] = label_overlap_filter.GetFalseNegativeError()
+        subject_stats[
+            "falsePositiveError_" + str(class_index)
+        ] = label_overlap_filter.GetFalsePositiveError()
+        subject_stats[
+            "meanOverlap_" + str(class_index)
+        ] = label_overlap_filter.GetMeanOverlap()
+        subject_stats[
+            "unionOverlap_" + str(class_index)
+        ] = label_overlap_filter.GetUnionOverlap()
+        subject_stats[
+            "volumeSimilarity_" + str(class_index)
+        ] = label_overlap_filter.GetVolumeSimilarity()
+
+    return subject_stats
+
+
+def _generate_metrics_synthesis_subject(row, headers, parameters) -> dict:
+    """
+    This function calculates the synthesis metrics of a single subject.
+
+    Args:
+        row (pandas.Series): The row of the input csv for this subject.
+        headers (dict): The mapping of the required columns to the columns of the input csv.
+        parameters (dict): The parameters from the config.
+
+    Returns:
+        dict: The metrics of the subject.
+    """
+    subject_stats = {}
+    target_image = _fix_2d_tensor(torchio.ScalarImage(row[headers["target"]]).data)
+    pred_image = _fix_2d_tensor(torchio.ScalarImage(row[headers["prediction"]]).data)
+    # if "mask" is not in the row, we assume that the whole image is the mask
+    # always cast to byte tensor
+    mask = (
+        _fix_2d_tensor(torchio.LabelMap(row[headers["mask"]]).data)
+        if "mask" in row
+        else torch.from_numpy(np.ones(target_image.numpy().shape, dtype=np.uint8))
+    ).byte()
+
+    # Get Infill region (we really are only interested in the infill region)
+    output_infill = (pred_image * mask).float()
+    gt_image_infill = (target_image * mask).float()
+
+    # Normalize to [0;1] based on GT (otherwise MSE will depend on the image intensity range)
+    normalize = parameters.get("normalize", True)
+    if normalize:
+        reference_tensor = (
+            target_image * ~mask
+        )  # use all the tissue that is not masked for normalization
+        gt_image_infill = _percentile_clip(
+            gt_image_infill,
+            reference_tensor=reference_tensor,
+            p_min=0.5,
+            p_max=99.5,
+            strictlyPositive=True,
+        )
+        output_infill = _percentile_clip(
+            output_infill,
+            reference_tensor=reference_tensor,
+            p_min=0.5,
+            p_max=99.5,
+            strictlyPositive=True,
+        )
+
+    subject_stats["ssim"] = structural_similarity_index(
+        gt_image_infill, output_infill, mask
+    ).item()
+
+    # ncc metrics
+    compute_ncc = parameters.get("compute_ncc", True)
+    if compute_ncc:
+        subject_stats["ncc_mean"] = ncc_mean(gt_image_infill, output_infill)
+        subject_stats["ncc_std"] = ncc_std(gt_image_infill, output_infill)
+        subject_stats["ncc_max"] = ncc_max(gt_image_infill, output_infill)
+        subject_stats["ncc_min"] = ncc_min(gt_image_infill, output_infill)
+
+    # only voxels that are to be inferred (-> flat array)
+    # these are required for mse, psnr, etc.
+    gt_image_infill = gt_image_infill[mask]
+    output_infill = output_infill[mask]
+
+    subject_stats["mse"] = mean_squared_error(gt_image_infill, output_infill).item()
+
+    subject_stats["msle"] = mean_squared_log_error(
+        gt_image_infill, output_infill
+    ).item()
+
+    subject_stats["mae"] = mean_absolute_error(gt_image_infill, output_infill).item()
+
+    # torchmetrics PSNR using "max"
+    subject_stats["psnr"] = peak_signal_noise_ratio(
+        gt_image_infill, output_infill
+    ).item()
+
+    # same as above but with epsilon for robustness
+    subject_stats["psnr_eps"] = peak_signal_noise_ratio(
+        gt_image_infill, output_infill, epsilon=sys.float_info.epsilon
+    ).item()
+
+    # only use fix data range to [0;1] if the data was normalized before
+    if normalize:
+        # torchmetrics PSNR but with fixed data range of 0 to 1
+        subject_stats["psnr_01"] = peak_signal_noise_ratio(
+            gt_image_infill, output_infill, data_range=(0, 1)
+        ).item()
+
+        # same as above but with epsilon for robustness
+        subject_stats["psnr_01_eps"] = peak_signal_noise_ratio(
+            gt_image_infill,
+            output_infill,
+            data_range=(0, 1),
+            epsilon=sys.float_info.epsilon,
+        ).item()
+
+    return subject_stats
+
+
+# markers of the output file while the per-subject metrics are being streamed to it
+_PARTIAL_OUTPUT_HEADER = "# incomplete metrics, use 'resume' to continue\n"
+_SUBJECT_END_MARKER = "# end of subject\n"
+
+
+def _load_partial_metrics(outputfile: str) -> dict:
+    """
+    This function loads the per-subject metrics that have already been written to the output file by a previous (possibly interrupted) run.
+
+    Args:
+        outputfile (str): The output file of the previous run.
+
+    Returns:
+        dict: The metrics of the completed subjects.
+    """
+    if outputfile is None or not os.path.isfile(outputfile):
+        return {}
+
+    with open(outputfile, "r") as file:
+        contents = file.read()
+
+    if contents.startswith(_PARTIAL_OUTPUT_HEADER):
+        # only keep the subjects that were completely written before the interruption
+        contents = contents[: contents.rfind(_SUBJECT_END_MARKER) + 1]
+
+    previous_stats = yaml.safe_load(contents)
+    return previous_stats if isinstance(previous_stats, dict) else {}
+
+
+def _append_subject_metrics(outputfile: str, subject_id, subject_stats: dict):
+    """
+    This function appends the metrics of a single subject to the output file, so that the results are available while the remaining subjects are processed.
+
+    Args:
+        outputfile (str): The output file.
+        subject_id (Union[str, int]): The subject identifier.
+        subject_stats (dict): The metrics of the subject.
+    """
+    with open(outputfile, "a") as outfile:
+        outfile.write(yaml.dump({subject_id: subject_stats}) + _SUBJECT_END_MARKER)
+        outfile.flush()
+
+
+def generate_metrics_dict(
+    input_csv: str,
+    config: str,
+    outputfile: str = None,
+    num_workers: int = 1,
+    resume: bool = False,
+) -> dict:
     """
     This function generates metrics from the input csv and the config.
 
@@ -38,6 +339,8 @@ def generate_metrics_dict(input_csv: str, config: str, outputfile: str = None) -
         input_csv (str): The input CSV.
         config (str): The input yaml config.
         outputfile (str, optional): The output file to save the metrics. Defaults to None.
+        num_workers (int, optional): The number of processes used to calculate the per-subject metrics for segmentation and synthesis. Defaults to 1.
+        resume (bool, optional): Whether to skip the subjects that are already present in the output file from a previous run. Defaults to False.
 
     Returns:
         dict: The metrics dictionary.
@@ -77,274 +380,69 @@ def generate_metrics_dict(input_csv: str, config: str, outputfile: str = None) -
             predictions_tensor, labels_tensor, parameters
         )
 
-    elif problem_type == "segmentation":
-        # read images and then calculate metrics
-        class_list = parameters["model"]["class_list"]
-        for _, row in tqdm(input_df.iterrows(), total=input_df.shape[0]):
+    elif problem_type in ["segmentation", "synthesis"]:
+        subject_metrics_function = (
+            _generate_metrics_segmentation_subject
+            if problem_type == "segmentation"
+            else _generate_metrics_synthesis_subject
+        )
+        rows = [row for _, row in input_df.iterrows()]
+        previous_stats = _load_partial_metrics(outputfile) if resume else {}
+        completed_stats = {}
+        rows_to_process = []
+        for row in rows:
             current_subject_id = row[headers["subjectid"]]
-            overall_stats_dict[current_subject_id] = {}
-            label_image = torchio.LabelMap(row[headers["target"]])
-            pred_image = torchio.LabelMap(row[headers["prediction"]])
-            label_tensor = label_image.data
-            pred_tensor = pred_image.data
-            spacing = label_image.spacing
-            if label_tensor.data.shape[-1] == 1:
-                spacing = spacing[0:2]
-            # add dimension for batch
-            parameters["subject_spacing"] = torch.Tensor(spacing).unsqueeze(0)
-            label_tensor = label_tensor.unsqueeze(0)
-            pred_tensor = pred_tensor.unsqueeze(0)
-
-            # one hot encode with batch_size = 1
-            label_image_one_hot = one_hot(label_tensor, class_list)
-            pred_image_one_hot = one_hot(pred_tensor, class_list)
-
-            for class_index, _ in enumerate(class_list):
-                current_target = label_image_one_hot[:, class_index, ...].unsqueeze(0)
-                current_prediction = pred_image_one_hot[:, class_index, ...].unsqueeze(
-                    0
-                )
-                overall_stats_dict[current_subject_id][str(class_index)] = {}
-                # this is inconsequential, since one_hot will ensure that the classes are present
-                parameters["model"]["class_list"] = [1]
-                parameters["model"]["num_classes"] = 1
-                overall_stats_dict[current_subject_id][str(class_index)]["dice"] = dice(
-                    current_prediction,
-                    current_target,
-                ).item()
-                nsd, hd100, hd95 = _calculator_generic_all_surface_distances(
-                    current_prediction,
-                    current_target,
-                    parameters,
-                )
-                overall_stats_dict[current_subject_id][str(class_index)][
-                    "nsd"
-                ] = nsd.item()
-                overall_stats_dict[current_subject_id][str(class_index)][
-                    "hd100"
-                ] = hd100.item()
-                overall_stats_dict[current_subject_id][str(class_index)][
-                    "hd95"
-                ] = hd95.item()
-
-                (
-                    s,
-                    p,
-                ) = _calculator_sensitivity_specificity(
-                    current_prediction,
-                    current_target,
-                    parameters,
-                )
-                overall_stats_dict[current_subject_id][str(class_index)][
-                    "sensitivity"
-                ] = s.item()
-                overall_stats_dict[current_subject_id][str(class_index)][
-                    "specificity"
-                ] = p.item()
-                overall_stats_dict[current_subject_id][
-                    "jaccard_" + str(class_index)
-                ] = _calculator_jaccard(
-                    current_prediction,
-                    current_target,
-                    parameters,
-                ).item()
-                current_target_image = sitk.GetImageFromArray(
-                    current_target[0, 0, ...].long()
-                )
-                current_prediction_image = sitk.GetImageFromArray(
-                    current_prediction[0, 0, ...].long()
-                )
-                label_overlap_filter = sitk.LabelOverlapMeasuresImageFilter()
-                label_overlap_filter.Execute(
-                    current_target_image, current_prediction_image
-                )
-                # overall_stats_dict[current_subject_id][
-                #     "falseDiscoveryRate_" + str(class_index)
-                # ] = label_overlap_filter.GetFalseDiscoveryRate()
-                overall_stats_dict[current_subject_id][
-                    "falseNegativeError_" + str(class_index)
-                ] = label_overlap_filter.GetFalseNegativeError()
-                overall_stats_dict[current_subject_id][
-                    "falsePositiveError_" + str(class_index)
-                ] = label_overlap_filter.GetFalsePositiveError()
-                overall_stats_dict[current_subject_id][
-                    "meanOverlap_" + str(class_index)
-                ] = label_overlap_filter.GetMeanOverlap()
-                overall_stats_dict[current_subject_id][
-                    "unionOverlap_" + str(class_index)
-                ] = label_overlap_filter.GetUnionOverlap()
-                overall_stats_dict[current_subject_id][
-                    "volumeSimilarity_" + str(class_index)
-                ] = label_overlap_filter.GetVolumeSimilarity()
-
-    elif problem_type == "synthesis":
-
-        def __fix_2d_tensor(input_tensor):
-            """
-            This function checks for 2d images and change the shape to [B, C, H, W]
-
-            Args:
-                input_tensor (torch.Tensor): The input tensor.
-
-            Returns:
-                torch.Tensor: The output tensor in the format that torchmetrics expects.
-            """
-            if input_tensor.shape[-1] == 1:
-                return input_tensor.squeeze(-1).unsqueeze(0)
+            if current_subject_id in previous_stats:
+                completed_stats[current_subject_id] = previous_stats[current_subject_id]
             else:
-                return input_tensor
-
-        def __percentile_clip(
-            input_tensor,
-            reference_tensor=None,
-            p_min=0.5,
-            p_max=99.5,
-            strictlyPositive=True,
-        ):
-            """Normalizes a tensor based on percentiles. Clips values below and above the percentile.
-            Percentiles for normalization can come from another tensor.
-
-            Args:
-                input_tensor (torch.Tensor): Tensor to be normalized based on the data from the reference_tensor.
-                    If reference_tensor is None, the percentiles from this tensor will be used.
-                reference_tensor (torch.Tensor, optional): The tensor used for obtaining the percentiles.
-                p_min (float, optional): Lower end percentile. Defaults to 0.5.
-                p_max (float, optional): Upper end percentile. Defaults to 99.5.
-                strictlyPositive (bool, optional): Ensures that really all values are above 0 before normalization. Defaults to True.
-
-            Returns:
-                torch.Tensor: The input_tensor normalized based on the percentiles of the reference tensor.
-            """
-            reference_tensor = (
-                input_tensor if reference_tensor is None else reference_tensor
-            )
-            v_min, v_max = np.percentile(
-                reference_tensor, [p_min, p_max]
-            )  # get p_min percentile and p_max percentile
-
-            # set lower bound to be 0 if strictlyPositive is enabled
-            v_min = max(v_min, 0.0) if strictlyPositive else v_min
-            output_tensor = np.clip(
-                input_tensor, v_min, v_max
-            )  # clip values to percentiles from reference_tensor
-            output_tensor = (output_tensor - v_min) / (
-                v_max - v_min
-            )  # normalizes values to [0;1]
-            return output_tensor
-
-        for _, row in tqdm(input_df.iterrows(), total=input_df.shape[0]):
-            current_subject_id = row[headers["subjectid"]]
-            overall_stats_dict[current_subject_id] = {}
-            target_image = __fix_2d_tensor(
-                torchio.ScalarImage(row[headers["target"]]).data
+                rows_to_process.append(row)
+        if resume and len(completed_stats) > 0:
+            print(
+                f"Resuming from '{outputfile}', skipping {len(completed_stats)} subjects with existing metrics.",
+                flush=True,
             )
-            pred_image = __fix_2d_tensor(
-                torchio.ScalarImage(row[headers["prediction"]]).data
-            )
-            # if "mask" is not in the row, we assume that the whole image is the mask
-            # always cast to byte tensor
-            mask = (
-                __fix_2d_tensor(torchio.LabelMap(row[headers["mask"]]).data)
-                if "mask" in row
-                else torch.from_numpy(
-                    np.ones(target_image.numpy().shape, dtype=np.uint8)
-                )
-            ).byte()
-
-            # Get Infill region (we really are only interested in the infill region)
-            output_infill = (pred_image * mask).float()
-            gt_image_infill = (target_image * mask).float()
-
-            # Normalize to [0;1] based on GT (otherwise MSE will depend on the image intensity range)
-            normalize = parameters.get("normalize", True)
-            if normalize:
-                reference_tensor = (
-                    target_image * ~mask
-                )  # use all the tissue that is not masked for normalization
-                gt_image_infill = __percentile_clip(
-                    gt_image_infill,
-                    reference_tensor=reference_tensor,
-                    p_min=0.5,
-                    p_max=99.5,
-                    strictlyPositive=True,
-                )
-                output_infill = __percentile_clip(
-                    output_infill,
-                    reference_tensor=reference_tensor,
-                    p_min=0.5,
-                    p_max=99.5,
-                    strictlyPositive=True,
-                )
-
-            overall_stats_dict[current_subject_id][
-                "ssim"
-            ] = structural_similarity_index(gt_image_infill, output_infill, mask).item()
 
-            # ncc metrics
-            compute_ncc = parameters.get("compute_ncc", True)
-            if compute_ncc:
-                overall_stats_dict[current_subject_id]["ncc_mean"] = ncc_mean(
-                    gt_image_infill, output_infill
-                )
-                overall_stats_dict[current_subject_id]["ncc_std"] = ncc_std(
-                    gt_image_infill, output_infill
-                )
-                overall_stats_dict[current_subject_id]["ncc_max"] = ncc_max(
-                    gt_image_infill, output_infill
-                )
-                overall_stats_dict[current_subject_id]["ncc_min"] = ncc_min(
-                    gt_image_infill, output_infill
+        # the output file is rewritten as the subjects are processed
+        if outputfile is not None:
+            with open(outputfile, "w") as outfile:
+                outfile.write(_PARTIAL_OUTPUT_HEADER)
+            for subject_id, subject_stats in completed_stats.items():
+                _append_subject_metrics(outputfile, subject_id, subject_stats)
+
+        def __subject_done(subject_id, subject_stats):
+            completed_stats[subject_id] = subject_stats
+            if outputfile is not None:
+                _append_subject_metrics(outputfile, subject_id, subject_stats)
+
+        if num_workers > 1 and len(rows_to_process) > 1:
+            with ProcessPoolExecutor(
+                max_workers=min(num_workers, len(rows_to_process))
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        subject_metrics_function, row, headers, parameters
+                    ): row[headers["subjectid"]]
+                    for row in rows_to_process
+                }
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    __subject_done(futures[future], future.result())
+        else:
+            for row in tqdm(rows_to_process):
+                __subject_done(
+                    row[headers["subjectid"]],
+                    subject_metrics_function(row, headers, parameters),
                 )
 
-            # only voxels that are to be inferred (-> flat array)
-            # these are required for mse, psnr, etc.
-            gt_image_infill = gt_image_infill[mask]
-            output_infill = output_infill[mask]
-
-            overall_stats_dict[current_subject_id]["mse"] = mean_squared_error(
-                gt_image_infill, output_infill
-            ).item()
-
-            overall_stats_dict[current_subject_id]["msle"] = mean_squared_log_error(
-                gt_image_infill, output_infill
-            ).item()
-
-            overall_stats_dict[current_subject_id]["mae"] = mean_absolute_error(
-                gt_image_infill, output_infill
-            ).item()
-
-            # torchmetrics PSNR using "max"
-            overall_stats_dict[current_subject_id]["psnr"] = peak_signal_noise_ratio(
-                gt_image_infill, output_infill
-            ).item()
-
-            # same as above but with epsilon for robustness
-            overall_stats_dict[current_subject_id][
-                "psnr_eps"
-            ] = peak_signal_noise_ratio(
-                gt_image_infill, output_infill, epsilon=sys.float_info.epsilon
-            ).item()
-
-            # only use fix data range to [0;1] if the data was normalized before
-            if normalize:
-                # torchmetrics PSNR but with fixed data range of 0 to 1
-                overall_stats_dict[current_subject_id][
-                    "psnr_01"
-                ] = peak_signal_noise_ratio(
-                    gt_image_infill, output_infill, data_range=(0, 1)
-                ).item()
-
-                # same as above but with epsilon for robustness
-                overall_stats_dict[current_subject_id][
-                    "psnr_01_eps"
-                ] = peak_signal_noise_ratio(
-                    gt_image_infill,
-                    output_infill,
-                    data_range=(0, 1),
-                    epsilon=sys.float_info.epsilon,
-                ).item()
+        # keep the order of the input csv, irrespective of the order of completion
+        for row in rows:
+            current_subject_id = row[headers["subjectid"]]
+            overall_stats_dict[current_subject_id] = completed_stats[current_subject_id]
 
     pprint(overall_stats_dict)
     if outputfile is not None:
-        with open(outputfile, "w") as outfile:
+        # replace the partial output in a single step, so that it is never lost
+        with open(outputfile + ".tmp", "w") as outfile:
             yaml.dump(overall_stats_dict, outfile)
+        os.replace(outputfile + ".tmp", outputfile)
+
+    return overall_stats_dict
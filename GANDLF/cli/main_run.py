@@ -9,6 +9,7 @@ from GANDLF.utils import (
     parseTrainingCSV,
     parseTestingCSV,
     set_determinism,
+    init_distributed,
 )
 
 
@@ -56,6 +57,10 @@ def main_run(
     if "-1" in device:
         device = "cpu"
 
+    if train_mode:
+        # no-op, unless launched with multiple processes by torchrun
+        init_distributed(device)
+
     # parse training CSV
     if "," in file_data_full:
         # training and validation pre-split
@@ -1,7 +1,10 @@
 import os, warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from copy import deepcopy
 from functools import partial
 from pathlib import Path
 
+import pandas as pd
 from PIL import Image
 
 from GANDLF.data.patch_miner.opm.patch_manager import PatchManager
@@ -11,7 +14,7 @@ from GANDLF.data.patch_miner.opm.utils import (
     parse_config,
     generate_initial_mask,
     get_patch_size_in_microns,
-    patch_artifact_check,
+    patch_artifact_check_batch,
     # pen_marking_check,
 )
 from GANDLF.utils import (
@@ -35,14 +38,80 @@ def parse_gandlf_csv(fpath):
             yield row["SubjectID"], row["Channel_0"], None
 
 
-def patch_extraction(input_path, output_path, config=None):
+def _get_slide_output_dir(output_path, index, sid):
+    # a subject can have several slides, so these are told apart by their row in the input CSV
+    return os.path.join(output_path, str(sid), str(index))
+
+
+def _get_slide_csv_path(output_path, index, sid):
+    return os.path.join(_get_slide_output_dir(output_path, index, sid), "opm_train.csv")
+
+
+def _extract_patches_from_slide(index, sid, slide, label, cfg, output_path):
+    """
+    This function extracts the patches of a single WSI and writes them to a per-slide CSV, which is created in a single step once the slide is done.
+
+    Args:
+        index (int): The row of the slide in the input CSV.
+        sid (str): The subject identifier.
+        slide (str): The path to the WSI.
+        label (Union[str, None]): The path to the label map, if any.
+        cfg (dict): The patch extraction config.
+        output_path (str): The output directory.
+
+    Returns:
+        str: The per-slide CSV.
+    """
+    Image.MAX_IMAGE_PIXELS = None
+    warnings.simplefilter("ignore")
+    cfg = deepcopy(cfg)
+    slide_csv_path = _get_slide_csv_path(output_path, index, sid)
+
+    # Create new instance of slide manager
+    manager = PatchManager(slide, _get_slide_output_dir(output_path, index, sid))
+    if label is not None:
+        manager.set_label_map(label)
+    manager.set_subjectID(str(sid))
+    manager.set_image_header("Channel_0")
+    manager.set_mask_header("Label")
+
+    cfg["patch_size"] = get_patch_size_in_microns(slide, cfg["patch_size"])
+
+    # Generate an initial validity mask
+    mask, scale = generate_initial_mask(slide, cfg["scale"])
+    print("Setting valid mask...")
+    manager.set_valid_mask(mask, scale)
+    # Reject patch if any pixels are transparent
+    manager.add_patch_criteria(alpha_rgb_2d_channel_check)
+    # manager.add_patch_criteria(pen_marking_check) ### will be added to main code after rigourous experimentation
+    # the artifact check is vectorized over the patches read in each run
+    manager.add_patch_batch_criteria(patch_artifact_check_batch)
+    # Reject patch if image dimensions are not equal to PATCH_SIZE
+    patch_dims_check = partial(
+        patch_size_check,
+        patch_height=cfg["patch_size"][0],
+        patch_width=cfg["patch_size"][1],
+    )
+    manager.add_patch_criteria(patch_dims_check)
+    # Save patches releases saves all patches stored in manager, dumps to specified output file
+    if os.path.isfile(slide_csv_path + ".tmp"):
+        os.remove(slide_csv_path + ".tmp")
+    manager.mine_patches(output_csv=slide_csv_path + ".tmp", config=cfg)
+    # the per-slide CSV marks the slide as completed
+    os.replace(slide_csv_path + ".tmp", slide_csv_path)
+    return slide_csv_path
+
+
+def patch_extraction(input_path, output_path, config=None, num_workers=1, resume=False):
     """
     This function extracts patches from WSIs.
 
     Args:
         input_path (str): The input CSV.
+        output_path (str): The output directory.
         config (Union[str, dict, none]): The input yaml config.
-        output_path (_type_): _description_
+        num_workers (int, optional): The number of slides processed in parallel processes. Defaults to 1.
+        resume (bool, optional): Whether to skip the slides that have been completed in a previous run. Defaults to False.
     """
 
     Image.MAX_IMAGE_PIXELS = None
@@ -56,7 +125,6 @@ def patch_extraction(input_path, output_path, config=None):
             cfg = parse_config(config)
     cfg["scale"] = cfg.get("scale", 16)
     cfg["patch_size"] = cfg.get("patch_size", (256, 256))
-    original_patch_size = cfg["patch_size"]
 
     if not os.path.exists(output_path):
         Path(output_path).mkdir(parents=True, exist_ok=True)
@@ -65,31 +133,62 @@ def patch_extraction(input_path, output_path, config=None):
 
     out_csv_path = os.path.join(output_path, "opm_train.csv")
 
-    for sid, slide, label in parse_gandlf_csv(input_path):
-        # Create new instance of slide manager
-        manager = PatchManager(slide, os.path.join(output_path, str(sid)))
-        if label is not None:
-            manager.set_label_map(label)
-        manager.set_subjectID(str(sid))
-        manager.set_image_header("Channel_0")
-        manager.set_mask_header("Label")
-
-        cfg["patch_size"] = get_patch_size_in_microns(slide, original_patch_size)
-
-        # Generate an initial validity mask
-        mask, scale = generate_initial_mask(slide, cfg["scale"])
-        print("Setting valid mask...")
-        manager.set_valid_mask(mask, scale)
-        # Reject patch if any pixels are transparent
-        manager.add_patch_criteria(alpha_rgb_2d_channel_check)
-        # manager.add_patch_criteria(pen_marking_check) ### will be added to main code after rigourous experimentation
-        manager.add_patch_criteria(patch_artifact_check)
-        # Reject patch if image dimensions are not equal to PATCH_SIZE
-        patch_dims_check = partial(
-            patch_size_check,
-            patch_height=cfg["patch_size"][0],
-            patch_width=cfg["patch_size"][1],
+    slides = list(parse_gandlf_csv(input_path))
+    slides_to_process = []
+    for index, (sid, slide, label) in enumerate(slides):
+        if resume and os.path.isfile(_get_slide_csv_path(output_path, index, sid)):
+            continue
+        slides_to_process.append((index, sid, slide, label))
+    if resume and len(slides_to_process) < len(slides):
+        print(
+            f"Resuming, skipping {len(slides) - len(slides_to_process)} slides that were already completed.",
+            flush=True,
         )
-        manager.add_patch_criteria(patch_dims_check)
-        # Save patches releases saves all patches stored in manager, dumps to specified output file
-        manager.mine_patches(output_csv=out_csv_path, config=cfg)
+
+    if num_workers > 1 and len(slides_to_process) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(num_workers, len(slides_to_process))
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _extract_patches_from_slide,
+                    index,
+                    sid,
+                    slide,
+                    label,
+                    cfg,
+                    output_path,
+                ): slide
+                for index, sid, slide, label in slides_to_process
+            }
+            for future in as_completed(futures):
+                future.result()
+                print("Finished slide:", futures[future], flush=True)
+    else:
+        for index, sid, slide, label in slides_to_process:
+            _extract_patches_from_slide(index, sid, slide, label, cfg, output_path)
+
+    # the combined CSV is only written by this process, in the order of the input CSV
+    output_dfs = []
+    if os.path.isfile(out_csv_path):
+        try:
+            previous_df = pd.read_csv(out_csv_path)
+            # keep the patches of other subjects from previous runs in the same output directory
+            if "SubjectID" in previous_df.columns:
+                previous_df = previous_df[
+                    ~previous_df["SubjectID"]
+                    .astype(str)
+                    .isin([str(sid) for sid, _, _ in slides])
+                ]
+            output_dfs.append(previous_df)
+        except pd.errors.EmptyDataError as e:
+            print(e)
+    for index, (sid, _, _) in enumerate(slides):
+        try:
+            output_dfs.append(pd.read_csv(_get_slide_csv_path(output_path, index, sid)))
+        except pd.errors.EmptyDataError:
+            # no valid patches were found for this slide
+            pass
+    output_df = pd.concat(output_dfs) if len(output_dfs) > 0 else pd.DataFrame()
+    output_df.to_csv(out_csv_path + ".tmp", index=False)
+    os.replace(out_csv_path + ".tmp", out_csv_path)
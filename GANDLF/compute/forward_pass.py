@@ -16,12 +16,40 @@ from GANDLF.utils import (
     resample_image,
     reverse_one_hot,
     get_ground_truths_and_predictions_tensor,
+    get_inference_batch_size,
     print_and_format_metrics,
 )
 from GANDLF.metrics import overall_stats
+from GANDLF.logger import PredictionWriter
 from tqdm import tqdm
 
 
+def step_scheduler(scheduler, params, loss):
+    """
+    Function to step the scheduler after a validation epoch
+
+    Parameters
+    ----------
+    scheduler : object
+        The scheduler, or None in inference mode
+    params : dict
+        The parameters passed by the user yaml
+    loss : float
+        The validation loss of the epoch, used by the plateau schedulers
+
+    """
+    if scheduler is not None:
+        if params["scheduler"]["type"] in [
+            "reduce_on_plateau",
+            "reduce-on-plateau",
+            "plateau",
+            "reduceonplateau",
+        ]:
+            scheduler.step(loss)
+        else:
+            scheduler.step()
+
+
 def validate_network(
     model, valid_dataloader, scheduler, params, epoch=0, mode="validation"
 ):
@@ -96,15 +124,28 @@ def validate_network(
         model.enable_medcam()
         params["medcam_enabled"] = True
 
+    predictions_writer = None
     if params["save_output"] or is_inference:
         if params["problem_type"] != "segmentation":
-            outputToWrite = "Epoch,SubjectID,PredictedValue\n"
-            file_to_write = os.path.join(current_output_dir, "output_predictions.csv")
+            file_to_write = os.path.join(
+                current_output_dir,
+                "output_predictions." + params["predictions_format"],
+            )
             if os.path.exists(file_to_write):
                 file_to_write = os.path.join(
                     current_output_dir,
-                    "output_predictions_" + get_unique_timestamp() + ".csv",
+                    "output_predictions_"
+                    + get_unique_timestamp()
+                    + "."
+                    + params["predictions_format"],
                 )
+            # the predictions are written as the subjects are processed
+            predictions_writer = PredictionWriter(
+                file_to_write,
+                ["Epoch", "SubjectID", "PredictedValue"],
+                params["predictions_format"],
+                buffer_size=100,
+            )
 
     # get ground truths for classification problem, validation set
     if calculate_overall_metrics:
@@ -194,13 +235,13 @@ def validate_network(
 
             if params["save_output"] or is_inference:
                 # we divide by scaling factor here because we multiply by it during loss/metric calculation
-                outputToWrite += (
-                    str(epoch)
-                    + ","
-                    + subject["subject_id"][0]
-                    + ","
-                    + str(pred_output.cpu().max().item() / params["scaling_factor"])
-                    + "\n"
+                predictions_writer.write(
+                    {
+                        "Epoch": epoch,
+                        "SubjectID": subject["subject_id"][0],
+                        "PredictedValue": pred_output.cpu().max().item()
+                        / params["scaling_factor"],
+                    }
                 )
             final_loss, final_metric = get_loss_and_metrics(
                 image, valuesToPredict, pred_output, params
@@ -226,12 +267,19 @@ def validate_network(
                     total_epoch_valid_metric[metric] += final_metric[metric]
 
         else:  # for segmentation problems OR regression/classification when no label is present
+            # the label is not needed for patch extraction, since metrics are only calculated on the full image
             grid_sampler = torchio.inference.GridSampler(
-                torchio.Subject(subject_dict),
+                torchio.Subject(
+                    {key: subject_dict[key] for key in subject_dict if key != "label"}
+                ),
                 params["patch_size"],
                 patch_overlap=params["inference_mechanism"]["patch_overlap"],
             )
-            patch_loader = torch.utils.data.DataLoader(grid_sampler, batch_size=1)
+            patch_loader = torch.utils.data.DataLoader(
+                grid_sampler,
+                batch_size=get_inference_batch_size(params, len(grid_sampler)),
+                num_workers=params["inference_mechanism"]["num_workers"],
+            )
             aggregator = torchio.inference.GridAggregator(
                 grid_sampler,
                 overlap_mode=params["inference_mechanism"]["grid_aggregator_overlap"],
@@ -271,28 +319,11 @@ def validate_network(
                     .to(params["device"])
                 )
 
-                # calculate metrics if ground truth is present
-                label = None
-                if params["problem_type"] != "segmentation":
-                    label = label_ground_truth
-                elif "label" in patches_batch:
-                    label = patches_batch["label"][torchio.DATA]
-
-                if label is not None:
-                    label = label.to(params["device"])
-                    if params["verbose"]:
-                        print(
-                            "=== Validation shapes : label:",
-                            label.shape,
-                            ", image:",
-                            image.shape,
-                            flush=True,
-                        )
+                if params["verbose"]:
+                    print("=== Validation shapes : image:", image.shape, flush=True)
 
-                if is_inference:
-                    result = step(model, image, None, params, train=False)
-                else:
-                    result = step(model, image, label, params, train=True)
+                # loss and metrics are calculated on the aggregated full image, so the label is not passed here
+                result = step(model, image, None, params, train=not (is_inference))
 
                 # get the current attention map and add it to its aggregator
                 if params["medcam_enabled"]:
@@ -310,7 +341,9 @@ def validate_network(
                 else:
                     if torch.is_tensor(output):
                         # this probably needs customization for classification (majority voting or median, perhaps?)
-                        output_prediction += output.detach().cpu()
+                        output_prediction += (
+                            output.detach().cpu().sum(dim=0, keepdim=True)
+                        )
                     else:
                         output_prediction += output
 
@@ -393,19 +426,18 @@ def validate_network(
                     )
             else:
                 # final regression output
-                output_prediction = output_prediction / len(patch_loader)
+                output_prediction = output_prediction / len(grid_sampler)
                 if calculate_overall_metrics:
                     predictions_array[batch_idx] = (
                         torch.argmax(output_prediction[0], 0).cpu().item()
                     )
                 if params["save_output"]:
-                    outputToWrite += (
-                        str(epoch)
-                        + ","
-                        + subject["subject_id"][0]
-                        + ","
-                        + str(output_prediction)
-                        + "\n"
+                    predictions_writer.write(
+                        {
+                            "Epoch": epoch,
+                            "SubjectID": subject["subject_id"][0],
+                            "PredictedValue": str(output_prediction),
+                        }
                     )
 
             # get the final attention map and save it
@@ -508,16 +540,7 @@ def validate_network(
     else:
         average_epoch_valid_loss, average_epoch_valid_metric = 0, {}
 
-    if scheduler is not None:
-        if params["scheduler"]["type"] in [
-            "reduce_on_plateau",
-            "reduce-on-plateau",
-            "plateau",
-            "reduceonplateau",
-        ]:
-            scheduler.step(average_epoch_valid_loss)
-        else:
-            scheduler.step()
+    step_scheduler(scheduler, params, average_epoch_valid_loss)
 
     # write the predictions, if appropriate
     if params["save_output"]:
@@ -538,9 +561,7 @@ def validate_network(
                 )
             logits_df.to_csv(logits_file, index=False, sep=",")
 
-        if "value_keys" in params:
-            file = open(file_to_write, "w")
-            file.write(outputToWrite)
-            file.close()
+    if predictions_writer is not None:
+        predictions_writer.close()
 
     return average_epoch_valid_loss, average_epoch_valid_metric
@@ -14,12 +14,15 @@ from skimage.io import imsave
 from tqdm import tqdm
 from torch.cuda.amp import autocast
 import tiffslide as openslide
+import tifffile
 from GANDLF.data import get_testing_loader
+from GANDLF.logger import PredictionWriter
 from GANDLF.utils import (
     best_model_path_end,
     latest_model_path_end,
     load_ov_model,
     print_model_summary,
+    get_inference_batch_size,
 )
 
 from GANDLF.data.inference_dataloader_histopath import InferTumorSegDataset
@@ -35,6 +38,309 @@ def applyCustomColorMap(im_gray):
     return cv2.LUT(img_bgr, lut)
 
 
+def _initialize_probability_maps(num_classes, map_shape, storage, output_dir):
+    """
+    This function initializes the accumulation maps of the whole slide inference.
+
+    Args:
+        num_classes (int): The number of classes.
+        map_shape (tuple): The (height, width) of the maps.
+        storage (str): Either "memory" to keep the maps in memory, or "disk" to memory-map them from files in "output_dir".
+        output_dir (str): The directory for the memory-mapped files.
+
+    Returns:
+        numpy.ndarray, numpy.ndarray: The count map and the probability map.
+    """
+    if storage == "disk":
+        # the files are sparse until written, and the OS only keeps the recently accessed tiles in memory
+        count_map = np.lib.format.open_memmap(
+            os.path.join(output_dir, "count_map.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=map_shape,
+        )
+        probs_map = np.lib.format.open_memmap(
+            os.path.join(output_dir, "probs_map.npy"),
+            mode="w+",
+            dtype=np.float16,
+            shape=(num_classes,) + tuple(map_shape),
+        )
+    else:
+        count_map = np.zeros(map_shape, dtype=np.uint8)
+        # this can probably be made into a single multi-class probability map that functions for all workloads
+        probs_map = np.zeros((num_classes,) + tuple(map_shape), dtype=np.float16)
+    return count_map, probs_map
+
+
+def _read_slide_at_map_resolution(
+    os_image,
+    slide_level,
+    map_downsample,
+    map_shape,
+    storage,
+    output_dir,
+    tile_size=2048,
+):
+    """
+    This function reads the slide once at the resolution of the probability maps, tile by tile from the closest pyramid level, so that it can be blended with all heatmaps.
+
+    Args:
+        os_image (tiffslide.TiffSlide): The slide.
+        slide_level (int): The slide level used for inference.
+        map_downsample (int): The downsample factor of the maps relative to the slide level.
+        map_shape (tuple): The (height, width) of the maps.
+        storage (str): Either "memory" to keep the slide in memory, or "disk" to memory-map it from a file in "output_dir".
+        output_dir (str): The directory for the memory-mapped file.
+        tile_size (int, optional): The size of the tiles that are read at once. Defaults to 2048.
+
+    Returns:
+        numpy.ndarray: The (height, width, 3) slide image.
+    """
+    if storage == "disk":
+        slide_map = np.lib.format.open_memmap(
+            os.path.join(output_dir, "slide_map.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=tuple(map_shape) + (3,),
+        )
+    else:
+        slide_map = np.zeros(tuple(map_shape) + (3,), dtype=np.uint8)
+
+    downsample = os_image.level_downsamples[slide_level] * map_downsample
+    read_level = os_image.get_best_level_for_downsample(downsample)
+    read_scale = downsample / os_image.level_downsamples[read_level]
+    for row in range(0, map_shape[0], tile_size):
+        for column in range(0, map_shape[1], tile_size):
+            rows = slice(row, min(row + tile_size, map_shape[0]))
+            columns = slice(column, min(column + tile_size, map_shape[1]))
+            tile_shape = (rows.stop - rows.start, columns.stop - columns.start)
+            slide_region = os_image.read_region(
+                (int(columns.start * downsample), int(rows.start * downsample)),
+                read_level,
+                (
+                    max(1, int(round(tile_shape[1] * read_scale))),
+                    max(1, int(round(tile_shape[0] * read_scale))),
+                ),
+                as_array=True,
+            )[..., :3]
+            if slide_region.shape[:2] != tile_shape:
+                slide_region = cv2.resize(
+                    slide_region,
+                    (tile_shape[1], tile_shape[0]),
+                    interpolation=cv2.INTER_AREA,
+                )
+            slide_map[rows, columns] = slide_region
+    return slide_map
+
+
+def _add_patch_to_probability_maps(
+    probs_map, count_map, patch_output, x_coord, y_coord, patch_size, downsample
+):
+    """
+    This function adds the output of a single patch to the accumulation maps, which can be at a lower resolution than the slide level.
+
+    Args:
+        probs_map (numpy.ndarray): The probability map, or None.
+        count_map (numpy.ndarray): The count map, or None.
+        patch_output (numpy.ndarray): The output of the patch, either per class (C, 1, 1) or per pixel (C, H, W).
+        x_coord (int): The x coordinate of the patch at the slide level.
+        y_coord (int): The y coordinate of the patch at the slide level.
+        patch_size (list): The (width, height) of the patch at the slide level.
+        downsample (int): The downsample factor of the maps relative to the slide level.
+    """
+    map_shape = count_map.shape if count_map is not None else probs_map.shape[1:]
+    y_start, x_start = y_coord // downsample, x_coord // downsample
+    y_end = min(y_start + -(-patch_size[1] // downsample), map_shape[0])
+    x_end = min(x_start + -(-patch_size[0] // downsample), map_shape[1])
+    if count_map is not None:
+        count_map[y_start:y_end, x_start:x_end] += 1
+    if probs_map is not None:
+        if patch_output.shape[-1] > 1:
+            patch_output = patch_output[:, ::downsample, ::downsample][
+                :, : y_end - y_start, : x_end - x_start
+            ]
+        probs_map[:, y_start:y_end, x_start:x_end] += patch_output
+
+
+def _normalize_probability_maps(probs_map, count_map, rows_per_chunk=1024):
+    """
+    This function divides the accumulated probabilities by the counts in place, in chunks of rows to keep the memory bounded.
+
+    Args:
+        probs_map (numpy.ndarray): The probability map.
+        count_map (numpy.ndarray): The count map.
+        rows_per_chunk (int, optional): The number of rows processed at once. Defaults to 1024.
+
+    Returns:
+        float: The maximum of the normalized probability map.
+    """
+    max_probability = 0
+    for row in range(0, count_map.shape[0], rows_per_chunk):
+        rows = slice(row, row + rows_per_chunk)
+        probs_map[:, rows] = np.divide(probs_map[:, rows], count_map[rows])
+        # regions without any patch are not a number
+        max_probability = max(
+            max_probability,
+            np.max(
+                probs_map[:, rows],
+                initial=0,
+                where=~np.isnan(probs_map[:, rows]),
+            ),
+        )
+    return max_probability
+
+
+def _write_pyramidal_tiff(file_to_write, map_shape, get_region, tile_size=256):
+    """
+    This function writes an image as a tiled pyramidal TIFF, where the tiles are generated on demand so that the full image is never in memory.
+
+    Args:
+        file_to_write (str): The output file.
+        map_shape (tuple): The (height, width) of the full resolution image.
+        get_region (function): Returns the uint8 (height, width, channels) image for the arguments (level_downsample, rows, columns), where rows and columns are slices at that level.
+        tile_size (int, optional): The size of the tiles. Defaults to 256.
+    """
+    num_levels = 1
+    while max(map_shape) // 2**num_levels >= tile_size:
+        num_levels += 1
+    sample_tile = get_region(1, slice(0, 1), slice(0, 1))
+
+    def __tiles(level_downsample):
+        level_shape = [-(-size // level_downsample) for size in map_shape]
+        for row in range(0, level_shape[0], tile_size):
+            for column in range(0, level_shape[1], tile_size):
+                region = get_region(
+                    level_downsample,
+                    slice(row, min(row + tile_size, level_shape[0])),
+                    slice(column, min(column + tile_size, level_shape[1])),
+                )
+                tile = np.zeros(
+                    (tile_size, tile_size, region.shape[-1]), dtype=np.uint8
+                )
+                tile[: region.shape[0], : region.shape[1]] = region
+                yield tile
+
+    with tifffile.TiffWriter(file_to_write, bigtiff=True) as tiff:
+        for level in range(num_levels):
+            level_downsample = 2**level
+            tiff.write(
+                __tiles(level_downsample),
+                shape=tuple(-(-size // level_downsample) for size in map_shape)
+                + (sample_tile.shape[-1],),
+                dtype=np.uint8,
+                tile=(tile_size, tile_size),
+                photometric="rgb" if sample_tile.shape[-1] == 3 else "minisblack",
+                compression="zlib",
+                subifds=num_levels - 1 if level == 0 else None,
+                subfiletype=1 if level > 0 else 0,
+            )
+
+
+def _write_probability_maps_as_tiff(
+    probs_map,
+    count_map,
+    slide_map,
+    blending_alpha,
+    output_dir,
+    subject_name,
+):
+    """
+    This function writes the count map, heatmaps, segmentation maps and blended heatmaps of a slide as tiled pyramidal TIFF files, one tile at a time.
+
+    Args:
+        probs_map (numpy.ndarray): The normalized probability map.
+        count_map (numpy.ndarray): The count map.
+        slide_map (numpy.ndarray): The slide at the resolution of the maps; the blended heatmaps are not written if this is None.
+        blending_alpha (float): The weight of the slide when blending with the heatmaps.
+        output_dir (str): The output directory of the subject.
+        subject_name (str): The subject identifier.
+    """
+    map_shape = count_map.shape
+    colormaps = {
+        "_jet": lambda gray: cv2.applyColorMap(gray, cv2.COLORMAP_JET),
+        "_turbo": lambda gray: cv2.applyColorMap(gray, cv2.COLORMAP_TURBO),
+        "_agni": applyCustomColorMap,
+    }
+
+    def __get_slide_region(level_downsample, rows, columns):
+        return slide_map[
+            rows.start
+            * level_downsample : rows.stop
+            * level_downsample : level_downsample,
+            columns.start
+            * level_downsample : columns.stop
+            * level_downsample : level_downsample,
+        ]
+
+    _write_pyramidal_tiff(
+        os.path.join(output_dir, str(subject_name) + "_count.tiff"),
+        map_shape,
+        lambda level_downsample, rows, columns: count_map[
+            rows.start
+            * level_downsample : rows.stop
+            * level_downsample : level_downsample,
+            columns.start
+            * level_downsample : columns.stop
+            * level_downsample : level_downsample,
+        ][..., np.newaxis],
+    )
+
+    for n in range(probs_map.shape[0]):
+
+        def __get_probabilities(level_downsample, rows, columns):
+            return probs_map[
+                n,
+                rows.start
+                * level_downsample : rows.stop
+                * level_downsample : level_downsample,
+                columns.start
+                * level_downsample : columns.stop
+                * level_downsample : level_downsample,
+            ]
+
+        def __get_gray(level_downsample, rows, columns):
+            return np.array(
+                __get_probabilities(level_downsample, rows, columns) * 255,
+                dtype=np.uint8,
+            )
+
+        # save the segmentation maps
+        _write_pyramidal_tiff(
+            os.path.join(output_dir, "seg_map_" + str(n) + ".tiff"),
+            map_shape,
+            lambda level_downsample, rows, columns: (
+                (__get_probabilities(level_downsample, rows, columns) > 0.5).astype(
+                    np.uint8
+                )
+                * 255
+            )[..., np.newaxis],
+        )
+
+        for key, colormap in colormaps.items():
+            _write_pyramidal_tiff(
+                os.path.join(output_dir, "probability_map" + str(n) + key + ".tiff"),
+                map_shape,
+                lambda level_downsample, rows, columns: colormap(
+                    __get_gray(level_downsample, rows, columns)
+                ),
+            )
+            if slide_map is None:
+                continue
+            _write_pyramidal_tiff(
+                os.path.join(
+                    output_dir, "probability_map_blended_" + str(n) + key + ".tiff"
+                ),
+                map_shape,
+                lambda level_downsample, rows, columns: cv2.addWeighted(
+                    __get_slide_region(level_downsample, rows, columns),
+                    blending_alpha,
+                    colormap(__get_gray(level_downsample, rows, columns)),
+                    1 - blending_alpha,
+                    0,
+                ),
+            )
+
+
 def inference_loop(
     inferenceDataFromPickle, device, parameters, modelDir, outputDir=None
 ):
@@ -156,14 +462,23 @@ def inference_loop(
             "mask_level", parameters["slide_level"]
         )
         parameters["blending_alpha"] = float(parameters.get("blending_alpha", 0.5))
+        parameters["blend_heatmaps"] = parameters.get("blend_heatmaps", True)
+        parameters["probability_map_downsample"] = max(
+            1, int(parameters.get("probability_map_downsample", 1))
+        )
+        parameters["probability_map_storage"] = parameters.get(
+            "probability_map_storage", "memory"
+        )
+        parameters["probability_map_format"] = parameters.get(
+            "probability_map_format", "png"
+        )
 
-        output_to_write = "SubjectID,x_coords,y_coords"
+        prediction_columns = []
         if parameters["problem_type"] == "regression":
-            output_to_write += ",output"
+            prediction_columns = ["output"]
         elif parameters["problem_type"] == "classification":
             for n in range(parameters["model"]["num_classes"]):
-                output_to_write += ",probability_" + str(n)
-        output_to_write += "\n"
+                prediction_columns.append("probability_" + str(n))
 
         # actual computation
         pbar = tqdm(inferenceDataFromPickle.iterrows())
@@ -183,13 +498,19 @@ def inference_loop(
             subject_dest_dir = os.path.join(outputDir, str(subject_name))
             Path(subject_dest_dir).mkdir(parents=True, exist_ok=True)
 
+            # the maps can be accumulated at a lower resolution than the slide level
+            map_downsample = parameters["probability_map_downsample"]
+            map_shape = (
+                -(-level_height // map_downsample),
+                -(-level_width // map_downsample),
+            )
             try:
                 count_map, probs_map = None, None
-                count_map = np.zeros((level_height, level_width), dtype=np.uint8)
-                # this can probably be made into a single multi-class probability map that functions for all workloads
-                probs_map = np.zeros(
-                    (parameters["model"]["num_classes"], level_height, level_width),
-                    dtype=np.float16,
+                count_map, probs_map = _initialize_probability_maps(
+                    parameters["model"]["num_classes"],
+                    map_shape,
+                    parameters["probability_map_storage"],
+                    subject_dest_dir,
                 )
             except Exception as e:
                 print(
@@ -225,7 +546,9 @@ def inference_loop(
 
             dataloader = DataLoader(
                 patient_dataset_obj,
-                batch_size=1,
+                batch_size=get_inference_batch_size(
+                    parameters, len(patient_dataset_obj)
+                ),
                 shuffle=False,
                 num_workers=parameters["q_num_workers"],
             )
@@ -245,6 +568,15 @@ def inference_loop(
                 "Looping over patches for subject: " + str(subject_name)
             )
 
+            # the predictions are written as the patches are processed
+            predictions_writer = None
+            if parameters["problem_type"] != "segmentation":
+                predictions_writer = PredictionWriter(
+                    os.path.join(subject_dest_dir, "predictions.csv"),
+                    ["SubjectID", "x_coords", "y_coords"] + prediction_columns,
+                    parameters["predictions_format"],
+                )
+
             for image_patches, (x_coords, y_coords) in dataloader:
                 x_coords, y_coords = x_coords.numpy(), y_coords.numpy()
                 if parameters["model"]["type"] == "torch":
@@ -265,43 +597,75 @@ def inference_loop(
                         }
                     )[parameters["model"]["IO"][1][0]]
 
+                # per-patch outputs (classification/regression) are broadcast over the patch
+                output_for_maps = output[:, : parameters["model"]["num_classes"]]
+                if output_for_maps.ndim == 2:
+                    output_for_maps = output_for_maps[..., np.newaxis, np.newaxis]
                 for i in range(int(output.shape[0])):
-                    if count_map is not None:
-                        count_map[
-                            y_coords[i] : y_coords[i] + patch_size[1],
-                            x_coords[i] : x_coords[i] + patch_size[0],
-                        ] += 1
-                    output_to_write += (
-                        str(subject_name)
-                        + ","
-                        + str(x_coords[i])
-                        + ","
-                        + str(y_coords[i])
+                    # This is a temporary fix for the segmentation problem for single class
+                    _add_patch_to_probability_maps(
+                        probs_map,
+                        count_map,
+                        output_for_maps[i],
+                        x_coords[i],
+                        y_coords[i],
+                        patch_size,
+                        map_downsample,
                     )
-                    for n in range(parameters["model"]["num_classes"]):
-                        # This is a temporary fix for the segmentation problem for single class
-                        if probs_map is not None:
-                            probs_map[
-                                n,
-                                y_coords[i] : y_coords[i] + patch_size[1],
-                                x_coords[i] : x_coords[i] + patch_size[0],
-                            ] += output[i][n]
-                        if parameters["problem_type"] != "segmentation":
-                            output_to_write += "," + str(output[i][n])
-                    output_to_write += "\n"
+
+                if predictions_writer is not None:
+                    batch_predictions = {
+                        "SubjectID": str(subject_name),
+                        "x_coords": x_coords,
+                        "y_coords": y_coords,
+                    }
+                    for n, column in enumerate(prediction_columns):
+                        batch_predictions[column] = output[:, n]
+                    predictions_writer.write(batch_predictions)
+
+            if predictions_writer is not None:
+                predictions_writer.close()
 
             # ensure probability map is scaled
             # reusing variables to save memory
             if probs_map is not None:
-                probs_map = np.divide(probs_map, count_map)
-
                 # Check if out_probs_map is greater than 1, print a warning
-                if np.max(probs_map) > 1:
+                if _normalize_probability_maps(probs_map, count_map) > 1:
                     # Print a warning
                     print(
                         "Warning: Probability map is greater than 1, report the images to GaNDLF developers"
                     )
 
+            # the slide is read once and blended with all heatmaps
+            slide_map = None
+            if probs_map is not None and parameters["blend_heatmaps"]:
+                try:
+                    slide_map = _read_slide_at_map_resolution(
+                        os_image,
+                        parameters["slide_level"],
+                        map_downsample,
+                        map_shape,
+                        parameters["probability_map_storage"],
+                        subject_dest_dir,
+                    )
+                except Exception as ex:
+                    print("Could not read the slide for blending; error:", ex)
+
+            if count_map is not None and parameters["probability_map_format"] == "tiff":
+                try:
+                    _write_probability_maps_as_tiff(
+                        probs_map,
+                        count_map,
+                        slide_map,
+                        parameters["blending_alpha"],
+                        subject_dest_dir,
+                        row[parameters["headers"]["subjectIDHeader"]],
+                    )
+                except Exception as ex:
+                    print("Could not write heatmaps; error:", ex)
+                # the png outputs are not written for tiled maps
+                count_map, probs_map = None, None
+
             if count_map is not None:
                 count_map = np.array(count_map * 255, dtype=np.uint16)
                 imsave(
@@ -313,14 +677,6 @@ def inference_loop(
                     count_map,
                 )
 
-            if parameters["problem_type"] != "segmentation":
-                output_file = os.path.join(
-                    subject_dest_dir,
-                    "predictions.csv",
-                )
-                with open(output_file, "w") as f:
-                    f.write(output_to_write)
-
             heatmaps = {}
             if probs_map is not None:
                 try:
@@ -348,24 +704,23 @@ def inference_loop(
 
                         cv2.imwrite(file_to_write, segmap)
 
+                    blended_image = None
                     for key in heatmaps:
                         file_to_write = os.path.join(
                             subject_dest_dir, "probability_map" + key + ".png"
                         )
                         cv2.imwrite(file_to_write, heatmaps[key])
 
-                        os_image_array = os_image.read_region(
-                            (0, 0),
-                            parameters["slide_level"],
-                            (level_width, level_height),
-                            as_array=True,
-                        )
+                        if slide_map is None:
+                            continue
+                        # the output buffer is reused for all heatmaps
                         blended_image = cv2.addWeighted(
-                            os_image_array,
+                            slide_map,
                             parameters["blending_alpha"],
                             heatmaps[key],
                             1 - parameters["blending_alpha"],
                             0,
+                            dst=blended_image,
                         )
 
                         file_to_write = os.path.join(
@@ -375,3 +730,9 @@ def inference_loop(
                         cv2.imwrite(file_to_write, blended_image)
                 except Exception as ex:
                     print("Could not write heatmaps; error:", ex)
+
+            # the memory-mapped maps are only needed during inference
+            count_map, probs_map, slide_map = None, None, None
+            for map_file in ["count_map.npy", "probs_map.npy", "slide_map.npy"]:
+                if os.path.isfile(os.path.join(subject_dest_dir, map_file)):
+                    os.remove(os.path.join(subject_dest_dir, map_file))
@@ -6,11 +6,14 @@ import torch.nn.functional as nnf
 from GANDLF.utils import one_hot, reverse_one_hot, get_linear_interpolation_mode
 
 
-def get_metric_output(metric_function, predicted, ground_truth, params):
+def get_metric_output(metric_function, predicted, ground_truth, params, to_host=True):
     """
-    This function computes the output of a metric function.
+    This function computes the output of a metric function; unless to_host is True, it is returned as a tensor on the device, so that the device is not synchronized.
     """
-    metric_output = metric_function(predicted, ground_truth, params).detach().cpu()
+    metric_output = metric_function(predicted, ground_truth, params).detach()
+    if not to_host:
+        return metric_output
+    metric_output = metric_output.cpu()
 
     if metric_output.dim() == 0:
         return metric_output.item()
@@ -23,7 +26,7 @@ def get_metric_output(metric_function, predicted, ground_truth, params):
             return metric_output.item()
 
 
-def get_loss_and_metrics(image, ground_truth, predicted, params):
+def get_loss_and_metrics(image, ground_truth, predicted, params, metrics_to_host=True):
     """
     This function computes the loss and metrics for a given image, ground truth and predicted output.
 
@@ -32,6 +35,7 @@ def get_loss_and_metrics(image, ground_truth, predicted, params):
         ground_truth (torch.Tensor): The input ground truth for the corresponding image label.
         predicted (torch.Tensor): The input predicted label for the corresponding image label.
         params (dict): The parameters passed by the user yaml.
+        metrics_to_host (bool, optional): Whether the metrics are returned as numbers, or as tensors on the device. Defaults to True.
 
     Returns:
         torch.Tensor: The computed loss from the label and the prediction.
@@ -111,6 +115,8 @@ def get_loss_and_metrics(image, ground_truth, predicted, params):
             loss = loss_function(predicted, ground_truth, params)
     metric_output = {}
 
+    # intermediate results that are shared between metrics, such as surface distances, only live for this step
+    params["metric_context"] = {}
     # Metrics should be a list
     for metric in params["metrics"]:
         metric_lower = metric.lower()
@@ -119,7 +125,11 @@ def get_loss_and_metrics(image, ground_truth, predicted, params):
             metric_function = global_metrics_dict[metric_lower]
             if sdnet_check:
                 metric_output[metric] = get_metric_output(
-                    metric_function, predicted[0], ground_truth.squeeze(-1), params
+                    metric_function,
+                    predicted[0],
+                    ground_truth.squeeze(-1),
+                    params,
+                    metrics_to_host,
                 )
             else:
                 if deep_supervision_model:
@@ -129,10 +139,16 @@ def get_loss_and_metrics(image, ground_truth, predicted, params):
                             predicted[i],
                             ground_truth_resampled[i],
                             params,
+                            metrics_to_host,
                         )
 
                 else:
                     metric_output[metric] = get_metric_output(
-                        metric_function, predicted, ground_truth, params
+                        metric_function,
+                        predicted,
+                        ground_truth,
+                        params,
+                        metrics_to_host,
                     )
+    params.pop("metric_context", None)
     return loss, metric_output
@@ -3,7 +3,7 @@ import psutil
 from .loss_and_metric import get_loss_and_metrics
 
 
-def step(model, image, label, params, train=True):
+def step(model, image, label, params, train=True, metrics_to_host=True):
     """
     Function that steps the model for a single batch
 
@@ -17,6 +17,10 @@ def step(model, image, label, params, train=True):
         The input label for the corresponding image label
     params : dict
         The parameters passed by the user yaml
+    train : bool
+        Whether the model is being trained
+    metrics_to_host : bool
+        Whether the metrics are returned as numbers, or as tensors on the device to avoid synchronizing it
 
     Returns
     -------
@@ -86,11 +90,14 @@ def step(model, image, label, params, train=True):
 
     # one-hot encoding of 'label' will probably be needed for segmentation
     if label is not None:
-        loss, metric_output = get_loss_and_metrics(image, label, output, params)
+        loss, metric_output = get_loss_and_metrics(
+            image, label, output, params, metrics_to_host
+        )
     else:
         loss, metric_output = None, None
 
-    if len(output) > 1:
+    # models with deep supervision return a list of outputs, and the first one is the final prediction
+    if isinstance(output, (list, tuple)):
         output = output[0]
 
     if params["model"]["dimension"] == 2:
@@ -1,11 +1,12 @@
 import os, time, psutil
+from contextlib import nullcontext
+from functools import partial
 import torch
 from tqdm import tqdm
 import numpy as np
-import torchio
 from medcam import medcam
 
-from GANDLF.data import get_testing_loader
+from GANDLF.data import get_testing_loader, BatchPrefetcher
 from GANDLF.grad_clipping.grad_scaler import GradScaler, model_parameters_exclude_head
 from GANDLF.grad_clipping.clip_gradients import dispatch_clip_grad_
 from GANDLF.utils import (
@@ -15,6 +16,7 @@ from GANDLF.utils import (
     initial_model_path_end,
     save_model,
     optimize_and_save_model,
+    CheckpointWriter,
     load_model,
     version_check,
     write_training_patches,
@@ -22,17 +24,171 @@ from GANDLF.utils import (
     get_ground_truths_and_predictions_tensor,
     get_model_dict,
     print_and_format_metrics,
+    init_distributed,
+    is_distributed,
+    is_main_process,
+    unwrap_model,
+    reduce_across_processes,
+    gather_across_processes,
+    broadcast_from_main_process,
+    set_sampler_epoch,
 )
 from GANDLF.metrics import overall_stats
+from GANDLF.metrics.classification import (
+    get_overall_stats_names,
+    initialize_overall_stats,
+    update_overall_stats,
+    compute_overall_stats,
+)
 from GANDLF.logger import Logger
 from .step import step
-from .forward_pass import validate_network
+from .forward_pass import validate_network, step_scheduler
 from .generic import create_pytorch_objects
 
 # hides torchio citation request, see https://github.com/fepegar/torchio/issues/235
 os.environ["TORCHIO_HIDE_CITATION_PROMPT"] = "1"
 
 
+def is_out_of_memory_error(error):
+    """
+    Function to check if an error was raised because the device (or host) ran out of memory
+
+    Parameters
+    ----------
+    error : RuntimeError
+        The error raised by torch
+
+    Returns
+    -------
+    bool
+        Whether the error is an out of memory error
+
+    """
+    message = str(error).lower()
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def get_metrics_on_host(metrics):
+    """
+    Function to copy the metrics that are accumulated as tensors on the device to the host
+
+    Parameters
+    ----------
+    metrics : dict
+        The metrics, as tensors or numbers
+
+    Returns
+    -------
+    dict
+        The metrics, as numbers for the single values and as arrays for the per-label values
+
+    """
+    host_metrics = {}
+    for metric, value in metrics.items():
+        if torch.is_tensor(value):
+            value = value.cpu()
+            value = np.array(value.tolist()) if value.numel() > 1 else value.item()
+        host_metrics[metric] = value
+    return host_metrics
+
+
+def forward_and_backward(
+    model,
+    image,
+    label,
+    params,
+    backward,
+    num_micro_batches=1,
+    loss_divisor=1,
+    synchronize_gradients=True,
+):
+    """
+    Function to run the forward and backward passes of a batch, split into micro-batches whose gradients are accumulated
+
+    Parameters
+    ----------
+    model : torch.model
+        The model to process the input image with, it should support appropriate dimensions.
+    image : torch.Tensor
+        The input image stack of the batch
+    label : torch.Tensor
+        The label of the batch
+    params : dict
+        the parameters passed by the user yaml
+    backward : Callable
+        Function that backpropagates a loss, accumulating the gradients
+    num_micro_batches : int
+        The number of micro-batches the batch is split into
+    loss_divisor : int
+        The number of batches that the gradients are accumulated over
+    synchronize_gradients : bool
+        Whether the gradients are synchronized across processes after the last micro-batch, for distributed training
+
+    Returns
+    -------
+    loss : torch.Tensor
+        The loss of the batch
+    calculated_metrics : dict
+        The metrics of the batch
+    output : torch.Tensor
+        The output of the model for the batch
+    nan_loss : torch.Tensor
+        Whether any micro-batch had a nan loss, on the device; every micro-batch is backpropagated, so that this is
+        only checked once per optimizer step
+
+    """
+    batch_size = image.shape[0]
+    micro_batch_size = -(-batch_size // num_micro_batches)
+    spacing = params["subject_spacing"]
+    losses, outputs, all_metrics, weights = [], [], [], []
+    nan_loss = torch.zeros((), dtype=torch.bool, device=image.device)
+    # the spacing of the whole batch is always restored, since the batch is retried if a micro-batch is out of memory
+    try:
+        for start in range(0, batch_size, micro_batch_size):
+            end = min(start + micro_batch_size, batch_size)
+            weight = (end - start) / batch_size
+            if spacing is not None:
+                params["subject_spacing"] = spacing[start:end]
+            # for distributed training, the gradients are only synchronized by the last backward pass of a step;
+            # DDP decides this during the forward pass, so both passes run in the context
+            synchronize = synchronize_gradients and end == batch_size
+            sync_context = nullcontext()
+            if not synchronize and hasattr(model, "no_sync"):
+                sync_context = model.no_sync()
+            with sync_context:
+                loss, calculated_metrics, output, _ = step(
+                    model,
+                    image[start:end],
+                    label[start:end],
+                    params,
+                    metrics_to_host=False,
+                )
+
+                # a nan loss only makes the gradients nan, and the optimizer step is skipped for those
+                nan_loss = nan_loss | torch.isnan(loss)
+                backward(loss * weight / loss_divisor)
+
+            losses.append(loss.detach())
+            outputs.append(output)
+            all_metrics.append(calculated_metrics)
+            weights.append(weight)
+    finally:
+        params["subject_spacing"] = spacing
+
+    if len(losses) == 1:
+        return loss, calculated_metrics, output, nan_loss
+
+    # the micro-batches are combined into the results of the whole batch
+    loss = sum(weight * loss for weight, loss in zip(weights, losses))
+    calculated_metrics = {
+        metric: sum(
+            weight * metrics[metric] for weight, metrics in zip(weights, all_metrics)
+        )
+        for metric in all_metrics[0]
+    }
+    return loss, calculated_metrics, torch.cat(outputs), nan_loss
+
+
 def train_network(model, train_dataloader, optimizer, params):
     """
     Function to train a network for a single epoch
@@ -67,11 +223,9 @@ def train_network(model, train_dataloader, optimizer, params):
         params["problem_type"] == "regression"
     )
 
+    # the loss and metrics are accumulated as tensors on the device, and copied to the host when printed
     for metric in params["metrics"]:
-        if "per_label" in metric:
-            total_epoch_train_metric[metric] = []
-        else:
-            total_epoch_train_metric[metric] = 0
+        total_epoch_train_metric[metric] = 0
 
     # automatic mixed precision - https://pytorch.org/docs/stable/amp.html
     if params["model"]["amp"]:
@@ -79,35 +233,41 @@ def train_network(model, train_dataloader, optimizer, params):
         if params["verbose"]:
             print("Using Automatic mixed precision", flush=True)
 
-    # get ground truths
-    if calculate_overall_metrics:
+    # classification stats are accumulated per batch, regression needs the ground truths
+    if params["problem_type"] == "classification":
+        overall_stats_calculators = initialize_overall_stats(params)
+    elif calculate_overall_metrics:
         (
             ground_truth_array,
             predictions_array,
         ) = get_ground_truths_and_predictions_tensor(params, "training_data")
+        predictions_array = predictions_array.to(params["device"])
+    accumulation_steps = params["gradient_accumulation_steps"]
+    # increased if a batch does not fit in memory, and kept for the rest of the epoch
+    num_micro_batches = 1
+    second_order = hasattr(optimizer, "is_second_order") and optimizer.is_second_order
+    if params["model"]["amp"]:
+        backward = partial(scaler.backward, create_graph=second_order)
+    else:
+        backward = partial(torch.Tensor.backward, create_graph=second_order)
+    # with amp, the scaler already skips the steps with non-finite gradients without synchronizing with the device
+    scaler_skips_nan = params["model"]["amp"] and scaler.is_enabled()
+    # whether any loss in the current accumulation window is nan, on the device
+    window_nan_loss = False
+
     # Set the model to train
     model.train()
+    optimizer.zero_grad()
     for batch_idx, (subject) in enumerate(
-        tqdm(train_dataloader, desc="Looping over training data")
-    ):
-        optimizer.zero_grad()
-        image = (
-            torch.cat(
-                [subject[key][torchio.DATA] for key in params["channel_keys"]], dim=1
-            )
-            .float()
-            .to(params["device"])
+        tqdm(
+            BatchPrefetcher(train_dataloader, params["device"]),
+            desc="Looping over training data",
         )
-        if "value_keys" in params:
-            label = torch.cat([subject[key] for key in params["value_keys"]], dim=0)
-            # min is needed because for certain cases, batch size becomes smaller than the total remaining labels
-            label = label.reshape(
-                min(params["batch_size"], len(label)),
-                len(params["value_keys"]),
-            )
-        else:
-            label = subject["label"][torchio.DATA]
-        label = label.to(params["device"])
+    ):
+        # the channels are concatenated by the collator of the loader, and the prefetcher has already
+        # started the copy to the device; these are no-ops in that case
+        image = subject["image_batch"].to(params["device"], non_blocking=True)
+        label = subject["label_batch"].to(params["device"], non_blocking=True)
 
         if params["save_training"]:
             write_training_patches(
@@ -120,61 +280,100 @@ def train_network(model, train_dataloader, optimizer, params):
             params["subject_spacing"] = subject["spacing"]
         else:
             params["subject_spacing"] = None
-        loss, calculated_metrics, output, _ = step(model, image, label, params)
-        # store predictions for classification
-        if calculate_overall_metrics:
-            predictions_array[
-                batch_idx
-                * params["batch_size"] : (batch_idx + 1)
-                * params["batch_size"]
-            ] = (torch.argmax(output[0], 0).cpu().item())
 
-        nan_loss = torch.isnan(loss)
-        second_order = (
-            hasattr(optimizer, "is_second_order") and optimizer.is_second_order
+        # the optimizer steps after every accumulation_steps batches, and at the end of the epoch
+        is_optimizer_step = ((batch_idx + 1) % accumulation_steps == 0) or (
+            batch_idx + 1 == len(train_dataloader)
+        )
+        # the last window of the epoch can have fewer batches, which are averaged over that number instead
+        window_start = batch_idx - batch_idx % accumulation_steps
+        batches_in_window = min(
+            accumulation_steps, len(train_dataloader) - window_start
         )
-        if params["model"]["amp"]:
-            with torch.cuda.amp.autocast():
-                # if loss is nan, don't backprop and don't step optimizer
-                if not nan_loss:
-                    scaler(
-                        loss=loss,
-                        optimizer=optimizer,
+        while True:
+            try:
+                loss, calculated_metrics, output, nan_loss = forward_and_backward(
+                    model,
+                    image,
+                    label,
+                    params,
+                    backward,
+                    num_micro_batches=num_micro_batches,
+                    loss_divisor=batches_in_window,
+                    synchronize_gradients=is_optimizer_step,
+                )
+                break
+            except RuntimeError as error:
+                # the processes would run different collectives if only some of them split their batches
+                if (
+                    is_distributed()
+                    or not is_out_of_memory_error(error)
+                    or num_micro_batches >= image.shape[0]
+                ):
+                    raise
+            # this is outside of the except block, so that the memory held by the error is released
+            num_micro_batches = min(2 * num_micro_batches, image.shape[0])
+            # a failed backward pass might have accumulated part of its gradients
+            optimizer.zero_grad()
+            window_nan_loss = False
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            print(
+                "WARNING: Out of memory, splitting the batches into %d micro-batches; the gradients accumulated for the current step are discarded."
+                % num_micro_batches,
+                flush=True,
+            )
+
+        window_nan_loss = window_nan_loss | nan_loss
+        if is_optimizer_step:
+            # the optimizer does not step if any loss of the accumulation window is nan (in any process); without amp,
+            # this is the only synchronization with the device in an accumulation window
+            skip_step = False
+            if not scaler_skips_nan:
+                skip_step = reduce_across_processes(window_nan_loss, average=False) > 0
+            if not skip_step:
+                if params["model"]["amp"]:
+                    scaler.step(
+                        optimizer,
                         clip_grad=params["clip_grad"],
                         clip_mode=params["clip_mode"],
                         parameters=model_parameters_exclude_head(
                             model, clip_mode=params["clip_mode"]
                         ),
-                        create_graph=second_order,
-                    )
-        else:
-            if not nan_loss:
-                loss.backward(create_graph=second_order)
-                if params["clip_grad"] is not None:
-                    dispatch_clip_grad_(
-                        parameters=model_parameters_exclude_head(
-                            model, clip_mode=params["clip_mode"]
-                        ),
-                        value=params["clip_grad"],
-                        mode=params["clip_mode"],
                     )
-                optimizer.step()
+                else:
+                    if params["clip_grad"] is not None:
+                        dispatch_clip_grad_(
+                            parameters=model_parameters_exclude_head(
+                                model, clip_mode=params["clip_mode"]
+                            ),
+                            value=params["clip_grad"],
+                            mode=params["clip_mode"],
+                        )
+                    optimizer.step()
+            optimizer.zero_grad()
+            window_nan_loss = False
+
+        # store predictions for classification
+        if params["problem_type"] == "classification":
+            update_overall_stats(
+                overall_stats_calculators,
+                torch.argmax(output, 1).view(-1).detach(),
+                label.view(-1).int(),
+                params,
+            )
+        elif calculate_overall_metrics:
+            predictions_array[
+                batch_idx
+                * params["batch_size"] : (batch_idx + 1)
+                * params["batch_size"]
+            ] = torch.argmax(output[0], 0)
 
         # Non network training related
-        if not nan_loss:
-            total_epoch_train_loss += loss.detach().cpu().item()
+        loss = loss.detach()
+        total_epoch_train_loss += torch.where(torch.isnan(loss), 0.0, loss.float())
         for metric in calculated_metrics.keys():
-            if isinstance(total_epoch_train_metric[metric], list):
-                if len(total_epoch_train_metric[metric]) == 0:
-                    total_epoch_train_metric[metric] = np.array(
-                        calculated_metrics[metric]
-                    )
-                else:
-                    total_epoch_train_metric[metric] += np.array(
-                        calculated_metrics[metric]
-                    )
-            else:
-                total_epoch_train_metric[metric] += calculated_metrics[metric]
+            total_epoch_train_metric[metric] += calculated_metrics[metric]
 
         if params["verbose"]:
             # For printing information at halftime during an epoch
@@ -183,27 +382,46 @@ def train_network(model, train_dataloader, optimizer, params):
             ):
                 print(
                     "\nHalf-Epoch Average train loss : ",
-                    total_epoch_train_loss / (batch_idx + 1),
+                    float(total_epoch_train_loss) / (batch_idx + 1),
                 )
+                host_train_metric = get_metrics_on_host(total_epoch_train_metric)
                 for metric in params["metrics"]:
-                    if isinstance(total_epoch_train_metric[metric], np.ndarray):
+                    if isinstance(host_train_metric[metric], np.ndarray):
                         to_print = (
-                            total_epoch_train_metric[metric] / (batch_idx + 1)
+                            host_train_metric[metric] / (batch_idx + 1)
                         ).tolist()
                     else:
-                        to_print = total_epoch_train_metric[metric] / (batch_idx + 1)
+                        to_print = host_train_metric[metric] / (batch_idx + 1)
                     print(
                         "Half-Epoch Average train " + metric + " : ",
                         to_print,
                     )
 
+    # the totals are only copied from the device at the end of the epoch
+    total_epoch_train_loss = float(total_epoch_train_loss)
+    total_epoch_train_metric = get_metrics_on_host(total_epoch_train_metric)
+    # every process has the same number of batches, so the totals are averaged over the processes
+    total_epoch_train_loss = reduce_across_processes(total_epoch_train_loss)
+    total_epoch_train_metric = reduce_across_processes(total_epoch_train_metric)
     average_epoch_train_loss = total_epoch_train_loss / len(train_dataloader)
     print("     Epoch Final   train loss : ", average_epoch_train_loss)
 
     # get overall stats for classification
-    if calculate_overall_metrics:
+    if params["problem_type"] == "classification":
+        # the states of the calculators are synchronized across processes by torchmetrics when computing
+        average_epoch_train_metric = compute_overall_stats(overall_stats_calculators)
+    elif calculate_overall_metrics:
+        if is_distributed():
+            # the predictions of all processes are gathered, and the subjects that the sampler repeats to
+            # even out the shards are dropped
+            num_predictions = min(
+                len(train_dataloader) * params["batch_size"], len(predictions_array)
+            )
+            predictions_array = gather_across_processes(
+                predictions_array[:num_predictions]
+            )[: len(ground_truth_array)]
         average_epoch_train_metric = overall_stats(
-            predictions_array, ground_truth_array, params
+            predictions_array.cpu(), ground_truth_array, params
         )
     average_epoch_train_metric = print_and_format_metrics(
         average_epoch_train_metric,
@@ -216,6 +434,45 @@ def train_network(model, train_dataloader, optimizer, params):
     return average_epoch_train_loss, average_epoch_train_metric
 
 
+def validate_on_main_process(model, data_loader, scheduler, params, epoch, mode):
+    """
+    Function to validate a network for a single epoch in the main process only, so that the validation work does not
+    grow with the number of processes; the other processes get its results, and step their schedulers with its loss
+
+    Parameters
+    ----------
+    model : torch.model
+        The model to process the input image with, without the wrapper of distributed training
+    data_loader : torch.DataLoader
+        The dataloader for the validation (or testing) epoch
+    scheduler : object
+        The scheduler that is stepped after the epoch
+    params : dict
+        The parameters passed by the user yaml
+    epoch : int
+        The current epoch
+    mode : str
+        The mode of validation, used to write outputs, if requested
+
+    Returns
+    -------
+    average_epoch_valid_loss : float
+        Validation loss for the current epoch
+    average_epoch_valid_metric : dict
+        Validation metrics for the current epoch
+
+    """
+    results = None
+    if is_main_process():
+        results = validate_network(
+            model, data_loader, scheduler, params, epoch, mode=mode
+        )
+    results = broadcast_from_main_process(results)
+    if not is_main_process():
+        step_scheduler(scheduler, params, results[0])
+    return results
+
+
 def training_loop(
     training_data,
     validation_data,
@@ -241,6 +498,12 @@ def training_loop(
     if epochs is None:
         epochs = params["num_epochs"]
     params["device"] = device
+    # no-op, unless launched with multiple processes by torchrun
+    distributed = init_distributed(device)
+    if not is_main_process():
+        # only the main process writes the outputs
+        params["save_output"] = False
+        params["save_training"] = False
     params["output_dir"] = output_dir
     params["training_data"] = training_data
     params["validation_data"] = validation_data
@@ -304,7 +567,7 @@ def training_loop(
     # if previous model file is present, load it up
     if main_dict is not None:
         try:
-            model.load_state_dict(main_dict["model_state_dict"])
+            unwrap_model(model).load_state_dict(main_dict["model_state_dict"])
             start_epoch = main_dict["epoch"]
             optimizer.load_state_dict(main_dict["optimizer_state_dict"])
             best_loss = main_dict["loss"]
@@ -342,13 +605,7 @@ def training_loop(
     if params["problem_type"] == "regression":
         overall_metrics = overall_stats(torch.Tensor([1]), torch.Tensor([1]), params)
     elif params["problem_type"] == "classification":
-        # this is just used to generate the headers for the overall stats
-        temp_tensor = torch.randint(0, params["model"]["num_classes"], (5,))
-        overall_metrics = overall_stats(
-            temp_tensor.to(dtype=torch.int32),
-            temp_tensor.to(dtype=torch.int32),
-            params,
-        )
+        overall_metrics = get_overall_stats_names()
 
     metrics_log = params["metrics"].copy()
     if calculate_overall_metrics:
@@ -390,10 +647,16 @@ def training_loop(
         params["medcam_enabled"] = False
 
     print("Using device:", device, flush=True)
+    checkpoint_writer = CheckpointWriter()
+    if distributed:
+        # the main process validates the whole model, without the synchronization of the training
+        validation_model = unwrap_model(model)
+    else:
+        validation_model = model
 
     # Iterate for number of epochs
     for epoch in range(start_epoch, epochs):
-        if params["track_memory_usage"]:
+        if params["track_memory_usage"] and is_main_process():
             file_to_write_mem = os.path.join(output_dir, "memory_usage.csv")
             if os.path.exists(file_to_write_mem):
                 # append to previously generated file
@@ -442,12 +705,20 @@ def training_loop(
             print("Epoch start time : ", get_date_time())
 
         params["current_epoch"] = epoch
+        # every process gets a different share of the training data in every epoch
+        set_sampler_epoch(train_dataloader, epoch)
 
         epoch_train_loss, epoch_train_metric = train_network(
             model, train_dataloader, optimizer, params
         )
-        epoch_valid_loss, epoch_valid_metric = validate_network(
-            model, val_dataloader, scheduler, params, epoch, mode="validation"
+        # every process gets the same loss, to make the same best model and patience decisions
+        epoch_valid_loss, epoch_valid_metric = validate_on_main_process(
+            validation_model,
+            val_dataloader,
+            scheduler,
+            params,
+            epoch,
+            mode="validation",
         )
 
         patience += 1
@@ -457,8 +728,13 @@ def training_loop(
         valid_logger.write(epoch, epoch_valid_loss, epoch_valid_metric)
 
         if testingDataDefined:
-            epoch_test_loss, epoch_test_metric = validate_network(
-                model, test_dataloader, scheduler, params, epoch, mode="testing"
+            epoch_test_loss, epoch_test_metric = validate_on_main_process(
+                validation_model,
+                test_dataloader,
+                scheduler,
+                params,
+                epoch,
+                mode="testing",
             )
             test_logger.write(epoch, epoch_test_loss, epoch_test_metric)
 
@@ -475,64 +751,49 @@ def training_loop(
         model_dict = get_model_dict(model, params["device_id"])
 
         # Start to check for loss
-        if not (first_model_saved) or (epoch_valid_loss <= torch.tensor(best_loss)):
+        is_best_model = not (first_model_saved) or (
+            epoch_valid_loss <= torch.tensor(best_loss)
+        )
+        if is_best_model:
             best_loss = epoch_valid_loss
             best_train_idx = epoch
             patience = 0
-
-            model.eval()
-
-            save_model(
-                {
-                    "epoch": best_train_idx,
-                    "model_state_dict": model_dict,
-                    "optimizer_state_dict": optimizer.state_dict(),
-                    "loss": best_loss,
-                },
-                model,
-                params,
-                model_paths["best"],
-                onnx_export=False,
-            )
-            model.train()
             first_model_saved = True
 
+        # the paths of every checkpoint (epoch, loss), which is serialized once for all of them
+        checkpoints = {}
+        if is_best_model:
+            checkpoints[(best_train_idx, float(best_loss))] = [model_paths["best"]]
         if params["model"]["save_at_every_epoch"]:
-            save_model(
-                {
-                    "epoch": epoch,
-                    "model_state_dict": model_dict,
-                    "optimizer_state_dict": optimizer.state_dict(),
-                    "loss": epoch_valid_loss,
-                },
-                model,
-                params,
+            checkpoints.setdefault((epoch, float(epoch_valid_loss)), []).append(
                 os.path.join(
                     output_dir,
                     params["model"]["architecture"]
                     + "_epoch_"
                     + str(epoch)
                     + ".pth.tar",
-                ),
-                onnx_export=False,
+                )
             )
-            model.train()
-
         # save the latest model
-        if os.path.exists(model_paths["latest"]):
-            os.remove(model_paths["latest"])
-        save_model(
-            {
-                "epoch": epoch,
-                "model_state_dict": model_dict,
-                "optimizer_state_dict": optimizer.state_dict(),
-                "loss": best_loss,
-            },
-            model,
-            params,
-            model_paths["latest"],
-            onnx_export=False,
+        checkpoints.setdefault((epoch, float(best_loss)), []).append(
+            model_paths["latest"]
         )
+
+        model.eval()
+        for (checkpoint_epoch, checkpoint_loss), paths in checkpoints.items():
+            checkpoint_writer.save(
+                {
+                    "epoch": checkpoint_epoch,
+                    "model_state_dict": model_dict,
+                    "optimizer_state_dict": optimizer.state_dict(),
+                    "loss": checkpoint_loss,
+                },
+                model,
+                params,
+                paths,
+                onnx_export=False,
+            )
+        model.train()
         print("Latest model saved.")
         print("Current Best epoch: ", best_train_idx)
 
@@ -546,6 +807,7 @@ def training_loop(
 
     # End train time
     end_time = time.time()
+    checkpoint_writer.close()
 
     print(
         "Total time to finish Training : ",
@@ -556,7 +818,9 @@ def training_loop(
 
     # once the training is done, optimize the best model
     if os.path.exists(model_paths["best"]):
-        optimize_and_save_model(model, params, model_paths["best"], onnx_export=True)
+        optimize_and_save_model(
+            unwrap_model(model), params, model_paths["best"], onnx_export=True
+        )
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 import numpy as np
 
@@ -9,12 +11,20 @@ import SimpleITK as sitk
 from tqdm import tqdm
 
 from GANDLF.utils import (
+    get_image_header,
     perform_sanity_check_on_subject,
     resize_image,
     get_filename_extension_sanitized,
+    get_distributed_sampler,
 )
 from .preprocessing import get_transforms_for_preprocessing
 from .augmentation import global_augs_dict
+from .subject_cache import (
+    get_subject_cache_key,
+    load_subject_from_cache,
+    save_subject_to_cache,
+)
+from .patch_miner.opm.patch_shards import split_shard_reference, read_patch_shard_image
 
 global_sampler_dict = {
     "uniform": torchio.data.UniformSampler,
@@ -68,6 +78,7 @@ def ImagesFromDataFrame(
     preprocessing = parameters["data_preprocessing"]
     in_memory = parameters["in_memory"]
     enable_padding = parameters["enable_padding"]
+    cache_dir = parameters.get("cache_dir", None)
 
     # Finding the dimension of the dataframe for computational purposes later
     num_row, num_col = dataframe.shape
@@ -102,6 +113,45 @@ def ImagesFromDataFrame(
                     preprocessing["resize_image"] = preprocessing[key]
                     break
 
+    # padding image, but only for label sampler, because we don't want to pad for uniform
+    padder = None
+    if "label" in sampler or "weight" in sampler:
+        if enable_padding:
+            psize_pad = list(np.asarray(np.ceil(np.divide(patch_size, 2)), dtype=int))
+            # for modes: https://numpy.org/doc/stable/reference/generated/numpy.pad.html
+            padder = Pad(psize_pad, padding_mode=sampler_padding)
+
+    transformations_list = []
+
+    # augmentations are applied to the training set only
+    if train and not (augmentations is None):
+        for aug in augmentations:
+            aug_lower = aug.lower()
+            if aug_lower in global_augs_dict:
+                transformations_list.append(
+                    global_augs_dict[aug_lower](augmentations[aug])
+                )
+
+    # the deterministic pre-processing can only be cached when no augmentation is applied before it
+    cache_preprocessing = len(transformations_list) == 0
+    cache_transform = None
+    if cache_dir is not None:
+        if cache_preprocessing:
+            cache_transform = get_transforms_for_preprocessing(
+                parameters, [], train, apply_zero_crop
+            )
+        # these are all the parameters that change the cached images
+        cache_parameters = {
+            "resize_image": preprocessing.get("resize_image")
+            if resize_images_flag and not (parameters["memory_save_mode"])
+            else None,
+            "padding": [psize_pad, sampler_padding] if padder is not None else None,
+            "data_preprocessing": preprocessing if cache_preprocessing else None,
+            "patch_size": patch_size,
+            "zero_crop": (train or apply_zero_crop)
+            and ("crop_external_zero_planes" in (preprocessing or {})),
+        }
+
     # helper function to save the resized images
     def _save_resized_images(
         resized_image, output_dir, subject_id, channel_str, loader_type, extension
@@ -129,31 +179,88 @@ def ImagesFromDataFrame(
         if not os.path.isfile(save_path):
             sitk.WriteImage(resized_image, save_path)
 
-    # iterating through the dataframe
-    for patient in tqdm(
-        range(num_row), desc="Constructing queue for " + loader_type + " data"
-    ):
+    def _is_file(path):
+        """
+        Helper function to check if an image exists, which can also be a patch inside a shard written by the patch miner.
+
+        Args:
+            path (str): The path to the image.
+
+        Returns:
+            bool: True if the file (or shard) exists.
+        """
+        return os.path.isfile(split_shard_reference(path)[0])
+
+    def _get_image(path, image_class):
+        """
+        Helper function to get the torchio image, which reads patches inside shards directly from the shard.
+
+        Args:
+            path (str): The path to the image.
+            image_class (type): Either torchio.ScalarImage or torchio.LabelMap.
+
+        Returns:
+            torchio.Image: The image, which is loaded lazily.
+        """
+        shard_path, member = split_shard_reference(path)
+        if member is None:
+            return image_class(path)
+        return image_class(
+            shard_path,
+            reader=partial(read_patch_shard_image, member=member),
+            shard_member=member,
+        )
+
+    def _construct_subject(patient):
+        """
+        Helper function to construct and sanity check a single subject.
+
+        Args:
+            patient (int): The row of the subject in the dataframe.
+
+        Returns:
+            tuple: The torchio.Subject (None if its files are missing) and whether it failed the sanity check.
+        """
         # We need this dict for storing the meta data for each subject
         # such as different image modalities, labels, any other data
         subject_dict = {}
         subject_dict["subject_id"] = str(dataframe[subjectIDHeader][patient])
         skip_subject = False
+
+        # re-use the images of this subject if they have been cached previously
+        cached_subject, cache_key = None, None
+        if cache_dir is not None:
+            files_for_subject = {
+                str(channel): str(dataframe[channel][patient])
+                for channel in channelHeaders
+            }
+            if labelHeader is not None:
+                files_for_subject["label"] = str(dataframe[labelHeader][patient])
+            if all(os.path.isfile(file) for file in files_for_subject.values()):
+                cache_key = get_subject_cache_key(files_for_subject, cache_parameters)
+                cached_subject = load_subject_from_cache(cache_dir, cache_key)
+                if cached_subject is not None:
+                    subject_dict["spacing"] = cached_subject["spacing"]
+
         # iterating through the channels/modalities/timepoints of the subject
         for channel in channelHeaders:
             # sanity check for malformed csv
-            if not os.path.isfile(str(dataframe[channel][patient])):
+            if not _is_file(str(dataframe[channel][patient])):
                 skip_subject = True
 
-            subject_dict[str(channel)] = torchio.ScalarImage(
-                dataframe[channel][patient]
+            if cached_subject is not None:
+                subject_dict[str(channel)] = cached_subject[str(channel)]
+                continue
+
+            subject_dict[str(channel)] = _get_image(
+                str(dataframe[channel][patient]), torchio.ScalarImage
             )
 
             # store image spacing information if not present
             if "spacing" not in subject_dict:
-                file_reader = sitk.ImageFileReader()
-                file_reader.SetFileName(str(dataframe[channel][patient]))
-                file_reader.ReadImageInformation()
-                subject_dict["spacing"] = torch.Tensor(file_reader.GetSpacing())
+                subject_dict["spacing"] = torch.Tensor(
+                    get_image_header(str(dataframe[channel][patient])).GetSpacing()
+                )
 
             # if resize_image is requested, the perform per-image resize with appropriate interpolator
             if resize_images_flag:
@@ -185,14 +292,19 @@ def ImagesFromDataFrame(
         #         sys.exit('The \'class_list\' parameter has been defined but a label file is not present for patient: ', patient)
 
         if labelHeader is not None:
-            if not os.path.isfile(str(dataframe[labelHeader][patient])):
+            if not _is_file(str(dataframe[labelHeader][patient])):
                 skip_subject = True
 
-            subject_dict["label"] = torchio.LabelMap(dataframe[labelHeader][patient])
+            if cached_subject is not None:
+                subject_dict["label"] = cached_subject["label"]
+            else:
+                subject_dict["label"] = _get_image(
+                    str(dataframe[labelHeader][patient]), torchio.LabelMap
+                )
             subject_dict["path_to_metadata"] = str(dataframe[labelHeader][patient])
 
             # if resize is requested, the perform per-image resize with appropriate interpolator
-            if resize_images_flag:
+            if resize_images_flag and cached_subject is None:
                 img_resized = resize_image(
                     subject_dict["label"].as_sitk(),
                     preprocessing["resize_image"],
@@ -226,6 +338,7 @@ def ImagesFromDataFrame(
             valueCounter += 1
 
         # skip subject the condition was tripped
+        subject_error = False
         if not skip_subject:
             # Initializing the subject object using the dict
             subject = torchio.Subject(subject_dict)
@@ -240,7 +353,7 @@ def ImagesFromDataFrame(
             try:
                 perform_sanity_check_on_subject(subject, parameters)
             except Exception as exception:
-                subjects_with_error.append(subject["subject_id"])
+                subject_error = True
                 print(
                     "Subject '"
                     + subject["subject_id"]
@@ -250,22 +363,45 @@ def ImagesFromDataFrame(
                     + "; message: {}".format(exception)
                 )
 
-            # # padding image, but only for label sampler, because we don't want to pad for uniform
-            if "label" in sampler or "weight" in sampler:
-                if enable_padding:
-                    psize_pad = list(
-                        np.asarray(np.ceil(np.divide(patch_size, 2)), dtype=int)
-                    )
-                    # for modes: https://numpy.org/doc/stable/reference/generated/numpy.pad.html
-                    padder = Pad(psize_pad, padding_mode=sampler_padding)
+            if cached_subject is None:
+                if padder is not None:
                     subject = padder(subject)
 
+                # cache the (padded and pre-processed) images for subsequent loaders and runs
+                # patches inside shards are not cached, since they are already stored uncompressed
+                if cache_key is not None and not subject_error:
+                    cached_images = save_subject_to_cache(
+                        subject, cache_dir, cache_key, cache_transform
+                    )
+                    for key in cached_images:
+                        subject[key] = cached_images[key]
+                elif cache_transform is not None and not subject_error:
+                    # subjects that cannot be cached (such as patches inside shards) are pre-processed
+                    # here, since the dataset does not apply the pre-processing when caching
+                    subject = cache_transform(subject)
+
             # load subject into memory: https://github.com/fepegar/torchio/discussions/568#discussioncomment-859027
             if in_memory:
                 subject.load()
 
-            # Appending this subject to the list of subjects
-            subjects_list.append(subject)
+            return subject, subject_error
+
+        return None, subject_error
+
+    # subjects are independent of each other, and constructing them is dominated by file I/O
+    with ThreadPoolExecutor(
+        max_workers=max(1, parameters["subject_construction_num_workers"])
+    ) as executor:
+        for subject, subject_error in tqdm(
+            executor.map(_construct_subject, range(num_row)),
+            total=num_row,
+            desc="Constructing queue for " + loader_type + " data",
+        ):
+            if subject is not None:
+                if subject_error:
+                    subjects_with_error.append(subject["subject_id"])
+                # Appending this subject to the list of subjects
+                subjects_list.append(subject)
 
     if subjects_with_error:
         raise ValueError(
@@ -273,20 +409,13 @@ def ImagesFromDataFrame(
             subjects_with_error,
         )
 
-    transformations_list = []
-
-    # augmentations are applied to the training set only
-    if train and not (augmentations is None):
-        for aug in augmentations:
-            aug_lower = aug.lower()
-            if aug_lower in global_augs_dict:
-                transformations_list.append(
-                    global_augs_dict[aug_lower](augmentations[aug])
-                )
-
-    transform = get_transforms_for_preprocessing(
-        parameters, transformations_list, train, apply_zero_crop
-    )
+    if cache_dir is not None and cache_preprocessing:
+        # the pre-processing has already been applied to the cached images
+        transform = None
+    else:
+        transform = get_transforms_for_preprocessing(
+            parameters, transformations_list, train, apply_zero_crop
+        )
 
     subjects_dataset = torchio.SubjectsDataset(subjects_list, transform=transform)
     if not train:
@@ -295,14 +424,17 @@ def ImagesFromDataFrame(
         sampler = global_sampler_dict[sampler](patch_size, probability_map="label")
     else:
         sampler = global_sampler_dict[sampler](patch_size)
+    # for distributed training, every process queues patches from its own share of the subjects
+    subject_sampler = get_distributed_sampler(subjects_dataset)
     # all of these need to be read from model.yaml
     patches_queue = torchio.Queue(
         subjects_dataset,
         max_length=q_max_length,
         samples_per_volume=q_samples_per_volume,
         sampler=sampler,
+        subject_sampler=subject_sampler,
         num_workers=q_num_workers,
-        shuffle_subjects=True,
+        shuffle_subjects=subject_sampler is None,
         shuffle_patches=True,
         verbose=q_verbose,
     )
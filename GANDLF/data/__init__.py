@@ -1,8 +1,44 @@
+import torch
 from torch.utils.data import DataLoader
 
 from .ImagesFromDataFrame import ImagesFromDataFrame
+from .training_dataloader_histopath import get_train_wsi_patch_dataset
+from .training_batch import TrainingBatchCollator, BatchPrefetcher
 from GANDLF.utils.write_parse import get_dataframe
-from GANDLF.utils import populate_channel_keys_in_params
+from GANDLF.utils import populate_channel_keys_in_params, get_distributed_sampler
+
+
+def get_dataloader_kwargs(params, train):
+    """
+    Get the keyword arguments for the data loaders.
+
+    Args:
+        params (dict): Dictionary of parameters.
+        train (bool): Whether the loader is for training.
+
+    Returns:
+        dict: The keyword arguments to pass to torch.utils.data.DataLoader.
+    """
+    loader_kwargs = {}
+    if train:
+        # only the training batches are sent to the device as-is; validation/testing subjects are whole
+        # volumes that get re-sampled into patches on the cpu, and pinning these variable-sized volumes
+        # causes the pinned memory cache of torch to grow until the host goes out of memory
+        loader_kwargs["pin_memory"] = (
+            params["pin_memory_dataloader"]
+            and torch.cuda.is_available()
+            and "cuda" in str(params.get("device", "cpu"))
+        )
+    else:
+        # worker processes are only added here, since the training queue already uses its own
+        num_workers = params["num_workers_dataloader"]
+        if num_workers > 0:
+            loader_kwargs["num_workers"] = num_workers
+            loader_kwargs["prefetch_factor"] = params["prefetch_factor_dataloader"]
+            loader_kwargs["persistent_workers"] = params[
+                "persistent_workers_dataloader"
+            ]
+    return loader_kwargs
 
 
 def get_train_loader(params):
@@ -15,17 +51,60 @@ def get_train_loader(params):
     Returns:
         torch.utils.data.DataLoader: The training loader.
     """
-
-    return DataLoader(
-        ImagesFromDataFrame(
+    loader_kwargs = get_dataloader_kwargs(params, train=True)
+    if params["wsi_patch_sampling"]:
+        # the patches are read from the slides by the workers of this loader, instead of the queue
+        training_dataset = get_train_wsi_patch_dataset(
+            get_dataframe(params["training_data"]), params
+        )
+        if params["q_num_workers"] > 0:
+            loader_kwargs["num_workers"] = params["q_num_workers"]
+            loader_kwargs["persistent_workers"] = True
+    else:
+        training_dataset = ImagesFromDataFrame(
             get_dataframe(params["training_data"]),
             params,
             train=True,
             loader_type="train",
-        ),
+        )
+
+    # the queue shards the subjects itself, so only the slide dataset needs a sampler
+    sampler = None
+    if params["wsi_patch_sampling"]:
+        sampler = get_distributed_sampler(training_dataset)
+
+    return DataLoader(
+        training_dataset,
         batch_size=params["batch_size"],
-        shuffle=True,
-        pin_memory=False,  # params["pin_memory_dataloader"], # this is going OOM if True - needs investigation
+        shuffle=sampler is None,
+        sampler=sampler,
+        collate_fn=TrainingBatchCollator(params),
+        **loader_kwargs,
+    )
+
+
+def _get_evaluation_dataset(params, data_key, loader_type):
+    """
+    Get the dataset of the validation or testing data.
+
+    Args:
+        params (dict): Dictionary of parameters.
+        data_key (str): The key of the data in the parameters.
+        loader_type (str): The type of the loader.
+
+    Returns:
+        torch.utils.data.Dataset: The dataset.
+    """
+    if params["wsi_patch_sampling"]:
+        # the slides are too large to be read whole, so they are evaluated on a fixed patch per slide
+        return get_train_wsi_patch_dataset(
+            get_dataframe(params[data_key]), params, train=False
+        )
+    return ImagesFromDataFrame(
+        get_dataframe(params[data_key]),
+        params,
+        train=False,
+        loader_type=loader_type,
     )
 
 
@@ -39,11 +118,8 @@ def get_validation_loader(params):
     Returns:
         torch.utils.data.DataLoader: The validation loader.
     """
-    queue_from_dataframe = ImagesFromDataFrame(
-        get_dataframe(params["validation_data"]),
-        params,
-        train=False,
-        loader_type="validation",
+    queue_from_dataframe = _get_evaluation_dataset(
+        params, "validation_data", "validation"
     )
     # Fetch the appropriate channel keys
     # Getting the channels for training and removing all the non numeric entries from the channels
@@ -52,7 +128,7 @@ def get_validation_loader(params):
     return DataLoader(
         queue_from_dataframe,
         batch_size=1,
-        pin_memory=False,  # params["pin_memory_dataloader"], # this is going OOM if True - needs investigation
+        **get_dataloader_kwargs(params, train=False),
     )
 
 
@@ -69,16 +145,13 @@ def get_testing_loader(params):
     if params["testing_data"] is None:
         return None
     else:
-        queue_from_dataframe = ImagesFromDataFrame(
-            get_dataframe(params["testing_data"]),
-            params,
-            train=False,
-            loader_type="testing",
+        queue_from_dataframe = _get_evaluation_dataset(
+            params, "testing_data", "testing"
         )
         if not ("channel_keys" in params):
             params = populate_channel_keys_in_params(queue_from_dataframe, params)
         return DataLoader(
             queue_from_dataframe,
             batch_size=1,
-            pin_memory=False,  # params["pin_memory_dataloader"], # this is going OOM if True - needs investigation
+            **get_dataloader_kwargs(params, train=False),
         )
@@ -6,6 +6,7 @@ Created on Fri Mar  8 20:03:35 2019
 @author: siddhesh
 """
 
+import math
 import os
 
 import numpy as np
@@ -38,6 +39,24 @@ def get_tissue_mask(image):
     return mask
 
 
+def _get_mask_block_size(scale, stride_size, patch_size):
+    """
+    This function returns the largest block size (in mask pixels) that all patch boundaries in the mask are aligned to.
+
+    Args:
+        scale (float): The number of mask pixels per pixel at the selected level.
+        stride_size (int): The stride size at the selected level.
+        patch_size (int): The patch size at the selected level.
+
+    Returns:
+        int: The block size, which is 1 if the patches are not aligned to the mask pixels.
+    """
+    stride_in_mask, patch_in_mask = stride_size * scale, patch_size * scale
+    if float(stride_in_mask).is_integer() and float(patch_in_mask).is_integer():
+        return max(1, math.gcd(int(stride_in_mask), int(patch_in_mask)))
+    return 1
+
+
 class InferTumorSegDataset(Dataset):
     def __init__(
         self,
@@ -61,12 +80,14 @@ class InferTumorSegDataset(Dataset):
         self._selected_level = selected_level
         self._mask_level = mask_level
         self._os_image = tiffslide.open_slide(os.path.join(self._wsi_path))
+        self._os_image_pid = os.getpid()
         self._points = []
         self._basic_preprocessing()
 
     def _basic_preprocessing(self):
         mask = None
-        height, width = self._os_image.level_dimensions[self._selected_level]
+        # level_dimensions are (x, y), while the arrays are indexed as [y, x]
+        size_x, size_y = self._os_image.level_dimensions[self._selected_level]
         try:
             mask_xdim, mask_ydim = self._os_image.level_dimensions[self._mask_level]
             mask = get_tissue_mask(
@@ -77,53 +98,102 @@ class InferTumorSegDataset(Dataset):
                     as_array=True,
                 )
             )
-
-            if self._selected_level != self._mask_level:
-                mask = resize(mask, (height, width))
+            # the fallback mask has the channels of the image
+            if mask.ndim > 2:
+                mask = np.any(mask, axis=-1)
+            # the mask is kept at the mask level, the patches are mapped to it instead
             mask = (mask > 0).astype(np.ubyte)
         except Exception as e:
             print("Mask could not be initialized, using entire image:", e)
-        # This is buggy because currently if mask_level is not equal to selected_level,
-        # then this logic straight up does not work
-        # You would have to scale the patch size appropriately for this to work correctly
-        # Remove all the points which are closer to the boundary of the wsi
-        # by accessing the WSI level properties with
-        # self._os_image.level_dimensions[self._selected_level]
-        # Logic as if point + self.patch_size > wsi_dimensions
-        # The move the point by the wsi_dimensions - (patch_size + self.points)
-        # This is because the patch is not going to be extracted if it is
-        # outside the wsi
-        for i in range(
+
+        # the candidate patches are on a regular grid, where the last patch is always completely inside the wsi
+        coords_y = np.arange(
             0,
-            width - (self._patch_size[0] + self._stride_size[0]),
+            size_y - (self._patch_size[0] + self._stride_size[0]),
             self._stride_size[0],
-        ):
-            for j in range(
-                0,
-                height - (self._patch_size[1] + self._stride_size[1]),
-                self._stride_size[1],
-            ):
-                # If point goes beyond the wsi in y_dim, then move so that we can extract the patch
-                coord_width, coord_height = i, j
-                if i + self._patch_size[0] > width:
-                    coord_width = width - self._patch_size[0]
-                # If point goes beyond the wsi in x_dim, then move so that we can extract the patch
-                if j + self._patch_size[1] > height:
-                    coord_height = height - self._patch_size[1]
-                # If there is anything in the mask patch, only then consider it
-                if mask is not None:
-                    if np.any(
-                        mask[
-                            coord_width : coord_width + self._patch_size[0],
-                            coord_height : coord_height + self._patch_size[1],
-                        ]
-                    ):
-                        self._points.append([coord_width, coord_height])
-                else:
-                    self._points.append([coord_width, coord_height])
-
-        self._points = np.array(self._points)
-        self._points[:, [0, 1]] = self._points[:, [1, 0]]
+        )
+        coords_x = np.arange(
+            0,
+            size_x - (self._patch_size[1] + self._stride_size[1]),
+            self._stride_size[1],
+        )
+        coords_y, coords_x = np.meshgrid(coords_y, coords_x, indexing="ij")
+        coords_y, coords_x = coords_y.ravel(), coords_x.ravel()
+
+        # If there is anything in the mask patch, only then consider it
+        if mask is not None:
+            scale_y = mask.shape[0] / size_y
+            scale_x = mask.shape[1] / size_x
+            # the extent of every patch in the mask, with at least one mask pixel per patch
+            start_y = np.floor(coords_y * scale_y).astype(np.int64)
+            start_x = np.floor(coords_x * scale_x).astype(np.int64)
+            end_y = np.ceil((coords_y + self._patch_size[0]) * scale_y).astype(np.int64)
+            end_x = np.ceil((coords_x + self._patch_size[1]) * scale_x).astype(np.int64)
+            start_y = np.clip(start_y, 0, mask.shape[0] - 1)
+            start_x = np.clip(start_x, 0, mask.shape[1] - 1)
+            end_y = np.clip(np.maximum(end_y, start_y + 1), 0, mask.shape[0])
+            end_x = np.clip(np.maximum(end_x, start_x + 1), 0, mask.shape[1])
+
+            # all patch boundaries are multiples of the block size, so the mask can be reduced to blocks first
+            block_y = _get_mask_block_size(
+                scale_y, self._stride_size[0], self._patch_size[0]
+            )
+            block_x = _get_mask_block_size(
+                scale_x, self._stride_size[1], self._patch_size[1]
+            )
+            if block_y > 1 or block_x > 1:
+                mask = np.pad(
+                    mask, ((0, -mask.shape[0] % block_y), (0, -mask.shape[1] % block_x))
+                )
+                mask = np.any(
+                    mask.reshape(
+                        mask.shape[0] // block_y,
+                        block_y,
+                        mask.shape[1] // block_x,
+                        block_x,
+                    ),
+                    axis=(1, 3),
+                ).astype(np.ubyte)
+                start_y, end_y = start_y // block_y, -(-end_y // block_y)
+                start_x, end_x = start_x // block_x, -(-end_x // block_x)
+
+            # integral image, so that the tissue in every patch is a constant-time lookup
+            integral_dtype = (
+                np.int32 if mask.size < np.iinfo(np.int32).max else np.int64
+            )
+            integral_mask = np.zeros(
+                (mask.shape[0] + 1, mask.shape[1] + 1), dtype=integral_dtype
+            )
+            np.cumsum(mask, axis=0, out=integral_mask[1:, 1:])
+            np.cumsum(integral_mask[1:, 1:], axis=1, out=integral_mask[1:, 1:])
+            tissue_in_patch = (
+                integral_mask[end_y, end_x]
+                - integral_mask[start_y, end_x]
+                - integral_mask[end_y, start_x]
+                + integral_mask[start_y, start_x]
+            )
+            coords_y = coords_y[tissue_in_patch > 0]
+            coords_x = coords_x[tissue_in_patch > 0]
+
+        self._points = np.stack([coords_x, coords_y], axis=1)
+
+    def __getstate__(self):
+        # the slide handle is re-opened by the process that uses it
+        state = self.__dict__.copy()
+        state["_os_image"], state["_os_image_pid"] = None, None
+        return state
+
+    def _get_os_image(self):
+        """
+        This function returns the slide handle of the current process, so that every data loader worker reads with its own file handle.
+
+        Returns:
+            tiffslide.TiffSlide: The slide handle.
+        """
+        if self._os_image_pid != os.getpid():
+            self._os_image = tiffslide.open_slide(os.path.join(self._wsi_path))
+            self._os_image_pid = os.getpid()
+        return self._os_image
 
     def get_patch_size(self):
         return self._patch_size
@@ -142,7 +212,7 @@ class InferTumorSegDataset(Dataset):
             (string, int, int): The patch, x and y locations.
         """
         x_loc, y_loc = self._points[idx]
-        patch = self._os_image.read_region(
+        patch = self._get_os_image().read_region(
             (x_loc, y_loc),
             self._selected_level,
             (self._patch_size[0], self._patch_size[1]),
@@ -37,11 +37,13 @@ class Patch:
         self.level = level
         self.size = size
         self.output_suffix = output_suffix
+        # set when the patch is written to a shard instead of its own file
+        self.shard_reference = None
 
     def read_patch(self):
         """
         Read patch from self.slide_object given this patch's coordinates, level, and size.
-        @return: PIL object of RGBA patch image.
+        @return: ndarray of the patch image.
         """
         return np.asarray(
             self.slide_object.read_region(
@@ -89,6 +91,17 @@ class Patch:
             + self.output_suffix.format(self.coordinates[0], self.coordinates[1]),
         )
 
+    def get_saved_path(self, out_dir):
+        """
+        Returns the path of the saved patch, which is a reference from patch_shards.get_shard_reference if the patch
+        was written to a shard.
+        @param out_dir: The output directory
+        @return: str
+        """
+        if self.shard_reference is not None:
+            return self.shard_reference
+        return self.get_patch_path(out_dir, False)
+
     def save(
         self,
         out_dir,
@@ -96,6 +109,8 @@ class Patch:
         check_if_valid=True,
         process_method=None,
         value_map=None,
+        shard_writer=None,
+        image=None,
     ):
         """
         Save patch.
@@ -107,11 +122,14 @@ class Patch:
         @param value_map: Map key values in patch to alternate value. dict(key => value) where key, value are ints.
             alters the patch by substituting key for value in the image, leaves values not in dictionary unaltered.
             Helpful for standardization.
+        @param shard_writer: A patch_shards.PatchShardWriter to write the patch to. If left as None, the patch is saved
+            to its own PNG file.
+        @param image: The image of the patch, if it has already been read (such as for the batch checks).
         @return: A list [bool, Patch, summary]. bool is if the patch was accepted, Patch is the patch object, and
             summary is the output of process_method.
         """
 
-        patch = self.read_patch()
+        patch = self.read_patch() if image is None else image
 
         if process_method is None:
             process_method = pass_method
@@ -124,13 +142,16 @@ class Patch:
 
         try:
             if save:
+                # the patch that was checked is saved, without reading it again
                 if isinstance(value_map, dict):
-                    patch = self.read_patch()[:, :, 0]
-                    patch = map_values(patch, value_map)
-                    imsave(fname=self.get_patch_path(out_dir), arr=patch)
-                elif value_map is None:
-                    patch = self.read_patch()
-                    imsave(fname=self.get_patch_path(out_dir), arr=patch)
+                    patch = map_values(patch[:, :, 0], value_map)
+                if isinstance(value_map, dict) or value_map is None:
+                    if shard_writer is not None:
+                        self.shard_reference = shard_writer.write(
+                            Path(self.get_patch_path(out_dir)).stem + ".npy", patch
+                        )
+                    else:
+                        imsave(fname=self.get_patch_path(out_dir), arr=patch)
 
             return [True, self, process_method(patch)]
 
@@ -2,6 +2,8 @@ import concurrent.futures
 import os
 from functools import partial
 from .patch import Patch
+from .patch_shards import PatchShardWriter
+from .tile_cache import CachedSlideReader, TileCache
 from .utils import get_patch_class_proportions, convert_to_tiff
 import numpy as np
 from tqdm import tqdm
@@ -17,13 +19,20 @@ class PatchManager:
         @param filename: name of main WSI.
         """
         self.output_dir = output_dir
+        # the tiles are shared by the slide and the label map
+        self.tile_cache = TileCache()
         self.set_slide_path(filename)
         self.patches = list()
         self.slide_folder = Path(filename).stem
         self.valid_mask = None
         self.mined_mask = None
         self.valid_mask_scale = (0, 0)
+        self.valid_indices = None
+        self.valid_indices_position = 0
         self.valid_patch_checks = []
+        self.valid_patch_batch_checks = []
+        # number of patches that are read and checked together by the batch checks
+        self.patch_batch_size = 256
         self.label_map = None
         self.label_map_object = None
         self.label_map_folder = None
@@ -41,7 +50,9 @@ class PatchManager:
     def set_slide_path(self, filename):
         self.img_path = filename
         self.img_path = convert_to_tiff(self.img_path, self.output_dir, "img")
-        self.slide_object = tiffslide.open_slide(self.img_path)
+        self.slide_object = CachedSlideReader(
+            tiffslide.open_slide(self.img_path), self.img_path, self.tile_cache
+        )
         self.slide_dims = self.slide_object.dimensions
 
     def set_label_map(self, path):
@@ -50,7 +61,9 @@ class PatchManager:
         @param path: path to label map.
         """
         self.label_map = convert_to_tiff(path, self.output_dir, "mask")
-        self.label_map_object = tiffslide.open_slide(self.label_map)
+        self.label_map_object = CachedSlideReader(
+            tiffslide.open_slide(self.label_map), self.label_map, self.tile_cache
+        )
 
         assert all(
             x == y for x, y in zip(self.label_map_object.dimensions, self.slide_dims)
@@ -61,6 +74,44 @@ class PatchManager:
         self.valid_mask = mask
         self.mined_mask = np.zeros_like(mask)
         self.valid_mask_scale = scale
+        # the candidate coordinates are collected on the first patch selection
+        self.valid_indices = None
+        self.valid_indices_position = 0
+
+    def next_valid_index(self, read_type):
+        """
+        Find the next coordinate on the valid mask that has not been excluded yet.
+
+        The flat indices of the valid mask are collected once, in row-major order for sequential reads or in a random
+        order otherwise. Every call advances through this list and skips the indices that have been excluded from
+        self.valid_mask since, so the selection is amortized O(1) instead of scanning the whole mask for every patch.
+        Since the order of the remaining indices is uniformly random, the random selection is still uniform over the
+        coordinates that are left.
+        @param read_type: either "random" or "sequential".
+        @return: the (row, column) index on the valid mask, or None if the mask is exhausted.
+        """
+        assert read_type in ["random", "sequential"], (
+            "Unrecognized read type %s" % read_type
+        )
+        if self.valid_indices is None:
+            self.valid_indices = np.flatnonzero(self.valid_mask)
+            if read_type == "random":
+                np.random.shuffle(self.valid_indices)
+            self.valid_indices_position = 0
+
+        while self.valid_indices_position < len(self.valid_indices):
+            index = np.unravel_index(
+                self.valid_indices[self.valid_indices_position], self.valid_mask.shape
+            )
+            self.valid_indices_position += 1
+            if self.valid_mask[index]:
+                print(
+                    "%i indices left "
+                    % (len(self.valid_indices) - self.valid_indices_position),
+                    end="\r",
+                )
+                return index
+        return None
 
     def add_patch(self, patch, overlap_factor, patch_size):
         """
@@ -183,27 +234,17 @@ class PatchManager:
         else:
             # Find indices on filled mask, then multiply by real scale to get actual coordinates
             try:
-                indices = np.argwhere(self.valid_mask)
+                index = self.next_valid_index(read_type)
+                if index is None:
+                    print("\nNo valid coordinates left on the mask.")
+                    return False
                 # (X/Y get reversed because OpenSlide and np use reversed height/width indexing)
-                x_values = np.round(indices[:, 0] * self.valid_mask_scale[0]).astype(
-                    int
-                )
-                y_values = np.round(indices[:, 1] * self.valid_mask_scale[1]).astype(
-                    int
+                coordinates = np.array(
+                    [
+                        int(np.round(index[0] * self.valid_mask_scale[0])),
+                        int(np.round(index[1] * self.valid_mask_scale[1])),
+                    ]
                 )
-                num_indices = len(indices.ravel()) // 2
-                print("%i indices left " % num_indices, end="\r")
-                # Find index of coordinates to select for patch
-
-                assert read_type in ["random", "sequential"], (
-                    "Unrecognized read type %s" % read_type
-                )
-                if read_type == "random":
-                    choice = np.random.choice(num_indices, 1)
-                elif read_type == "sequential":
-                    choice = 0
-
-                coordinates = np.array([x_values[choice], y_values[choice]]).ravel()
 
                 patch = Patch(
                     slide_path=self.img_path,
@@ -236,6 +277,48 @@ class PatchManager:
         """
         self.valid_patch_checks.append(patch_validity_check)
 
+    def add_patch_batch_criteria(self, patch_batch_validity_check):
+        """
+        Add check for if the patches can be saved, which is run on many patches at once.
+        @param patch_batch_validity_check: A function that takes a stack of images of the same shape as an argument
+            and returns an array that is True for the patches that pass the check, False for the ones to reject.
+        """
+        self.valid_patch_batch_checks.append(patch_batch_validity_check)
+
+    def check_patch_batch(self, images):
+        """
+        Run the batch checks on the images of the patches, stacking the images of the same shape.
+        @param images: A list of the images of the patches.
+        @return: A boolean array that is True for the patches that pass all batch checks.
+        """
+        validity = np.ones(len(images), dtype=bool)
+        shapes = [image.shape for image in images]
+        for shape in set(shapes):
+            indices = [
+                i for i, image_shape in enumerate(shapes) if image_shape == shape
+            ]
+            stack = np.stack([images[i] for i in indices])
+            for check_function in self.valid_patch_batch_checks:
+                validity[indices] &= np.asarray(check_function(stack), dtype=bool)
+        return validity
+
+    def _save_patch_batches(self, executor, save_function):
+        """
+        Read the patches in batches, run the batch checks on each batch, and save the patches that pass them.
+        @param executor: The executor that reads and saves the patches.
+        @param save_function: The function that saves a patch, given the patch, its image and whether it is valid.
+        @return: The results of save_function for all patches in self.patches, in order.
+        """
+        results = []
+        with tqdm(total=len(self.patches), unit="pchs") as progress_bar:
+            for start in range(0, len(self.patches), self.patch_batch_size):
+                patches = self.patches[start : start + self.patch_batch_size]
+                images = list(executor.map(Patch.read_patch, patches))
+                validity = self.check_patch_batch(images)
+                results.extend(executor.map(save_function, patches, images, validity))
+                progress_bar.update(len(patches))
+        return results
+
     def set_image_header(self, image_header):
         self.image_header = image_header
 
@@ -261,7 +344,8 @@ class PatchManager:
                 - Adds each patch to self.patches
             2) Read and save all patches stored in self.patches
                 - If patch CANNOT be saved, return [False, Patch, ""]
-                    > this is due to either being rejected by methods added by add_patch_criteria or an error.
+                    > this is due to either being rejected by methods added by add_patch_criteria or
+                      add_patch_batch_criteria, or an error.
                 - If patch WAS saved, return [False, Patch, patch_processor(patch)]
             IF label_map is provided:
                 3) Pull successfully saved slide patches from corresponding label map locations.
@@ -276,6 +360,8 @@ class PatchManager:
         @param n_jobs: Number of threads to launch.
         @param save: 'Dummy' run of patch extraction if False.
         @param value_map: Dictionary for value swapping.
+        @param patch_format: "png" for a file per patch, or "tar" to write the patches to uncompressed tar shards.
+        @param patches_per_shard: Number of patches per shard for the "tar" format.
         """
 
         # initialize defaults
@@ -283,6 +369,11 @@ class PatchManager:
         n_jobs = config["num_workers"]
         save = config["save_patches"]
         value_map = config["value_map"]
+        patch_format = config.get("patch_format", "png")
+        assert patch_format in ["png", "tar"], (
+            "Unrecognized patch format %s" % patch_format
+        )
+        slide_shard_writer, lm_shard_writer = None, None
 
         csv_filename = os.path.join(self.output_dir, "list.csv")
 
@@ -334,23 +425,33 @@ class PatchManager:
             # Save patches
             output_dir_slide_folder = os.path.join(self.output_dir, self.slide_folder)
             Path(output_dir_slide_folder).mkdir(parents=True, exist_ok=True)
+            if patch_format == "tar" and slide_shard_writer is None:
+                slide_shard_writer = PatchShardWriter(
+                    output_dir_slide_folder, config.get("patches_per_shard", 1000)
+                )
             _save_patch_partial = partial(
                 _save_patch,
                 output_directory=self.output_dir,
                 save=save,
                 check_if_valid=True,
+                shard_writer=slide_shard_writer,
             )
 
             print("Saving patches:")
 
             with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
-                np_slide_futures = list(
-                    tqdm(
-                        executor.map(_save_patch_partial, self.patches),
-                        total=len(self.patches),
-                        unit="pchs",
+                if self.valid_patch_batch_checks:
+                    np_slide_futures = self._save_patch_batches(
+                        executor, _save_patch_partial
+                    )
+                else:
+                    np_slide_futures = list(
+                        tqdm(
+                            executor.map(_save_patch_partial, self.patches),
+                            total=len(self.patches),
+                            unit="pchs",
+                        )
                     )
-                )
 
                 self.patches = list()
                 np_slide_futures = np.array(np_slide_futures)
@@ -372,6 +473,10 @@ class PatchManager:
                     self.output_dir, self.label_map_folder
                 )
                 Path(output_dir_mask_folder).mkdir(parents=True, exist_ok=True)
+                if patch_format == "tar" and lm_shard_writer is None:
+                    lm_shard_writer = PatchShardWriter(
+                        output_dir_mask_folder, config.get("patches_per_shard", 1000)
+                    )
 
                 _lm_save_patch_partial = partial(
                     _save_patch,
@@ -380,6 +485,7 @@ class PatchManager:
                     check_if_valid=False,
                     patch_processor=get_patch_class_proportions,
                     value_map=value_map,
+                    shard_writer=lm_shard_writer,
                 )
                 with concurrent.futures.ThreadPoolExecutor(
                     config["num_workers"]
@@ -406,11 +512,11 @@ class PatchManager:
                 if self.save_subjectID:
                     new_row.update({"SubjectID": self.subjectID})
                 if self.label_map is not None:
-                    slide_patch_path = np_slide_futures[index, 1].get_patch_path(
-                        self.output_dir, False
+                    slide_patch_path = np_slide_futures[index, 1].get_saved_path(
+                        self.output_dir
                     )
-                    lm_patch_path = np_lm_futures[index, 1].get_patch_path(
-                        self.output_dir, False
+                    lm_patch_path = np_lm_futures[index, 1].get_saved_path(
+                        self.output_dir
                     )
                     lm_result = np_lm_futures[index, 2]
                     new_row.update(
@@ -421,8 +527,8 @@ class PatchManager:
                         }
                     )
 
-                slide_patch_path = np_slide_futures[index, 1].get_patch_path(
-                    self.output_dir, False
+                slide_patch_path = np_slide_futures[index, 1].get_saved_path(
+                    self.output_dir
                 )
                 new_row.update({"SlidePatchPath": slide_patch_path})
 
@@ -436,6 +542,10 @@ class PatchManager:
             # Concatenate in case there is a pre-existing dataframe
             output_df = pd.concat([output_df, new_df])
 
+        # the shards are complete before they are listed in the CSV
+        for shard_writer in [slide_shard_writer, lm_shard_writer]:
+            if shard_writer is not None:
+                shard_writer.close()
         output_df.to_csv(csv_filename, index=False)
 
         print("Done!")
@@ -534,16 +644,24 @@ class PatchManager:
 
 def _save_patch(
     patch,
-    output_directory,
-    save,
+    image=None,
+    batch_valid=True,
+    output_directory=None,
+    save=True,
     check_if_valid=True,
     patch_processor=None,
     value_map=None,
+    shard_writer=None,
 ):
+    if not batch_valid:
+        print("Patch failed batch check")
+        return [False, patch, ""]
     return patch.save(
         out_dir=output_directory,
         save=save,
         check_if_valid=check_if_valid,
         process_method=patch_processor,
         value_map=value_map,
+        shard_writer=shard_writer,
+        image=image,
     )
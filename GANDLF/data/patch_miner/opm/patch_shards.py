@@ -0,0 +1,166 @@
+import io
+import os
+import tarfile
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from torchio.data.io import sitk_to_nib
+
+# separates the shard file from the patch inside it, e.g. "patches-000000.tar::slide_patch_0-0.npy"
+SHARD_MEMBER_SEPARATOR = "::"
+
+
+def get_shard_reference(shard_path, member):
+    """
+    Returns the reference to a patch inside a shard, which is written to the patch CSV instead of a file path.
+    @param shard_path: The path to the shard.
+    @param member: The name of the patch inside the shard.
+    @return: str
+    """
+    return str(shard_path) + SHARD_MEMBER_SEPARATOR + member
+
+
+def split_shard_reference(path):
+    """
+    Split a patch path into the shard and the name of the patch inside it.
+    @param path: A file path or a reference from get_shard_reference.
+    @return: (path, None) for a regular file path, or (shard_path, member) for a patch inside a shard.
+    """
+    path = str(path)
+    if SHARD_MEMBER_SEPARATOR not in path:
+        return path, None
+    shard_path, member = path.rsplit(SHARD_MEMBER_SEPARATOR, 1)
+    return shard_path, member
+
+
+@lru_cache(maxsize=256)
+def _get_shard_index(shard_path, modification_time, file_size):
+    """
+    Helper function to list the patches of a shard, cached on the path, modification time and size of the shard.
+    The shards are uncompressed, so this only reads the tar headers and seeks over the patch data.
+    @return: dict(member => (offset, size)) of the patch data in the shard.
+    """
+    with tarfile.open(shard_path, "r:") as tar:
+        return {info.name: (info.offset_data, info.size) for info in tar}
+
+
+def read_patch_from_shard(shard_path, member):
+    """
+    Read a single patch from a shard, without reading the other patches.
+    @param shard_path: The path to the shard.
+    @param member: The name of the patch inside the shard.
+    @return: ndarray of the patch.
+    """
+    file_stat = os.stat(shard_path)
+    offset, size = _get_shard_index(
+        os.path.abspath(shard_path), file_stat.st_mtime_ns, file_stat.st_size
+    )[member]
+    with open(shard_path, "rb") as shard_file:
+        shard_file.seek(offset)
+        return np.load(io.BytesIO(shard_file.read(size)), allow_pickle=False)
+
+
+def get_patch_image(patch):
+    """
+    Convert a patch to an image with the same information as a 2D PNG of the patch read by SimpleITK.
+    @param patch: ndarray of the patch, with the channels last.
+    @return: sitk.Image
+    """
+    return sitk.GetImageFromArray(patch, isVector=patch.ndim == 3)
+
+
+def read_patch_shard_image(shard_path, member):
+    """
+    Reader for torchio images of a patch inside a shard, which gives the same result as reading the patch from a PNG.
+    @param shard_path: The path to the shard, passed by torchio.
+    @param member: The name of the patch inside the shard.
+    @return: The tensor and affine of the patch.
+    """
+    patch = read_patch_from_shard(shard_path, member)
+    data, affine = sitk_to_nib(get_patch_image(patch))
+    return torch.as_tensor(data), affine
+
+
+def get_patch_shard_header(shard_path, member):
+    """
+    Returns the image information of a patch inside a shard, only reading the header of its array.
+    @param shard_path: The path to the shard.
+    @param member: The name of the patch inside the shard.
+    @return: sitk.Image with the size, spacing, origin and direction of the patch.
+    """
+    file_stat = os.stat(shard_path)
+    offset, _ = _get_shard_index(
+        os.path.abspath(shard_path), file_stat.st_mtime_ns, file_stat.st_size
+    )[member]
+    with open(shard_path, "rb") as shard_file:
+        shard_file.seek(offset)
+        if np.lib.format.read_magic(shard_file) == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(shard_file)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(shard_file)
+    return get_patch_image(np.zeros(shape, dtype=np.uint8))
+
+
+class PatchShardWriter:
+    def __init__(self, output_dir, patches_per_shard=1000, prefix="patches"):
+        """
+        Thread-safe writer of patches to uncompressed tar shards, so that mining does not create a file per patch.
+        Each patch is stored as a .npy array, which avoids the cost of PNG compression.
+        @param output_dir: The folder for the shards.
+        @param patches_per_shard: The number of patches after which a new shard is started.
+        @param prefix: The prefix of the shard filenames.
+        """
+        self.output_dir = output_dir
+        self.patches_per_shard = patches_per_shard
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._tar = None
+        self._shard_path = None
+        self._shard_count = 0
+        self._patches_in_shard = 0
+
+    def _next_shard(self):
+        self._close_shard()
+        self._shard_path = os.path.join(
+            self.output_dir, "{}-{:06d}.tar".format(self.prefix, self._shard_count)
+        )
+        self._tar = tarfile.open(self._shard_path, "w")
+        self._shard_count += 1
+        self._patches_in_shard = 0
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def write(self, member, patch):
+        """
+        Write a patch to the current shard.
+        @param member: The name of the patch inside the shard.
+        @param patch: ndarray of the patch.
+        @return: The reference to the patch, from get_shard_reference.
+        """
+        # the serialization happens outside the lock, so that the patches are prepared concurrently
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(patch), allow_pickle=False)
+        info = tarfile.TarInfo(member)
+        info.size = buffer.tell()
+        info.mtime = time.time()
+        buffer.seek(0)
+        with self._lock:
+            if self._tar is None or self._patches_in_shard >= self.patches_per_shard:
+                self._next_shard()
+            self._tar.addfile(info, buffer)
+            self._patches_in_shard += 1
+            return get_shard_reference(self._shard_path, member)
+
+    def close(self):
+        """
+        Finish the current shard; the shards can only be read after this.
+        """
+        with self._lock:
+            self._close_shard()
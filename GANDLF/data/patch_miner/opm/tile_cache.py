@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class TileCache:
+    def __init__(self, max_tiles=64):
+        """
+        Thread-safe LRU cache of slide tiles, which can be shared by multiple slide readers.
+        @param max_tiles: The maximum number of tiles kept in memory.
+        """
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, read_tile):
+        """
+        Return the cached tile for key, reading it with read_tile() if it is not cached.
+        @param key: A hashable key of the tile.
+        @param read_tile: A function without arguments that returns the tile.
+        @return: The tile.
+        """
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key]
+            self.misses += 1
+        # the read happens outside the lock, so that the tiles are read concurrently
+        tile = read_tile()
+        with self._lock:
+            self._tiles[key] = tile
+            self._tiles.move_to_end(key)
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return tile
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+
+
+class CachedSlideReader:
+    def __init__(self, slide_object, slide_path, cache, tile_size=None):
+        """
+        Wrapper of a tiffslide object that reads level 0 regions from cached tiles, so that patches sharing the same
+        TIFF tiles (e.g., adjacent or overlapping patches, or a patch that is checked and then saved) are only read once.
+        All other attributes are forwarded to the slide object.
+        @param slide_object: The tiffslide object.
+        @param slide_path: Path to the slide, used to distinguish the tiles of different slides in a shared cache.
+        @param cache: The TileCache.
+        @param tile_size: The size of the cached tiles; defaults to the tile size of the TIFF, or 512.
+        """
+        self.slide_object = slide_object
+        self.slide_path = slide_path
+        self.cache = cache
+        if tile_size is None:
+            tile_size = int(
+                slide_object.properties.get("tiffslide.level[0].tile-width") or 512
+            )
+        # very small TIFF tiles would make the stitching overhead larger than the reads
+        self.tile_size = max(tile_size, 256)
+
+    def __getattr__(self, name):
+        return getattr(self.slide_object, name)
+
+    def _read_tile(self, tile_x, tile_y):
+        return np.asarray(
+            self.slide_object.read_region(
+                (tile_x * self.tile_size, tile_y * self.tile_size),
+                0,
+                (self.tile_size, self.tile_size),
+            )
+        )
+
+    def read_region(self, location, level, size):
+        """
+        Read a region of the slide; this has the same arguments as tiffslide's read_region.
+        @param location: (x, y) tuple of the top-left corner at level 0.
+        @param level: The level of the slide.
+        @param size: (width, height) tuple of the region.
+        @return: ndarray of the region.
+        """
+        x, y = int(location[0]), int(location[1])
+        width, height = int(size[0]), int(size[1])
+        # only level 0 is cached, since the tiles of other levels are not aligned with integer coordinates
+        if level != 0 or x < 0 or y < 0:
+            return np.asarray(
+                self.slide_object.read_region((x, y), level, (width, height))
+            )
+
+        region = None
+        for tile_y in range(
+            y // self.tile_size, (y + height - 1) // self.tile_size + 1
+        ):
+            for tile_x in range(
+                x // self.tile_size, (x + width - 1) // self.tile_size + 1
+            ):
+                tile = self.cache.get(
+                    (self.slide_path, tile_x, tile_y),
+                    lambda: self._read_tile(tile_x, tile_y),
+                )
+                if region is None:
+                    region = np.empty((height, width) + tile.shape[2:], tile.dtype)
+                # the overlap of the tile and the region, in the coordinates of the region
+                start_x = max(tile_x * self.tile_size, x) - x
+                start_y = max(tile_y * self.tile_size, y) - y
+                end_x = min((tile_x + 1) * self.tile_size, x + width) - x
+                end_y = min((tile_y + 1) * self.tile_size, y + height) - y
+                # the offset of the region in the tile
+                offset_x = x - tile_x * self.tile_size
+                offset_y = y - tile_y * self.tile_size
+                region[start_y:end_y, start_x:end_x] = tile[
+                    start_y + offset_y : end_y + offset_y,
+                    start_x + offset_x : end_x + offset_x,
+                ]
+        return region
@@ -1,14 +1,13 @@
-import sys, os
+import sys, os, functools
 from pathlib import Path
 import numpy as np
 import skimage.io
 
 # from skimage.filters.rank import maximum
-from skimage.filters import gaussian
 
 # from skimage.morphology.footprints import disk
 from skimage.morphology import remove_small_holes
-from skimage.color.colorconv import rgb2hsv
+from skimage.util import img_as_float32
 import cv2
 
 # from skimage.exposure import rescale_intensity
@@ -123,16 +122,38 @@ def map_values(image, dictionary):
 
 
 def hue_range_mask(image, min_hue, max_hue, sat_min=0.05):
-    hsv_image = rgb2hsv(image)
-    h_channel = gaussian(hsv_image[:, :, HSV_HUE_CHANNEL])
+    """
+    Mask of the pixels in a hue range with a minimum saturation, after smoothing the hue and saturation with a Gaussian.
+    This is computed in float32 with OpenCV, and matches skimage's rgb2hsv and gaussian(sigma=1, mode="nearest").
+    """
+    image = img_as_float32(np.asarray(image))
+    if image.ndim != 3 or image.shape[-1] != 3:
+        raise ValueError(
+            "the input array must have a shape == (..., 3)), got " + str(image.shape)
+        )
+    hsv_image = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+    # opencv returns the hue in degrees for floating point images
+    h_channel = _smooth_mask_channel(hsv_image[:, :, HSV_HUE_CHANNEL] / 360)
     above_min = h_channel > min_hue
     below_max = h_channel < max_hue
 
-    s_channel = gaussian(hsv_image[:, :, HSV_SAT_CHANNEL])
+    s_channel = _smooth_mask_channel(hsv_image[:, :, HSV_SAT_CHANNEL])
     above_sat = s_channel > sat_min
     return np.logical_and(np.logical_and(above_min, below_max), above_sat)
 
 
+def _smooth_mask_channel(channel, sigma=1.0, truncate=4.0):
+    # same kernel radius and border handling as skimage.filters.gaussian
+    kernel_size = 2 * int(truncate * sigma + 0.5) + 1
+    return cv2.GaussianBlur(
+        channel,
+        (kernel_size, kernel_size),
+        sigmaX=sigma,
+        sigmaY=sigma,
+        borderType=cv2.BORDER_REPLICATE,
+    )
+
+
 def tissue_mask(image):
     """
     Quick and dirty hue range mask for OPM. Works well on H&E.
@@ -280,34 +301,74 @@ def patch_artifact_check(
     Returns:
         bool: Whether the patch is valid (True) or not (False)
     """
-    # patch_size = config["patch_size"]
-    patch_hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
-    count_white_pixels = np.sum(np.logical_and.reduce(img > intensity_thresh, axis=2))
-    percent_pixels = count_white_pixels / (patch_size[0] * patch_size[1])
-    count_black_pixels = np.sum(np.logical_and.reduce(img < intensity_thresh_b, axis=2))
-    percent_pixel_b = count_black_pixels / (patch_size[0] * patch_size[1])
-    percent_pixel_2 = np.sum(patch_hsv[..., 1] < intensity_thresh_saturation) / (
-        patch_size[0] * patch_size[1]
+    return bool(
+        patch_artifact_check_batch(
+            np.asarray(img)[np.newaxis],
+            intensity_thresh,
+            intensity_thresh_saturation,
+            intensity_thresh_b,
+            patch_size,
+        )[0]
     )
-    percent_pixel_3 = np.sum(patch_hsv[..., 2] > intensity_thresh) / (
-        patch_size[0] * patch_size[1]
+
+
+def patch_artifact_check_batch(
+    imgs,
+    intensity_thresh=250,
+    intensity_thresh_saturation=5,
+    intensity_thresh_b=128,
+    patch_size=(256, 256),
+):
+    """
+    This function is the batched version of patch_artifact_check, which checks many patches of the same shape at once in integer arithmetic.
+    Args:
+        imgs (np.ndarray): Input uint8 patches of shape (N, H, W, C).
+        intensity_thresh (int, optional): Threshold to check whiteness in the patch. Defaults to 250.
+        intensity_thresh_saturation (int, optional): Threshold to check saturation in the patch. Defaults to 5.
+        intensity_thresh_b (int, optional) : Threshold to check blackness in the patch. Defaults to 128.
+        patch_size (int, optional): Tiling Size of the WSI/patch size. Defaults to 256. patch_size=config["patch_size"]
+    Returns:
+        np.ndarray: Whether each patch is valid (True) or not (False)
+    """
+    imgs = np.asarray(imgs)
+    num_patches, height, width = imgs.shape[:3]
+    num_pixels = patch_size[0] * patch_size[1]
+    # opencv converts every pixel independently, so the patches are stacked along the rows
+    patch_hsv = cv2.cvtColor(
+        imgs.reshape((num_patches * height, width) + imgs.shape[3:]),
+        cv2.COLOR_RGB2HSV,
+    ).reshape((num_patches, height, width, 3))
+
+    # a pixel is white (or black) if all of its channels are above (or below) the threshold
+    channels = [imgs[..., channel] for channel in range(imgs.shape[3])]
+    count_white_pixels = np.count_nonzero(
+        functools.reduce(np.minimum, channels) > intensity_thresh, axis=(1, 2)
+    )
+    percent_pixels = count_white_pixels / num_pixels
+    count_black_pixels = np.count_nonzero(
+        functools.reduce(np.maximum, channels) < intensity_thresh_b, axis=(1, 2)
+    )
+    percent_pixel_b = count_black_pixels / num_pixels
+    saturation, value = patch_hsv[..., 1], patch_hsv[..., 2]
+    percent_pixel_2 = (
+        np.count_nonzero(saturation < intensity_thresh_saturation, axis=(1, 2))
+        / num_pixels
+    )
+    percent_pixel_3 = (
+        np.count_nonzero(value > intensity_thresh, axis=(1, 2)) / num_pixels
     )
+    mean_saturation = saturation.sum(axis=(1, 2), dtype=np.uint64) / (height * width)
 
-    if (
-        percent_pixel_2 > 0.99
-        or np.mean(patch_hsv[..., 1]) < 5
-        or percent_pixel_3 > 0.99
-    ):
-        if percent_pixel_2 < 0.1:
-            return False
-    elif (
-        (percent_pixel_2 > 0.99 and percent_pixel_3 > 0.99)
-        or percent_pixel_b > 0.99
-        or percent_pixels > 0.9
-    ):
-        return False
-    # assume that the patch is valid
-    return True
+    # mostly unsaturated or bright patches are rejected only if they have little unsaturated area
+    mostly_background = (
+        (percent_pixel_2 > 0.99) | (mean_saturation < 5) | (percent_pixel_3 > 0.99)
+    )
+    is_artifact = (
+        (percent_pixel_2 > 0.99) & (percent_pixel_3 > 0.99)
+        | (percent_pixel_b > 0.99)
+        | (percent_pixels > 0.9)
+    )
+    return np.where(mostly_background, percent_pixel_2 >= 0.1, ~is_artifact)
 
 
 def parse_config(config_file):
@@ -327,6 +388,8 @@ def parse_config(config_file):
     config["read_type"] = config.get("read_type", "random")
     config["overlap_factor"] = config.get("overlap_factor", 0.0)
     config["patch_size"] = config.get("patch_size", [256, 256])
+    config["patch_format"] = config.get("patch_format", "png")
+    config["patches_per_shard"] = config.get("patches_per_shard", 1000)
 
     return config
 
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+import torchio
+
+from GANDLF.version import __version__
+
+
+def get_subject_cache_key(files_for_subject, cache_parameters):
+    """
+    This function computes the key under which a subject is cached. The key changes if any of the input files is modified or if any of the parameters that affect the cached data changes.
+
+    Args:
+        files_for_subject (dict): The image key to file path mapping for all images of the subject.
+        cache_parameters (dict): The parameters that affect the cached data.
+
+    Returns:
+        str: The cache key.
+    """
+    key_dict = {"version": __version__, "parameters": cache_parameters, "files": []}
+    for key, file in files_for_subject.items():
+        file_stat = os.stat(file)
+        key_dict["files"].append(
+            [key, os.path.abspath(file), file_stat.st_mtime_ns, file_stat.st_size]
+        )
+
+    return hashlib.sha256(
+        json.dumps(key_dict, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def load_subject_from_cache(cache_dir, cache_key):
+    """
+    This function loads the images of a cached subject as memory-mapped tensors.
+
+    Args:
+        cache_dir (str): The cache directory.
+        cache_key (str): The key of the subject, from get_subject_cache_key.
+
+    Returns:
+        dict: The images (torchio.ScalarImage or torchio.LabelMap) and the "spacing" of the subject, or None if the subject is not cached.
+    """
+    subject_cache_dir = os.path.join(cache_dir, cache_key)
+    metadata_file = os.path.join(subject_cache_dir, "metadata.json")
+    if not os.path.isfile(metadata_file):
+        return None
+
+    with open(metadata_file, "r") as file:
+        metadata = json.load(file)
+
+    cached_subject = {"spacing": torch.Tensor(metadata["spacing"])}
+    for key, image_info in metadata["images"].items():
+        image_class = (
+            torchio.LabelMap
+            if image_info["type"] == torchio.LABEL
+            else torchio.ScalarImage
+        )
+        # copy-on-write memory map, so that the data is only read from disk when accessed
+        cached_subject[key] = image_class(
+            path=image_info["path"] if image_info["path"] != "" else None,
+            tensor=np.load(
+                os.path.join(subject_cache_dir, key + ".npy"), mmap_mode="c"
+            ),
+            affine=np.array(image_info["affine"]),
+        )
+
+    return cached_subject
+
+
+def save_subject_to_cache(subject, cache_dir, cache_key, transform=None):
+    """
+    This function applies the (deterministic) transform to the subject and writes all of its images to the cache.
+
+    Args:
+        subject (torchio.Subject): The subject to cache.
+        cache_dir (str): The cache directory.
+        cache_key (str): The key of the subject, from get_subject_cache_key.
+        transform (torchio.transforms.Transform, optional): The deterministic transform to apply before caching. Defaults to None.
+
+    Returns:
+        dict: The cached images and "spacing" of the subject, as returned by load_subject_from_cache.
+    """
+    if transform is not None:
+        subject = transform(subject)
+
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    # write to a temporary directory first so that concurrent runs never see a partially written subject
+    temp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_")
+    metadata = {"spacing": subject["spacing"].tolist(), "images": {}}
+    for key, image in subject.get_images_dict(intensity_only=False).items():
+        np.save(os.path.join(temp_dir, key + ".npy"), image.data.numpy())
+        metadata["images"][key] = {
+            "type": image.type,
+            "path": image["path"],
+            "affine": image.affine.tolist(),
+        }
+    with open(os.path.join(temp_dir, "metadata.json"), "w") as file:
+        json.dump(metadata, file)
+
+    try:
+        os.rename(temp_dir, os.path.join(cache_dir, cache_key))
+    except OSError:
+        # another process has already cached this subject
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return load_subject_from_cache(cache_dir, cache_key)
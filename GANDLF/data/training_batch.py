@@ -0,0 +1,86 @@
+import torch
+import torchio
+from torch.utils.data import default_collate
+
+
+class TrainingBatchCollator:
+    """
+    Collates the training samples into a batch, and adds the "image_batch" (all channels concatenated) and "label_batch" entries that are used for the forward pass. For loaders with worker processes, this moves the concatenation off the training loop; the channel and value keys are read from the parameters at collation time, since they are only populated once the validation loader is created, and are taken from the batch itself if the loader is used before that.
+
+    Args:
+        params (dict): The parameters passed by the user yaml.
+    """
+
+    def __init__(self, params):
+        self.params = params
+
+    def _get_keys(self, batch):
+        if "channel_keys" in self.params:
+            return self.params["channel_keys"], self.params.get("value_keys")
+        # same as populate_channel_keys_in_params
+        channel_keys = [key for key in batch.keys() if key.isnumeric()]
+        value_keys = [
+            key for key in batch.keys() if not key.isnumeric() and "value" in key
+        ]
+        return channel_keys, value_keys or None
+
+    def __call__(self, samples):
+        batch = default_collate(samples)
+        channel_keys, value_keys = self._get_keys(batch)
+        batch["image_batch"] = torch.cat(
+            [batch[key][torchio.DATA] for key in channel_keys], dim=1
+        ).float()
+        if value_keys:
+            label = torch.cat([batch[key] for key in value_keys], dim=0)
+            # min is needed because for certain cases, batch size becomes smaller than the total remaining labels
+            batch["label_batch"] = label.reshape(
+                min(self.params["batch_size"], len(label)), len(value_keys)
+            )
+        else:
+            batch["label_batch"] = batch["label"][torchio.DATA]
+        return batch
+
+
+class BatchPrefetcher:
+    """
+    Wraps the training loader and copies the "image_batch" and "label_batch" entries of the next batch to the device on a separate CUDA stream while the current batch is being used, so that the host-to-device transfer overlaps with the computation. For CUDA devices, the training loader uses pinned memory by default, so that these non-blocking copies are asynchronous ("pin_memory_dataloader" can be set to False to opt out, in which case the copies are synchronous). On the cpu, the batches are returned as-is.
+
+    Args:
+        data_loader (torch.utils.data.DataLoader): The training loader, which uses TrainingBatchCollator.
+        device (Union[str, torch.device]): The device to copy the batches to.
+    """
+
+    keys = ("image_batch", "label_batch")
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _copy_to_device(self, batch, stream):
+        if batch is not None:
+            with torch.cuda.stream(stream):
+                for key in self.keys:
+                    batch[key] = batch[key].to(self.device, non_blocking=True)
+        return batch
+
+    def __iter__(self):
+        if self.device.type != "cuda" or not torch.cuda.is_available():
+            yield from self.data_loader
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        iterator = iter(self.data_loader)
+        next_batch = self._copy_to_device(next(iterator, None), stream)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            # the tensors were allocated on the copy stream, so the allocator needs to know that they are used
+            # on the current stream before their memory can be reused
+            for key in self.keys:
+                batch[key].record_stream(current_stream)
+            next_batch = self._copy_to_device(next(iterator, None), stream)
+            yield batch
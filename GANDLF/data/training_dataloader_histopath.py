@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+import tiffslide
+import torch
+import torchio
+from torch.utils.data.dataset import Dataset
+from torchio.data.io import sitk_to_nib
+from tqdm import tqdm
+
+from GANDLF.utils import resize_image
+from .preprocessing import get_transforms_for_preprocessing
+from .augmentation import global_augs_dict
+from GANDLF.data.patch_miner.opm.utils import (
+    generate_initial_mask,
+    get_patch_size_in_microns,
+)
+from GANDLF.data.patch_miner.opm.patch_shards import get_patch_image
+
+
+def get_slide_patch_coordinates(slide_path, patch_size, scale, cache_dir=None):
+    """
+    This function returns the candidate patch locations of a slide, which are the tissue pixels of the OPM tissue mask (as used by the patch miner) where the patch fits inside the slide. The locations are stored as flat int32 indices into the mask, since there is one per tissue pixel of every slide, in every data loader worker.
+
+    Args:
+        slide_path (str): The path to the WSI.
+        patch_size (list): The patch size in pixels as [x, y].
+        scale (int): The scale of the tissue mask, as for the patch miner.
+        cache_dir (str, optional): The directory where the coordinates are cached across runs. Defaults to None.
+
+    Returns:
+        dict: The flat "indices" of the tissue pixels in the mask, the "width" of the mask, and the "scale" from the mask to the slide as [x, y]; see get_patch_location.
+    """
+    cache_file = None
+    if cache_dir is not None:
+        slide_stat = os.stat(slide_path)
+        cache_key = hashlib.sha256(
+            json.dumps(
+                [
+                    os.path.abspath(slide_path),
+                    slide_stat.st_mtime_ns,
+                    slide_stat.st_size,
+                    [int(size) for size in patch_size],
+                    scale,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+        cache_file = os.path.join(cache_dir, "wsi_coordinates", cache_key + ".npz")
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cached:
+                return {
+                    "indices": cached["indices"],
+                    "width": int(cached["width"]),
+                    "scale": cached["scale"].tolist(),
+                }
+
+    mask, (scale_x, scale_y) = generate_initial_mask(slide_path, scale)
+    with tiffslide.open_slide(slide_path) as slide:
+        size_x, size_y = slide.dimensions
+    # the mask is indexed as [y, x], and only the rows and columns where the patch fits are kept
+    height, width = mask.shape[:2]
+    fits_x = np.round(np.arange(width) * scale_x) + patch_size[0] <= size_x
+    fits_y = np.round(np.arange(height) * scale_y) + patch_size[1] <= size_y
+    mask = np.logical_and(mask, np.outer(fits_y, fits_x))
+    coordinates = {
+        "indices": np.flatnonzero(mask).astype(np.int32),
+        "width": width,
+        "scale": [scale_x, scale_y],
+    }
+
+    if cache_file is not None:
+        Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+        # written in a single step, so that concurrent runs never read a partial file
+        with open(cache_file + ".tmp", "wb") as file:
+            np.savez(file, **coordinates)
+        os.replace(cache_file + ".tmp", cache_file)
+    return coordinates
+
+
+def get_patch_location(coordinates, index):
+    """
+    This function returns the location of a patch in the slide from its candidate locations.
+
+    Args:
+        coordinates (dict): The candidate locations, from get_slide_patch_coordinates.
+        index (int): The index of the location.
+
+    Returns:
+        tuple: The (x, y) coordinates of the top-left corner of the patch.
+    """
+    mask_y, mask_x = divmod(int(coordinates["indices"][index]), coordinates["width"])
+    scale_x, scale_y = coordinates["scale"]
+    return int(np.round(mask_x * scale_x)), int(np.round(mask_y * scale_y))
+
+
+class TrainWSIPatchDataset(Dataset):
+    def __init__(self, dataframe, parameters, transform=None, random_locations=True):
+        """
+        Dataset that reads patches from the whole slide images (WSIs) in the data CSV during training, instead of from patches extracted by the patch miner.
+
+        For training, every item is a patch of a random slide at a random location of its tissue mask, in the same format as a patch read from a PNG by ImagesFromDataFrame. Otherwise, every item is a single patch per slide in the order of the data CSV, at a location that is fixed across epochs, since the slides cannot be validated whole.
+
+        Args:
+            dataframe (pandas.DataFrame): The data CSV, with a single channel and an optional label per slide.
+            parameters (dict): The parameters dictionary.
+            transform (torchio.transforms.Transform, optional): The augmentation and pre-processing transform. Defaults to None.
+            random_locations (bool, optional): Whether the patches are sampled at random locations, for training. Defaults to True.
+        """
+        self.transform = transform
+        self._headers = parameters["headers"]
+        assert (
+            len(self._headers["channelHeaders"]) == 1
+        ), "Sampling patches from slides requires a single channel per slide."
+        self._random_locations = random_locations
+        self._samples_per_slide = (
+            parameters["q_samples_per_volume"] if random_locations else 1
+        )
+        self._max_open_slides = parameters["wsi_max_open_slides"]
+        self._sampler = torchio.data.UniformSampler(parameters["patch_size"])
+        wsi_patch_size = parameters["wsi_patch_size"]
+        if wsi_patch_size is None:
+            wsi_patch_size = parameters["patch_size"][:2]
+
+        self._resize = None
+        preprocessing = parameters["data_preprocessing"]
+        if preprocessing is not None:
+            for key in ["resize", "resize_image", "resize_images"]:
+                if preprocessing.get(key) is not None:
+                    self._resize = preprocessing[key]
+                    break
+
+        def _get_slide(row):
+            slide_path = str(dataframe.iloc[row, self._headers["channelHeaders"][0]])
+            patch_size = get_patch_size_in_microns(slide_path, wsi_patch_size)
+            slide = {
+                "subject_id": str(
+                    dataframe.iloc[row, self._headers["subjectIDHeader"]]
+                ),
+                "path": slide_path,
+                "label_path": None,
+                "values": [
+                    dataframe.iloc[row, header]
+                    for header in self._headers["predictionHeaders"]
+                ],
+                "patch_size": patch_size,
+                # the coordinate index is computed once per slide
+                "coordinates": get_slide_patch_coordinates(
+                    slide_path,
+                    patch_size,
+                    parameters["wsi_mask_scale"],
+                    parameters.get("cache_dir", None),
+                ),
+            }
+            if self._headers["labelHeader"] is not None:
+                slide["label_path"] = str(
+                    dataframe.iloc[row, self._headers["labelHeader"]]
+                )
+            return slide
+
+        with ThreadPoolExecutor(
+            max_workers=max(1, parameters["subject_construction_num_workers"])
+        ) as executor:
+            self._slides = [
+                slide
+                for slide in tqdm(
+                    executor.map(_get_slide, range(len(dataframe))),
+                    total=len(dataframe),
+                    desc="Computing the patch locations of the training slides",
+                )
+            ]
+        for slide in self._slides:
+            # slides without tissue are only skipped for training, so that the others stay in the order of the data CSV
+            assert (
+                random_locations or len(slide["coordinates"]["indices"]) > 0
+            ), f"No tissue was found in the slide '{slide['path']}'."
+        self._slides = [
+            slide for slide in self._slides if len(slide["coordinates"]["indices"]) > 0
+        ]
+        assert len(self._slides) > 0, "No tissue was found in the training slides."
+
+        self._open_slides = OrderedDict()
+        self._open_slides_pid = os.getpid()
+
+    def __getstate__(self):
+        # the slide handles are re-opened by the process that uses them
+        state = self.__dict__.copy()
+        state["_open_slides"], state["_open_slides_pid"] = OrderedDict(), None
+        return state
+
+    def _get_open_slide(self, slide_path):
+        """
+        This function returns the slide handle from the pool of the current process, so that every data loader worker reads with its own file handles.
+
+        Args:
+            slide_path (str): The path to the slide.
+
+        Returns:
+            tiffslide.TiffSlide: The slide handle.
+        """
+        if self._open_slides_pid != os.getpid():
+            self._open_slides = OrderedDict()
+            self._open_slides_pid = os.getpid()
+        if slide_path in self._open_slides:
+            self._open_slides.move_to_end(slide_path)
+        else:
+            self._open_slides[slide_path] = tiffslide.open_slide(slide_path)
+            # the least recently used slides are closed
+            while len(self._open_slides) > self._max_open_slides:
+                self._open_slides.popitem(last=False)[1].close()
+        return self._open_slides[slide_path]
+
+    def _read_patch(self, slide_path, location, patch_size, interpolator):
+        """
+        This function reads a patch from a slide, with the same image information as a PNG of the patch from the patch miner.
+
+        Args:
+            slide_path (str): The path to the slide.
+            location (numpy.ndarray): The (x, y) location of the top-left corner.
+            patch_size (list): The patch size in pixels as [x, y].
+            interpolator (SimpleITK.sitkInterpolator): The interpolator for resizing.
+
+        Returns:
+            SimpleITK.Image: The patch.
+        """
+        patch = self._get_open_slide(slide_path).read_region(
+            (int(location[0]), int(location[1])),
+            0,
+            (patch_size[0], patch_size[1]),
+            as_array=True,
+        )
+        image = get_patch_image(patch)
+        if self._resize is not None:
+            image = resize_image(image, self._resize, interpolator)
+        return image
+
+    def __len__(self):
+        return len(self._slides) * self._samples_per_slide
+
+    def __getitem__(self, idx):
+        """
+        This function returns a patch of the slide at idx, at a random location in its tissue.
+
+        Args:
+            idx (int): The index of the sample.
+
+        Returns:
+            torchio.Subject: The patch, with the same keys as the subjects of ImagesFromDataFrame.
+        """
+        slide = self._slides[idx % len(self._slides)]
+        # torch seeds every data loader worker differently, and the fixed locations only depend on the slide
+        generator = None
+        if not self._random_locations:
+            generator = torch.Generator().manual_seed(idx)
+        location = get_patch_location(
+            slide["coordinates"],
+            torch.randint(
+                len(slide["coordinates"]["indices"]), (1,), generator=generator
+            ).item(),
+        )
+
+        image = self._read_patch(
+            slide["path"], location, slide["patch_size"], sitk.sitkLinear
+        )
+        data, affine = sitk_to_nib(image)
+        subject_dict = {
+            "subject_id": slide["subject_id"],
+            "spacing": torch.Tensor(image.GetSpacing()),
+            str(self._headers["channelHeaders"][0]): torchio.ScalarImage(
+                tensor=data, affine=affine
+            ),
+        }
+        if slide["label_path"] is not None:
+            label = self._read_patch(
+                slide["label_path"],
+                location,
+                slide["patch_size"],
+                sitk.sitkNearestNeighbor,
+            )
+            data, affine = sitk_to_nib(label)
+            subject_dict["label"] = torchio.LabelMap(tensor=data, affine=affine)
+            subject_dict["path_to_metadata"] = slide["label_path"]
+        else:
+            subject_dict["label"] = "NA"
+            subject_dict["path_to_metadata"] = slide["path"]
+        for value_counter, value in enumerate(slide["values"]):
+            subject_dict["value_" + str(value_counter)] = np.array(value)
+
+        subject = torchio.Subject(subject_dict)
+        if self.transform is not None:
+            subject = self.transform(subject)
+        if not self._random_locations:
+            # the whole patch is used, as for the extracted patches in validation
+            return subject
+        # the patch is cropped to the patch size, as done by the queue for the extracted patches
+        return next(iter(self._sampler(subject, num_patches=1)))
+
+
+def get_train_wsi_patch_dataset(dataframe, parameters, train=True):
+    """
+    This function returns the dataset of patches read from the slides, with the same augmentations and pre-processing as ImagesFromDataFrame.
+
+    Args:
+        dataframe (pandas.DataFrame): The data CSV of the slides.
+        parameters (dict): The parameters dictionary.
+        train (bool, optional): Whether the augmentations are applied and the patches are sampled at random locations; otherwise, there is a single patch per slide at a fixed location, for validation and testing. Defaults to True.
+
+    Returns:
+        TrainWSIPatchDataset: The dataset.
+    """
+    if parameters["problem_type"] == "regression":
+        raise ValueError(
+            "Sampling patches from slides is only supported for segmentation and classification."
+        )
+
+    transformations_list = []
+    augmentations = parameters["data_augmentation"]
+    if train and not (augmentations is None):
+        for aug in augmentations:
+            aug_lower = aug.lower()
+            if aug_lower in global_augs_dict:
+                transformations_list.append(
+                    global_augs_dict[aug_lower](augmentations[aug])
+                )
+
+    return TrainWSIPatchDataset(
+        dataframe,
+        parameters,
+        transform=get_transforms_for_preprocessing(
+            parameters, transformations_list, train, False
+        ),
+        random_locations=train,
+    )
@@ -27,7 +27,31 @@ class GradScaler:
             parameters (Iterable): The model parameters to clip (default: None).
             create_graph (bool): Whether to create a new graph for backpropagation (default: False).
         """
+        self.backward(loss, create_graph=create_graph)
+        self.step(
+            optimizer, clip_grad=clip_grad, clip_mode=clip_mode, parameters=parameters
+        )
+
+    def backward(self, loss, create_graph=False):
+        """
+        Scales the loss and performs backward pass through the computation graph, accumulating the gradients.
+
+        Args:
+            loss (torch.Tensor): The loss tensor to scale and backpropagate.
+            create_graph (bool): Whether to create a new graph for backpropagation (default: False).
+        """
         self._scaler.scale(loss).backward(create_graph=create_graph)
+
+    def step(self, optimizer, clip_grad=None, clip_mode="norm", parameters=None):
+        """
+        Unscales and clips the accumulated gradients, and steps the optimizer.
+
+        Args:
+            optimizer (torch.optim.Optimizer): The optimizer to step.
+            clip_grad (float): The clipping value/factor/norm, mode dependent (default: None).
+            clip_mode (str): The clipping mode, one of 'norm', 'value', 'agc' (default: 'norm').
+            parameters (Iterable): The model parameters to clip (default: None).
+        """
         if clip_grad is not None:
             assert parameters is not None
             # unscale the gradients of optimizer's assigned params in-place
@@ -38,6 +62,12 @@ class GradScaler:
         self._scaler.step(optimizer)
         self._scaler.update()
 
+    def is_enabled(self):
+        """
+        Returns whether the scaler is enabled (i.e., on CUDA), in which case the steps with non-finite gradients are skipped.
+        """
+        return self._scaler.is_enabled()
+
     def state_dict(self):
         """
         Returns the state dict of the underlying GradScaler.
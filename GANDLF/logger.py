@@ -7,8 +7,12 @@ Created on Thu Mar 11 14:55:44 2021
 """
 
 import os
+import numpy as np
+import pandas as pd
 import torch
 
+from GANDLF.utils import is_main_process
+
 
 class Logger:
     def __init__(self, logger_csv_filename, metrics):
@@ -30,6 +34,9 @@ class Logger:
         self.metrics = metrics
 
     def write_header(self, mode="train"):
+        # for distributed training, only the main process writes the logs
+        if not is_main_process():
+            return
         self.csv = open(self.filename, "a")
         if os.stat(self.filename).st_size == 0:
             mode_lower = mode.lower()
@@ -61,6 +68,8 @@ class Logger:
         None.
 
         """
+        if not is_main_process():
+            return
         self.csv = open(self.filename, "a")
         row = ""
         row += str(epoch_number) + ","
@@ -83,3 +92,111 @@ class Logger:
 
     def close(self):
         self.csv.close()
+
+
+class PredictionWriter:
+    def __init__(self, filename, columns, output_format="csv", buffer_size=10000):
+        """
+        Buffered writer of predictions, where the rows are written in batches as they become available.
+
+        Parameters
+        ----------
+        filename : String
+            Path to the output file; the extension is replaced according to the output_format
+        columns : list
+            The names of the columns
+        output_format : String
+            Either "csv" or "parquet"; parquet needs the optional pyarrow dependency
+        buffer_size : int
+            The number of rows that are buffered before they are written
+
+        Returns
+        -------
+        None.
+
+        """
+        self.output_format = output_format.lower()
+        assert self.output_format in [
+            "csv",
+            "parquet",
+        ], "The output format of the predictions should be either 'csv' or 'parquet'"
+        self.filename = os.path.splitext(filename)[0] + "." + self.output_format
+        self.columns = list(columns)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered_rows = 0
+        self._parquet_writer = None
+        # start a new file, which is also created if no predictions are written
+        if self.output_format == "csv":
+            pd.DataFrame(columns=self.columns).to_csv(self.filename, index=False)
+
+    def write(self, rows):
+        """
+        Adds a batch of predictions.
+
+        Parameters
+        ----------
+        rows : dict
+            The values of the batch for every column, either as arrays of the same length or as scalars that are repeated for every row
+
+        Returns
+        -------
+        None.
+
+        """
+        values = {
+            column: (
+                rows[column].detach().cpu().numpy()
+                if torch.is_tensor(rows[column])
+                else rows[column]
+            )
+            for column in self.columns
+        }
+        # a batch of only scalars is a single row
+        is_single_row = all(np.ndim(value) == 0 for value in values.values())
+        batch = pd.DataFrame(values, index=[0] if is_single_row else None)
+        self._buffer.append(batch)
+        self._buffered_rows += len(batch)
+        if self._buffered_rows >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all the buffered predictions to the file.
+        """
+        if len(self._buffer) == 0:
+            return
+        rows = pd.concat(self._buffer, ignore_index=True)
+        self._buffer, self._buffered_rows = [], 0
+        if self.output_format == "csv":
+            rows.to_csv(self.filename, mode="a", header=False, index=False)
+        else:
+            self._write_parquet(rows)
+
+    def _write_parquet(self, rows):
+        """
+        Writes the predictions to the parquet file, which is started with the schema of the first rows.
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError(
+                "Writing predictions as parquet requires pyarrow; please install it or use the 'csv' format."
+            ) from e
+        table = pa.Table.from_pandas(rows, preserve_index=False)
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.filename, table.schema)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        """
+        Writes the remaining predictions and closes the file.
+        """
+        self.flush()
+        # as for csv, the file is created with the columns if no predictions were written
+        if self.output_format == "parquet" and self._parquet_writer is None:
+            self._write_parquet(pd.DataFrame(columns=self.columns))
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
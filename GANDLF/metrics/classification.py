@@ -1,8 +1,136 @@
+import copy
+from functools import lru_cache
+
 import torchmetrics as tm
 from torch.nn.functional import one_hot
-from ..utils import get_output_from_calculator
 from GANDLF.utils.generic import determine_classification_task_type
 
+# the metrics calculated by overall_stats, in the order in which they are reported
+_overall_stats_names = (
+    "accuracy",
+    "precision",
+    "recall",
+    "f1",
+    "specificity",
+    "aucroc",
+)
+
+
+@lru_cache(maxsize=None)
+def _get_overall_stats_calculators(
+    task: str, num_classes: int, sync_on_compute: bool = True
+) -> dict:
+    """
+    Constructs the calculators for the overall stats; these are cached per task and number of classes, and need to be reset before use.
+
+    Args:
+        task (str): The classification task type, from determine_classification_task_type.
+        num_classes (int): The number of classes.
+        sync_on_compute (bool, optional): Whether the states are synchronized across processes when computing, for distributed training. Defaults to True.
+
+    Returns:
+        dict: The calculators of the metrics that are based on the confusion matrix ("stats") and of the AUROC ("aucroc").
+    """
+    # consider adding a "multilabel field in the future"
+    # multidim_average is not used when constructing these metrics
+    # think of having it
+    kwargs = {
+        "task": task,
+        "num_classes": num_classes,
+        "average": "weighted",
+        "sync_on_compute": sync_on_compute,
+    }
+    return {
+        # these metrics have the same state, so that a single confusion matrix is accumulated for all of them
+        "stats": tm.MetricCollection(
+            {
+                "accuracy": tm.Accuracy(**kwargs),
+                "precision": tm.Precision(**kwargs),
+                "recall": tm.Recall(**kwargs),
+                "f1": tm.F1Score(**kwargs),
+                "specificity": tm.Specificity(**kwargs),
+            },
+            compute_groups=True,
+        ),
+        "aucroc": tm.AUROC(**kwargs),
+    }
+
+
+def get_overall_stats_names() -> list:
+    """
+    Returns the names of the metrics calculated by overall_stats, without calculating them.
+
+    Returns:
+        list: The names of the metrics.
+    """
+    return list(_overall_stats_names)
+
+
+def initialize_overall_stats(params) -> dict:
+    """
+    Initializes the calculators to accumulate the overall stats over batches with update_overall_stats.
+
+    Args:
+        params (dict): The parameter dictionary containing training and data information.
+
+    Returns:
+        dict: The calculators with an empty state.
+    """
+    assert (
+        params["problem_type"] == "classification"
+    ), "Only classification is supported for these stats"
+    calculators = _get_overall_stats_calculators(
+        determine_classification_task_type(params), params["model"]["num_classes"]
+    )
+    # a separate copy, so that the accumulation is not affected by other calls to overall_stats
+    calculators = copy.deepcopy(calculators)
+    for calculator in calculators.values():
+        calculator.reset()
+        # the predictions are accumulated on the device, without copying them to the host
+        calculator.to(params.get("device", "cpu"))
+    return calculators
+
+
+def update_overall_stats(calculators, predictions, ground_truth, params):
+    """
+    Accumulates the predictions and ground truths of a batch into the calculators.
+
+    Args:
+        calculators (dict): The calculators from initialize_overall_stats.
+        predictions (torch.Tensor): The predicted labels.
+        ground_truth (torch.Tensor): The ground truth labels.
+        params (dict): The parameter dictionary containing training and data information.
+    """
+    calculators["stats"].update(predictions, ground_truth)
+    if determine_classification_task_type(params) == "binary":
+        aucroc_predictions = predictions.float()
+    else:
+        aucroc_predictions = one_hot(
+            predictions.long(), num_classes=params["model"]["num_classes"]
+        ).float()
+    calculators["aucroc"].update(aucroc_predictions, ground_truth)
+
+
+def compute_overall_stats(calculators) -> dict:
+    """
+    Computes the overall stats from the accumulated state of the calculators.
+
+    Args:
+        calculators (dict): The calculators from initialize_overall_stats.
+
+    Returns:
+        dict: A dictionary of metrics.
+    """
+    computed_metrics = calculators["stats"].compute()
+    computed_metrics["aucroc"] = calculators["aucroc"].compute()
+    output_metrics = {}
+    for metric_name in _overall_stats_names:
+        metric_value = computed_metrics[metric_name].cpu()
+        output_metrics[metric_name] = (
+            metric_value.tolist() if metric_value.dim() > 0 else metric_value.item()
+        )
+    return output_metrics
+
 
 def overall_stats(predictions, ground_truth, params):
     """
@@ -20,66 +148,16 @@ def overall_stats(predictions, ground_truth, params):
         params["problem_type"] == "classification"
     ), "Only classification is supported for these stats"
 
-    output_metrics = {}
-
-    average_types_keys = {
-        "global": "micro",
-        "per_class": "none",
-        "per_class_average": "macro",
-        "per_class_weighted": "weighted",
-    }
-    task = determine_classification_task_type(params)
-    # consider adding a "multilabel field in the future"
-    # metrics that need the "average" parameter
-
-    for average_type_key in average_types_keys.values():
-        # multidim_average is not used when constructing these metrics
-        # think of having it
-        calculators = {
-            "accuracy": tm.Accuracy(
-                task=task,
-                num_classes=params["model"]["num_classes"],
-                average=average_type_key,
-            ),
-            "precision": tm.Precision(
-                task=task,
-                num_classes=params["model"]["num_classes"],
-                average=average_type_key,
-            ),
-            "recall": tm.Recall(
-                task=task,
-                num_classes=params["model"]["num_classes"],
-                average=average_type_key,
-            ),
-            "f1": tm.F1Score(
-                task=task,
-                num_classes=params["model"]["num_classes"],
-                average=average_type_key,
-            ),
-            "specificity": tm.Specificity(
-                task=task,
-                num_classes=params["model"]["num_classes"],
-                average=average_type_key,
-            ),
-            "aucroc": tm.AUROC(
-                task=task,
-                num_classes=params["model"]["num_classes"],
-                average=average_type_key if average_type_key != "micro" else "macro",
-            ),
-        }
-        for metric_name, calculator in calculators.items():
-            if metric_name == "aucroc":
-                one_hot_preds = one_hot(
-                    predictions.long(),
-                    num_classes=params["model"]["num_classes"],
-                )
-                output_metrics[metric_name] = get_output_from_calculator(
-                    one_hot_preds.float(), ground_truth, calculator
-                )
-            else:
-                output_metrics[metric_name] = get_output_from_calculator(
-                    predictions, ground_truth, calculator
-                )
+    # the predictions are complete, so these are not synchronized across processes
+    calculators = _get_overall_stats_calculators(
+        determine_classification_task_type(params),
+        params["model"]["num_classes"],
+        sync_on_compute=False,
+    )
+    for calculator in calculators.values():
+        calculator.reset()
+    update_overall_stats(calculators, predictions, ground_truth, params)
+    output_metrics = compute_overall_stats(calculators)
 
     #### HERE WE NEED TO MODIFY TESTS - ROC IS RETURNING A TUPLE. WE MAY ALSO DISCRAD IT ####
     # what is AUC metric telling at all? Computing it for predictions and ground truth
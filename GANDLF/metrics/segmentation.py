@@ -79,50 +79,92 @@ def multi_class_dice_per_label(output, label, params):
     return multi_class_dice(output, label, params, per_label=True)
 
 
-def __surface_distances(result, reference, voxelspacing=None, connectivity=1):
+def _get_bounding_box(input_array):
     """
-    The distances between the surface voxel of binary objects in result and their
-    nearest partner surface voxel of a binary object in reference. Adapted from https://github.com/loli/medpy/blob/39131b94f0ab5328ab14a874229320efc2f74d98/medpy/metric/binary.py#L1195.
+    This function computes the bounding box of the objects in an array.
 
     Args:
-        result (torch.Tensor): Input prediction containing objects. Can be any type but will be converted into binary: background where 0, object everywhere else.
-        reference (torch.Tensor): Input ground truth containing objects. Can be any type but will be converted into binary: background where 0, object everywhere else.
+        input_array (np.ndarray): Input data containing objects. Can be any type but will be converted into binary: background where 0, object everywhere else.
+
+    Returns:
+        list: The [start, stop) indices of the objects along each axis, or None if there are no objects.
+    """
+    bbox = []
+    for axis in range(input_array.ndim):
+        other_axes = tuple(i for i in range(input_array.ndim) if i != axis)
+        indices = np.flatnonzero(np.any(input_array, axis=other_axes))
+        if len(indices) == 0:
+            return None
+        bbox.append((indices[0], indices[-1] + 1))
+    return bbox
+
+
+def _surface_distances_both_ways(
+    result, reference, voxelspacing=None, connectivity=1, crop_to_bbox=True
+):
+    """
+    The distances between the surface voxels of binary objects in result and their nearest partner surface voxels of a binary object in reference, and vice versa; the borders are extracted only once for both directions. Adapted from https://github.com/loli/medpy/blob/39131b94f0ab5328ab14a874229320efc2f74d98/medpy/metric/binary.py#L1195.
+
+    Args:
+        result (np.ndarray): Input prediction containing objects. Can be any type but will be converted into binary: background where 0, object everywhere else.
+        reference (np.ndarray): Input ground truth containing objects. Can be any type but will be converted into binary: background where 0, object everywhere else.
         voxelspacing (tuple): The size of each voxel, defaults to isotropic spacing of 1mm.
         connectivity (int): The connectivity of regions. See scipy.ndimage.generate_binary_structure for more information.
+        crop_to_bbox (bool): Whether to compute the borders and distance transforms only in the (padded) bounding box of the union of both objects.
 
     Returns:
-        float: The symmetric Hausdorff Distance between the object(s) in ```result``` and the object(s) in ```reference```. The distance unit is the same as for the spacing of elements along each dimension, which is usually given in mm.
+        np.ndarray, np.ndarray: The surface distances from ```result``` to ```reference``` and from ```reference``` to ```result```, or 0 for both if either is empty. The distance unit is the same as for the spacing of elements along each dimension, which is usually given in mm.
     """
-    result = np.atleast_1d(result.astype(bool))
-    reference = np.atleast_1d(reference.astype(bool))
+    result = np.atleast_1d(result)
+    reference = np.atleast_1d(reference)
     if voxelspacing is not None:
         voxelspacing = _ni_support._normalize_sequence(voxelspacing, result.ndim)
         voxelspacing = np.asarray(voxelspacing, dtype=np.float64)
         if not voxelspacing.flags.contiguous:
             voxelspacing = voxelspacing.copy()
 
+    # test for emptiness
+    result_bbox = _get_bounding_box(result)
+    if result_bbox is None:
+        return 0, 0
+    reference_bbox = _get_bounding_box(reference)
+    if reference_bbox is None:
+        return 0, 0
+
+    if crop_to_bbox:
+        # all borders are inside the bounding box of the union of both objects, and a margin of one
+        # background voxel ensures that the borders are extracted exactly as in the full array;
+        # the crop does not change the voxel size, so the distances are unchanged
+        roi = tuple(
+            slice(max(min(r_start, t_start) - 1, 0), min(max(r_stop, t_stop) + 1, size))
+            for (r_start, r_stop), (t_start, t_stop), size in zip(
+                result_bbox, reference_bbox, result.shape
+            )
+        )
+        result, reference = result[roi], reference[roi]
+
+    result = result.astype(bool)
+    reference = reference.astype(bool)
+
     # binary structure
     footprint = generate_binary_structure(result.ndim, connectivity)
 
-    # test for emptiness
-    if 0 == np.count_nonzero(result):
-        return 0
-    if 0 == np.count_nonzero(reference):
-        return 0
-
     # extract only 1-pixel border line of objects
     result_border = result ^ binary_erosion(result, structure=footprint, iterations=1)
     reference_border = reference ^ binary_erosion(
         reference, structure=footprint, iterations=1
     )
 
-    # compute average surface distance
     # Note: scipys distance transform is calculated only inside the borders of the
     #       foreground objects, therefore the input has to be reversed
-    dt = distance_transform_edt(~reference_border, sampling=voxelspacing)
-    sds = dt[result_border]
+    result_to_reference = distance_transform_edt(
+        ~reference_border, sampling=voxelspacing
+    )[result_border]
+    reference_to_result = distance_transform_edt(~result_border, sampling=voxelspacing)[
+        reference_border
+    ]
 
-    return sds
+    return result_to_reference, reference_to_result
 
 
 def _nsd_base(a_to_b, b_to_a, threshold):
@@ -263,14 +305,33 @@ def _calculator_sensitivity_specificity(
         )
 
 
-def _calculator_generic_all_surface_distances(
-    inp,
-    target,
-    params,
-    per_label=False,
-):
+def _get_surface_distance_options(params):
     """
-    This function returns hd100, hd95, and nsd.
+    This function returns the options of the surface distance metrics, which share a single computation.
+
+    Args:
+        params (dict): The parameter dictionary containing training and data information.
+
+    Returns:
+        int, bool: The connectivity of regions and whether the distance transforms are restricted to the bounding box of the objects.
+    """
+    connectivity, crop_to_bbox = None, True
+    metrics = params.get("metrics", None)
+    if isinstance(metrics, dict):
+        for metric_options in metrics.values():
+            # only the surface distance metrics have the connectivity option
+            if isinstance(metric_options, dict) and ("connectivity" in metric_options):
+                if connectivity is None:
+                    connectivity = metric_options["connectivity"]
+                crop_to_bbox = crop_to_bbox and metric_options.get("bbox", True)
+    if connectivity is None:
+        connectivity = 1
+    return connectivity, crop_to_bbox
+
+
+def _get_surface_distance_metrics(inp, target, params):
+    """
+    This function computes nsd, hd100, and hd95 for every batch element and label. The surface distances are only computed once per (prediction, target) pair in a step, and all surface distance metrics are served from that.
 
     Args:
         inp (torch.Tensor): Input prediction containing objects. Can be any type but will be converted into binary: background where 0, object everywhere else.
@@ -278,54 +339,72 @@ def _calculator_generic_all_surface_distances(
         params (dict): The parameter dictionary containing training and data information.
 
     Returns:
-        float, float, float: The Normalized Surface Dice, 100th percentile Hausdorff Distance, and the 95th percentile Hausdorff Distance.
+        list, list, list: The Normalized Surface Dice, 100th percentile Hausdorff Distance, and the 95th percentile Hausdorff Distance for every batch element and label.
     """
+    # the metric context only lives for a single step, during which both tensors are alive and cannot change identity
+    metric_context = params.get("metric_context", None)
+    context_key = ("surface_distances", id(inp), id(target))
+    if metric_context is not None and context_key in metric_context:
+        return metric_context[context_key][2]
+
     result_array = _convert_tensor_to_int_label_array(inp)
     target_array = _convert_tensor_to_int_label_array(target)
+    connectivity, crop_to_bbox = _get_surface_distance_options(params)
 
-    avg_counter = 0
-    if per_label:
-        return_hd100, return_hd95, return_nsd = [], [], []
-    else:
-        return_hd100, return_hd95, return_nsd = 0, 0, 0
+    all_nsd, all_hd100, all_hd95 = [], [], []
     for b in range(0, result_array.shape[0]):
         for i in range(0, params["model"]["num_classes"]):
             if i != params["model"]["ignore_label_validation"]:
-                hd1 = __surface_distances(
+                hd1, hd2 = _surface_distances_both_ways(
                     result_array[b, i, ...],
                     target_array[b, i, ...],
                     params["subject_spacing"][b],
-                )
-                hd2 = __surface_distances(
-                    target_array[b, i, ...],
-                    result_array[b, i, ...],
-                    params["subject_spacing"][b],
+                    connectivity,
+                    crop_to_bbox,
                 )
                 threshold = max(min(params["subject_spacing"][0]), 1).item()
-                temp_nsd = _nsd_base(hd1, hd2, threshold)
-                temp_hd100 = np.percentile(np.hstack((hd1, hd2)), 100)
-                temp_hd95 = np.percentile(np.hstack((hd1, hd2)), 95)
-                if per_label:
-                    return_nsd.append(temp_nsd)
-                    return_hd100.append(temp_hd100)
-                    return_hd95.append(temp_hd95)
-                else:
-                    return_nsd += temp_nsd
-                    return_hd100 += temp_hd100
-                    return_hd95 += temp_hd95
-                    avg_counter += 1
+                all_nsd.append(_nsd_base(hd1, hd2, threshold))
+                all_distances = np.hstack((hd1, hd2))
+                all_hd100.append(np.percentile(all_distances, 100))
+                all_hd95.append(np.percentile(all_distances, 95))
+
+    if metric_context is not None:
+        # the tensors are stored to keep them alive along with their ids
+        metric_context[context_key] = (inp, target, (all_nsd, all_hd100, all_hd95))
+    return all_nsd, all_hd100, all_hd95
+
+
+def _calculator_generic_all_surface_distances(
+    inp,
+    target,
+    params,
+    per_label=False,
+):
+    """
+    This function returns hd100, hd95, and nsd.
+
+    Args:
+        inp (torch.Tensor): Input prediction containing objects. Can be any type but will be converted into binary: background where 0, object everywhere else.
+        target (torch.Tensor): Input ground truth containing objects. Can be any type but will be converted into binary: binary: background where 0, object everywhere else.
+        params (dict): The parameter dictionary containing training and data information.
+
+    Returns:
+        float, float, float: The Normalized Surface Dice, 100th percentile Hausdorff Distance, and the 95th percentile Hausdorff Distance.
+    """
+    all_nsd, all_hd100, all_hd95 = _get_surface_distance_metrics(inp, target, params)
 
     if per_label:
         return (
-            torch.tensor(return_nsd),
-            torch.tensor(return_hd100),
-            torch.tensor(return_hd95),
+            torch.tensor(all_nsd),
+            torch.tensor(all_hd100),
+            torch.tensor(all_hd95),
         )
     else:
+        avg_counter = len(all_nsd)
         return (
-            torch.tensor(return_nsd / avg_counter),
-            torch.tensor(return_hd100 / avg_counter),
-            torch.tensor(return_hd95 / avg_counter),
+            torch.tensor(sum(all_nsd) / avg_counter),
+            torch.tensor(sum(all_hd100) / avg_counter),
+            torch.tensor(sum(all_hd95) / avg_counter),
         )
 
 
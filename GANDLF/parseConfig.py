@@ -16,19 +16,29 @@ parameter_defaults = {
     "save_training": False,  # save outputs during training
     "save_output": False,  # save outputs during validation/testing
     "in_memory": False,  # pin data to cpu memory
-    "pin_memory_dataloader": False,  # pin data to gpu memory
+    "pin_memory_dataloader": True,  # pin the training batches for asynchronous copies to cuda devices
+    "num_workers_dataloader": 0,  # number of worker processes for the validation/testing data loaders
+    "prefetch_factor_dataloader": 2,  # number of subjects prefetched by each worker of the validation/testing data loaders
+    "persistent_workers_dataloader": False,  # keep the workers of the validation/testing data loaders alive across epochs
     "enable_padding": False,  # if padding needs to be done when "patch_sampler" is "label"
     "scaling_factor": 1,  # scaling factor for regression problems
     "q_max_length": 100,  # the max length of queue
     "q_samples_per_volume": 10,  # number of samples per volume
     "q_num_workers": 4,  # number of worker threads to use
+    "subject_construction_num_workers": 4,  # number of threads to construct and sanity check the subjects
     "num_epochs": 100,  # total number of epochs to train
     "patience": 100,  # number of epochs to wait for performance improvement
     "batch_size": 1,  # default batch size of training
     "learning_rate": 0.001,  # default learning rate
     "clip_grad": None,  # clip_gradient value
+    "gradient_accumulation_steps": 1,  # number of batches whose gradients are accumulated for every optimizer step
     "track_memory_usage": False,  # default memory tracking
     "memory_save_mode": False,  # default memory saving, if enabled, resize/resample will save files to disk
+    "cache_dir": None,  # directory to cache the loaded and pre-processed subjects across runs
+    "wsi_patch_sampling": False,  # read the training patches from the whole slide images in the training data, instead of pre-extracted patches
+    "wsi_patch_size": None,  # size of the patches read from the slides (can be in microns), before pre-processing; defaults to the patch size
+    "wsi_mask_scale": 16,  # scale of the tissue mask that the patch locations are sampled from, as for the patch miner
+    "wsi_max_open_slides": 32,  # number of slides kept open by each data loader worker
     "print_rgb_label_warning": True,  # print rgb label warning
     "data_postprocessing": {},  # default data postprocessing
     "grid_aggregator_overlap": "crop",  # default grid aggregator overlap strategy
@@ -42,6 +52,7 @@ parameter_defaults_string = {
     "patch_sampler": "uniform",  # type of sampling strategy
     "scheduler": "triangle_modified",  # the default scheduler
     "clip_mode": None,  # default clip mode
+    "predictions_format": "csv",  # file format of the written predictions, either "csv" or "parquet"
 }
 
 
@@ -255,6 +266,9 @@ def parseConfig(config_file_path, version_check_flag=True):
                 temp_dict[comparison_string] = initialize_key(
                     temp_dict[comparison_string], "threshold", None
                 )
+                temp_dict[comparison_string] = initialize_key(
+                    temp_dict[comparison_string], "bbox", True
+                )
 
         params["metrics"] = temp_dict
 
@@ -654,6 +668,11 @@ def parseConfig(config_file_path, version_check_flag=True):
             False,
         )
 
+    assert (
+        isinstance(params["gradient_accumulation_steps"], int)
+        and params["gradient_accumulation_steps"] >= 1
+    ), "'gradient_accumulation_steps' should be a positive integer"
+
     # ensure that the scheduler and optimizer are dicts
     if isinstance(params["scheduler"], str):
         temp_dict = {}
@@ -677,6 +696,8 @@ def parseConfig(config_file_path, version_check_flag=True):
     inference_mechanism = {
         "grid_aggregator_overlap": "crop",
         "patch_overlap": 0,
+        "batch_size": 1,
+        "num_workers": 0,
     }
     initialize_inference_mechanism = False
     if not ("inference_mechanism" in params):
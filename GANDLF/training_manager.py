@@ -4,7 +4,7 @@ from sklearn.model_selection import KFold
 from pathlib import Path
 
 from GANDLF.compute import training_loop
-from GANDLF.utils import get_dataframe
+from GANDLF.utils import get_dataframe, is_main_process, main_process_first
 
 
 def TrainingManager(dataframe, outputDir, parameters, device, resume, reset):
@@ -19,23 +19,27 @@ def TrainingManager(dataframe, outputDir, parameters, device, resume, reset):
         resume (bool): Whether the previous run will be resumed or not.
         reset (bool): Whether the previous run will be reset or not.
     """
-    if reset:
-        shutil.rmtree(outputDir)
-        Path(outputDir).mkdir(parents=True, exist_ok=True)
-
-    # save the current model configuration as a sanity check
-    currentModelConfigPickle = os.path.join(outputDir, "parameters.pkl")
-    if (not os.path.exists(currentModelConfigPickle)) or reset or resume:
-        with open(currentModelConfigPickle, "wb") as handle:
-            pickle.dump(parameters, handle, protocol=pickle.HIGHEST_PROTOCOL)
-    else:
-        if os.path.exists(currentModelConfigPickle):
-            print(
-                "Using previously saved parameter file",
-                currentModelConfigPickle,
-                flush=True,
-            )
-            parameters = pickle.load(open(currentModelConfigPickle, "rb"))
+    # for distributed training, the main process writes the files and the other processes read them
+    with main_process_first():
+        if reset and is_main_process():
+            shutil.rmtree(outputDir)
+            Path(outputDir).mkdir(parents=True, exist_ok=True)
+
+        # save the current model configuration as a sanity check
+        currentModelConfigPickle = os.path.join(outputDir, "parameters.pkl")
+        if is_main_process() and (
+            (not os.path.exists(currentModelConfigPickle)) or reset or resume
+        ):
+            with open(currentModelConfigPickle, "wb") as handle:
+                pickle.dump(parameters, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            if os.path.exists(currentModelConfigPickle):
+                print(
+                    "Using previously saved parameter file",
+                    currentModelConfigPickle,
+                    flush=True,
+                )
+                parameters = pickle.load(open(currentModelConfigPickle, "rb"))
 
     # check for single fold training
     singleFoldValidation = False
@@ -141,35 +145,38 @@ def TrainingManager(dataframe, outputDir, parameters, device, resume, reset):
                 currentOutputFolder, "data_testing.pkl"
             )
 
-            if (not os.path.exists(currentTestingDataPickle)) or reset or resume:
-                testingData.to_pickle(currentTestingDataPickle)
-            else:
-                if os.path.exists(currentTestingDataPickle):
-                    print(
-                        "Using previously saved testing data",
-                        currentTestingDataPickle,
-                        flush=True,
-                    )
-                    testingData = pd.read_pickle(currentTestingDataPickle)
-
-            if (
-                (not os.path.exists(currentTrainingAndValidationDataPickle))
-                or reset
-                or resume
-            ):
-                trainingAndValidationData.to_pickle(
-                    currentTrainingAndValidationDataPickle
-                )
-            else:
-                if os.path.exists(currentTrainingAndValidationDataPickle):
-                    print(
-                        "Using previously saved training+validation data",
-                        currentTrainingAndValidationDataPickle,
-                        flush=True,
-                    )
-                    trainingAndValidationData = pd.read_pickle(
+            with main_process_first():
+                if is_main_process() and (
+                    (not os.path.exists(currentTestingDataPickle)) or reset or resume
+                ):
+                    testingData.to_pickle(currentTestingDataPickle)
+                else:
+                    if os.path.exists(currentTestingDataPickle):
+                        print(
+                            "Using previously saved testing data",
+                            currentTestingDataPickle,
+                            flush=True,
+                        )
+                        testingData = pd.read_pickle(currentTestingDataPickle)
+
+                if is_main_process() and (
+                    (not os.path.exists(currentTrainingAndValidationDataPickle))
+                    or reset
+                    or resume
+                ):
+                    trainingAndValidationData.to_pickle(
                         currentTrainingAndValidationDataPickle
                     )
+                else:
+                    if os.path.exists(currentTrainingAndValidationDataPickle):
+                        print(
+                            "Using previously saved training+validation data",
+                            currentTrainingAndValidationDataPickle,
+                            flush=True,
+                        )
+                        trainingAndValidationData = pd.read_pickle(
+                            currentTrainingAndValidationDataPickle
+                        )
 
             current_training_subject_indeces_full = (
                 trainingAndValidationData[
@@ -232,20 +239,25 @@ def TrainingManager(dataframe, outputDir, parameters, device, resume, reset):
             currentValidationDataPickle = os.path.join(
                 currentValOutputFolder, "data_validation.pkl"
             )
-            if (not os.path.exists(currentTrainingDataPickle)) or reset or resume:
-                trainingData.to_pickle(currentTrainingDataPickle)
-                trainingData.to_csv(
-                    currentTrainingDataPickle.replace(".pkl", ".csv"), index=False
-                )
-            else:
-                trainingData = get_dataframe(currentTrainingDataPickle)
-            if (not os.path.exists(currentValidationDataPickle)) or reset or resume:
-                validationData.to_pickle(currentValidationDataPickle)
-                validationData.to_csv(
-                    currentValidationDataPickle.replace(".pkl", ".csv"), index=False
-                )
-            else:
-                validationData = get_dataframe(currentValidationDataPickle)
+            with main_process_first():
+                if is_main_process() and (
+                    (not os.path.exists(currentTrainingDataPickle)) or reset or resume
+                ):
+                    trainingData.to_pickle(currentTrainingDataPickle)
+                    trainingData.to_csv(
+                        currentTrainingDataPickle.replace(".pkl", ".csv"), index=False
+                    )
+                else:
+                    trainingData = get_dataframe(currentTrainingDataPickle)
+                if is_main_process() and (
+                    (not os.path.exists(currentValidationDataPickle)) or reset or resume
+                ):
+                    validationData.to_pickle(currentValidationDataPickle)
+                    validationData.to_csv(
+                        currentValidationDataPickle.replace(".pkl", ".csv"), index=False
+                    )
+                else:
+                    validationData = get_dataframe(currentValidationDataPickle)
 
             # parallel_compute_command is an empty string, thus no parallel computing requested
             if (not parameters["parallel_compute_command"]) or (singleFoldValidation):
@@ -326,17 +338,20 @@ def TrainingManager_split(
         reset (bool): Whether the previous run will be reset or not.
     """
     currentModelConfigPickle = os.path.join(outputDir, "parameters.pkl")
-    if (not os.path.exists(currentModelConfigPickle)) or reset or resume:
-        with open(currentModelConfigPickle, "wb") as handle:
-            pickle.dump(parameters, handle, protocol=pickle.HIGHEST_PROTOCOL)
-    else:
-        if os.path.exists(currentModelConfigPickle):
-            print(
-                "Using previously saved parameter file",
-                currentModelConfigPickle,
-                flush=True,
-            )
-            parameters = pickle.load(open(currentModelConfigPickle, "rb"))
+    with main_process_first():
+        if is_main_process() and (
+            (not os.path.exists(currentModelConfigPickle)) or reset or resume
+        ):
+            with open(currentModelConfigPickle, "wb") as handle:
+                pickle.dump(parameters, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            if os.path.exists(currentModelConfigPickle):
+                print(
+                    "Using previously saved parameter file",
+                    currentModelConfigPickle,
+                    flush=True,
+                )
+                parameters = pickle.load(open(currentModelConfigPickle, "rb"))
 
     training_loop(
         training_data=dataframe_train,
@@ -6,6 +6,7 @@ os.environ["TORCHIO_HIDE_CITATION_PROMPT"] = "1"
 from .imaging import (
     resize_image,
     resample_image,
+    get_image_header,
     perform_sanity_check_on_subject,
     write_training_patches,
 )
@@ -21,6 +22,7 @@ from .tensor import (
     get_linear_interpolation_mode,
     print_model_summary,
     get_ground_truths_and_predictions_tensor,
+    get_inference_batch_size,
     get_output_from_calculator,
     get_tensor_from_image,
     get_image_from_tensor,
@@ -53,6 +55,23 @@ from .generic import (
     determine_classification_task_type,
 )
 
+from .distributed import (
+    init_distributed,
+    is_distributed,
+    get_rank,
+    get_world_size,
+    is_main_process,
+    barrier,
+    main_process_first,
+    unwrap_model,
+    reduce_across_processes,
+    gather_across_processes,
+    broadcast_from_main_process,
+    average_gradients,
+    get_distributed_sampler,
+    set_sampler_epoch,
+)
+
 from .modelio import (
     best_model_path_end,
     latest_model_path_end,
@@ -61,4 +80,6 @@ from .modelio import (
     load_ov_model,
     save_model,
     optimize_and_save_model,
+    get_parameters_to_save,
+    CheckpointWriter,
 )
@@ -0,0 +1,221 @@
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch import nn
+from torch.utils.data.distributed import DistributedSampler
+
+
+def is_distributed_launch() -> bool:
+    """
+    This function checks if the current process has been launched by torchrun (or another launcher that sets the same environment variables) with more than one process.
+
+    Returns:
+        bool: True if there are multiple processes.
+    """
+    return int(os.environ.get("WORLD_SIZE", "1")) > 1
+
+
+def init_distributed(device: str) -> bool:
+    """
+    This function initializes the default process group if the current process has been launched with multiple processes; the "nccl" backend is used for CUDA and "gloo" for CPU.
+
+    Args:
+        device (str): The device type.
+
+    Returns:
+        bool: True if training is distributed.
+    """
+    if is_distributed_launch() and not is_distributed():
+        backend = "nccl" if "cuda" in str(device) else "gloo"
+        if backend == "nccl":
+            torch.cuda.set_device(get_local_rank())
+        dist.init_process_group(backend=backend)
+    return is_distributed()
+
+
+def is_distributed() -> bool:
+    """
+    This function checks if the default process group has been initialized.
+
+    Returns:
+        bool: True if training is distributed.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", "0"))
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextmanager
+def main_process_first():
+    """
+    Context manager in which the main process runs first, and the other processes only after it is done; used for blocks that write files that the other processes read.
+    """
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    """
+    This function returns the model without the DataParallel/DistributedDataParallel wrapper.
+
+    Args:
+        model (torch.nn.Module): The model.
+
+    Returns:
+        torch.nn.Module: The unwrapped model.
+    """
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def reduce_across_processes(value, average=True):
+    """
+    This function sums (or averages) the value over all processes; dictionaries and lists are reduced per element, and strings are returned as-is.
+
+    Args:
+        value (Union[float, int, bool, numpy.ndarray, torch.Tensor, list, dict]): The value of the current process.
+        average (bool, optional): Whether to average instead of sum. Defaults to True.
+
+    Returns:
+        Union[float, numpy.ndarray, torch.Tensor, list, dict]: The reduced value, of the same type as the input.
+    """
+    if not is_distributed():
+        return value
+    if isinstance(value, dict):
+        return {
+            key: reduce_across_processes(item, average) for key, item in value.items()
+        }
+    if isinstance(value, str) or value is None:
+        return value
+    if isinstance(value, list):
+        return reduce_across_processes(
+            np.array(value, dtype=np.float64), average
+        ).tolist()
+
+    # gloo does not support all types, so the reduction is done in float64 on the device of the backend
+    backend_device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    tensor = torch.as_tensor(value.detach() if torch.is_tensor(value) else value).to(
+        backend_device, dtype=torch.float64
+    )
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    if average:
+        tensor /= get_world_size()
+
+    if torch.is_tensor(value):
+        return tensor.to(value.device, dtype=value.dtype)
+    if isinstance(value, np.ndarray):
+        return tensor.cpu().numpy()
+    return tensor.item()
+
+
+def gather_across_processes(tensor: torch.Tensor) -> torch.Tensor:
+    """
+    This function concatenates the tensors of all processes along the first dimension, in the order of the ranks; the tensors can have different lengths.
+
+    Args:
+        tensor (torch.Tensor): The tensor of the current process.
+
+    Returns:
+        torch.Tensor: The concatenated tensor, on the device of the input.
+    """
+    if not is_distributed():
+        return tensor
+    backend_device = "cuda" if dist.get_backend() == "nccl" else "cpu"
+    local = tensor.detach().to(backend_device)
+    lengths = [None] * get_world_size()
+    dist.all_gather_object(lengths, local.shape[0])
+    # all_gather needs tensors of the same shape, so the shorter ones are padded
+    padded = local.new_zeros((max(lengths),) + tuple(local.shape[1:]))
+    padded[: local.shape[0]] = local
+    gathered = [torch.empty_like(padded) for _ in lengths]
+    dist.all_gather(gathered, padded)
+    return torch.cat([item[:length] for item, length in zip(gathered, lengths)]).to(
+        tensor.device
+    )
+
+
+def broadcast_from_main_process(value):
+    """
+    This function returns the value of the main process in every process; used for results that are only computed by the main process.
+
+    Args:
+        value (Any): The value of the current process, which is ignored in the other processes; it needs to be picklable.
+
+    Returns:
+        Any: The value of the main process.
+    """
+    if not is_distributed():
+        return value
+    values = [value]
+    dist.broadcast_object_list(values, src=0)
+    return values[0]
+
+
+def average_gradients(model: nn.Module):
+    """
+    This function averages the gradients of the model across processes; used when the last backward pass of a step did not synchronize them.
+
+    Args:
+        model (torch.nn.Module): The model.
+    """
+    for parameter in model.parameters():
+        if parameter.grad is not None:
+            parameter.grad.copy_(reduce_across_processes(parameter.grad))
+
+
+def get_distributed_sampler(dataset, shuffle=True):
+    """
+    This function returns the sampler that shards the dataset across processes, or None if training is not distributed.
+
+    Args:
+        dataset (torch.utils.data.Dataset): The dataset.
+        shuffle (bool, optional): Whether to shuffle the dataset every epoch. Defaults to True.
+
+    Returns:
+        Union[torch.utils.data.distributed.DistributedSampler, None]: The sampler.
+    """
+    if not is_distributed():
+        return None
+    return DistributedSampler(dataset, shuffle=shuffle)
+
+
+def set_sampler_epoch(data_loader, epoch):
+    """
+    This function sets the epoch of the distributed sampler of the data loader (or of the subject sampler of its torchio queue), so that every epoch is shuffled differently.
+
+    Args:
+        data_loader (torch.utils.data.DataLoader): The data loader.
+        epoch (int): The current epoch.
+    """
+    for sampler in [
+        getattr(data_loader, "sampler", None),
+        getattr(getattr(data_loader, "dataset", None), "subject_sampler", None),
+    ]:
+        if isinstance(sampler, DistributedSampler):
+            sampler.set_epoch(epoch)
@@ -1,4 +1,5 @@
 import os, pathlib, sys, math
+from functools import lru_cache
 import numpy as np
 import SimpleITK as sitk
 import torchio
@@ -107,6 +108,51 @@ def softer_sanity_check(base_property, new_property, threshold=0.00001):
     return result
 
 
+@lru_cache(maxsize=1024)
+def _read_image_header(image_path, modification_time, file_size):
+    """
+    Helper function to read the header of an image, cached on the path, modification time and size of the file; the cache is bounded, so that long runs over many files do not keep every reader alive.
+
+    Args:
+        image_path (str): The path to the image.
+        modification_time (int): The modification time of the image in nanoseconds.
+        file_size (int): The size of the image in bytes.
+
+    Returns:
+        sitk.ImageFileReader: The file reader with the image information.
+    """
+    file_reader = sitk.ImageFileReader()
+    file_reader.SetFileName(image_path)
+    file_reader.ReadImageInformation()
+    return file_reader
+
+
+def get_image_header(image_path):
+    """
+    This function reads the header of an image WITHOUT loading it into memory; the headers of recently read files are cached, and the cached readers are shared, so they should not be modified.
+
+    Args:
+        image_path (str): The path to the image, or the reference to a patch inside a shard written by the patch miner.
+
+    Returns:
+        sitk.ImageFileReader: The file reader with the image information.
+    """
+    # patches inside shards written by the patch miner
+    from GANDLF.data.patch_miner.opm.patch_shards import (
+        split_shard_reference,
+        get_patch_shard_header,
+    )
+
+    shard_path, member = split_shard_reference(image_path)
+    if member is not None:
+        return get_patch_shard_header(shard_path, member)
+
+    file_stat = os.stat(image_path)
+    return _read_image_header(
+        os.path.abspath(image_path), file_stat.st_mtime_ns, file_stat.st_size
+    )
+
+
 def perform_sanity_check_on_subject(subject, parameters):
     """
     This function performs sanity check on the subject to ensure presence of consistent header information WITHOUT loading images into memory.
@@ -142,14 +188,19 @@ def perform_sanity_check_on_subject(subject, parameters):
         Returns:
             Union[sitk.ImageFileReader, sitk.Image]: The itk image or file reader.
         """
-        if subject_str_key["path"] != "":
-            file_reader = sitk.ImageFileReader()
-            file_reader.SetFileName(subject_str_key["path"])
-            file_reader.ReadImageInformation()
-            return file_reader
+        if subject_str_key.get("shard_member") is not None:
+            from GANDLF.data.patch_miner.opm.patch_shards import get_shard_reference
+
+            return get_image_header(
+                get_shard_reference(
+                    subject_str_key["path"], subject_str_key["shard_member"]
+                )
+            )
+        elif subject_str_key["path"] != "":
+            return get_image_header(subject_str_key["path"])
         else:
             # this case is required if any tensor/imaging operation has been applied in dataloader
-            file_reader = subject_str_key.as_sitk()
+            return subject_str_key.as_sitk()
 
     if len(list_for_comparison) > 1:
         for key in list_for_comparison:
@@ -1,12 +1,16 @@
 import hashlib
 import os
+import shutil
 import subprocess
-from typing import Any, Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List
 
 import torch
 
 from ..version import __version__
 from .generic import get_unique_timestamp
+from .distributed import is_main_process
 
 # these are the base keys for the model dictionary to save
 model_dict_full = {
@@ -29,6 +33,15 @@ best_model_path_end = "_best.pth.tar"
 latest_model_path_end = "_latest.pth.tar"
 initial_model_path_end = "_initial.pth.tar"
 
+# these are set during training, and are not needed to use or resume from a checkpoint
+runtime_parameter_keys = [
+    "training_data",
+    "validation_data",
+    "testing_data",
+    "subject_spacing",
+    "metric_context",
+]
+
 
 def optimize_and_save_model(model, params, path, onnx_export=True):
     """
@@ -40,6 +53,10 @@ def optimize_and_save_model(model, params, path, onnx_export=True):
         path (str): The path to save the model dictionary to.
         onnx_export (bool): Whether to export to ONNX and OpenVINO.
     """
+    # for distributed training, only the main process writes the models
+    if not is_main_process():
+        return
+
     # Check if ONNX export is enabled in the parameter dictionary
     onnx_export = params["model"].get("onnx_export", onnx_export)
 
@@ -130,6 +147,130 @@ def optimize_and_save_model(model, params, path, onnx_export=True):
                 print("WARNING: OpenVINO Model Optimizer IR conversion failed: " + e)
 
 
+@lru_cache(maxsize=None)
+def get_git_hash(cwd: str) -> str:
+    """
+    Get the git hash of the GaNDLF codebase, which is cached since it does not change during a run.
+
+    Args:
+        cwd (str): The directory to run git in.
+
+    Returns:
+        str: The git hash, or "None" if not found.
+    """
+    try:
+        return (
+            subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=cwd)
+            .decode("ascii")
+            .strip()
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return "None"
+
+
+def get_parameters_to_save(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Get the parameters to save with a model, without the data and other runtime objects of the training.
+
+    Args:
+        params (dict): The parameter dictionary.
+
+    Returns:
+        dict: A shallow copy of the parameters to save.
+    """
+    params_to_save = {
+        key: value for key, value in params.items() if key not in runtime_parameter_keys
+    }
+    previous_parameters = params_to_save.get("previous_parameters", None)
+    if previous_parameters is not None:
+        # only one level is kept, so that resumed runs do not nest all the previous parameters
+        params_to_save["previous_parameters"] = {
+            key: value
+            for key, value in previous_parameters.items()
+            if key not in runtime_parameter_keys + ["previous_parameters"]
+        }
+    return params_to_save
+
+
+def _get_model_dict_to_save(
+    model_dict: Dict[str, Any], params: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Add the metadata to the model dictionary.
+
+    Args:
+        model_dict (dict): Model dictionary to save.
+        params (dict): The parameter dictionary.
+
+    Returns:
+        dict: The model dictionary with the metadata.
+    """
+    model_dict["timestamp"] = get_unique_timestamp()
+    model_dict["timestamp_hash"] = hashlib.sha256(
+        str(model_dict["timestamp"]).encode("utf-8")
+    ).hexdigest()
+    model_dict["version"] = __version__
+    model_dict["parameters"] = get_parameters_to_save(params)
+    # this will try to encode the git hash of the current GaNDLF codebase, and reverts to "None" if not found
+    model_dict["git_hash"] = get_git_hash(os.getcwd())
+    return model_dict
+
+
+def _copy_to_cpu(value: Any) -> Any:
+    """
+    Copy the tensors (and the containers holding them) to the cpu, so that the copy does not change with the training.
+
+    Args:
+        value (Any): The value to copy.
+
+    Returns:
+        Any: The copy.
+    """
+    if torch.is_tensor(value):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        copied = type(value)((key, _copy_to_cpu(item)) for key, item in value.items())
+        # the state dictionaries keep the versions of the modules here
+        if hasattr(value, "_metadata"):
+            copied._metadata = value._metadata
+        return copied
+    if isinstance(value, (list, tuple)):
+        return type(value)(_copy_to_cpu(item) for item in value)
+    return value
+
+
+def _save_atomically(model_dict: Dict[str, Any], path: str):
+    """
+    Save the model dictionary to a temporary file that is renamed to the path, so that the path never holds a partial file.
+
+    Args:
+        model_dict (dict): Model dictionary to save.
+        path (str): The path to save the model dictionary to.
+    """
+    temp_path = path + ".tmp"
+    torch.save(model_dict, temp_path)
+    os.replace(temp_path, path)
+
+
+def _link_atomically(source_path: str, path: str):
+    """
+    Hard-link (or copy, if linking is not possible) a saved model to another path.
+
+    Args:
+        source_path (str): The path of the saved model.
+        path (str): The path of the link.
+    """
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        shutil.copyfile(source_path, temp_path)
+    # the files are always replaced and never written in-place, so the links never change each other
+    os.replace(temp_path, path)
+
+
 def save_model(
     model_dict: Dict[str, Any],
     model: torch.nn.Module,
@@ -147,29 +288,82 @@ def save_model(
         path (str): The path to save the model dictionary to.
         onnx_export (bool): Whether to export to ONNX and OpenVINO.
     """
-    model_dict["timestamp"] = get_unique_timestamp()
-    model_dict["timestamp_hash"] = hashlib.sha256(
-        str(model_dict["timestamp"]).encode("utf-8")
-    ).hexdigest()
-    model_dict["version"] = __version__
-    model_dict["parameters"] = params
-
-    try:
-        # this will try to encode the git hash of the current GaNDLF codebase, and reverts to "None" if not found
-        model_dict["git_hash"] = (
-            subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.getcwd())
-            .decode("ascii")
-            .strip()
-        )
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        model_dict["git_hash"] = "None"
+    # for distributed training, only the main process writes the models
+    if not is_main_process():
+        return
 
-    torch.save(model_dict, path)
+    _save_atomically(_get_model_dict_to_save(model_dict, params), path)
 
     # post-training optimization
     optimize_and_save_model(model, params, path, onnx_export=onnx_export)
 
 
+class CheckpointWriter:
+    def __init__(self):
+        """
+        Writer of the checkpoints during training, which saves them in a background thread so that the training continues while they are written.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        # the git hash is looked up once at the start, instead of for every checkpoint
+        get_git_hash(os.getcwd())
+
+    def save(
+        self,
+        model_dict: Dict[str, Any],
+        model: torch.nn.Module,
+        params: Dict[str, Any],
+        paths: List[str],
+        onnx_export: bool = False,
+    ):
+        """
+        Save the model dictionary to several paths, serializing it only once; the first path is written and the others are linked to it.
+
+        Args:
+            model_dict (dict): Model dictionary to save.
+            model (torch.nn.Module): Trained torch model.
+            params (dict): The parameter dictionary.
+            paths (list): The paths to save the model dictionary to.
+            onnx_export (bool): Whether to export to ONNX and OpenVINO.
+        """
+        # for distributed training, only the main process writes the models
+        if not is_main_process():
+            return
+
+        # at most one checkpoint is written at a time, which also surfaces any error of the previous one
+        self.wait()
+        # the copy is taken now, since the training changes the model while it is written
+        model_dict = _copy_to_cpu(_get_model_dict_to_save(model_dict, params))
+        self._pending = self._executor.submit(self._write, model_dict, list(paths))
+
+        # post-training optimization
+        for path in paths:
+            optimize_and_save_model(model, params, path, onnx_export=onnx_export)
+
+    @staticmethod
+    def _write(model_dict: Dict[str, Any], paths: List[str]):
+        _save_atomically(model_dict, paths[0])
+        for path in paths[1:]:
+            _link_atomically(paths[0], path)
+
+    def wait(self):
+        """
+        Wait for the checkpoint that is being written.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self):
+        """
+        Wait for the checkpoint that is being written and stop the background thread.
+        """
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+
 def load_model(
     path: str, device: torch.device, full_sanity_check: bool = True
 ) -> Dict[str, Any]:
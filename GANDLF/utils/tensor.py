@@ -1,7 +1,9 @@
 import os, sys
+from functools import lru_cache
 from typing import Union
 from pandas.util import hash_pandas_object
 import numpy as np
+import psutil
 import SimpleITK as sitk
 import torch
 import torch.nn as nn
@@ -10,11 +12,54 @@ import torchio
 from tqdm import tqdm
 from torchinfo import summary
 from GANDLF.utils.generic import get_array_from_image_or_tensor
+from GANDLF.utils.distributed import (
+    is_distributed,
+    get_rank,
+    get_world_size,
+    get_local_rank,
+)
 
 # global definition for both one_hot and reverse_one_hot
 special_cases_to_check = ["||"]
 
 
+@lru_cache(maxsize=None)
+def _get_class_lookup(class_list):
+    """
+    This function precompiles the lookup tables used by one_hot and reverse_one_hot from the class list, so that compound classes are only parsed once.
+
+    Args:
+        class_list (tuple): The classes based on which one-hot encoding needs to happen.
+
+    Returns:
+        tuple: The label values of each class.
+        bool: Whether every class is a single label value.
+        numpy.array: The value written into the final mask for each class by reverse_one_hot.
+    """
+    # this implementation allows users to combine logical operands
+    values_per_class = []
+    special_case_detected = False
+    for _class in class_list:
+        values = [_class]
+        if isinstance(_class, str):
+            for case in special_cases_to_check:
+                if case in _class:
+                    special_case_detected = True
+                    values = _class.split(case)
+        values_per_class.append(tuple(int(value) for value in values))
+    single_valued = all(len(values) == 1 for values in values_per_class)
+
+    if special_case_detected:
+        # for special case, use the index as value, and do not use '0' if it is absent
+        output_values = np.arange(len(class_list))
+        if not any((_class == "0") or (_class == 0) for _class in class_list):
+            output_values += 1
+    else:
+        output_values = np.array([int(_class) for _class in class_list])
+
+    return tuple(values_per_class), single_valued, output_values.astype(np.int16)
+
+
 def one_hot(segmask_tensor, class_list):
     """
     This function creates a one-hot-encoded mask from the segmentation mask Tensor and specified class list
@@ -26,56 +71,30 @@ def one_hot(segmask_tensor, class_list):
     Returns:
         torch.Tensor: The one-hot encoded torch.Tensor
     """
-    batch_size = segmask_tensor.shape[0]
-
-    def_shape = segmask_tensor.shape
-    if len(def_shape) == 4:
-        # special case for sdnet
-        batch_stack = torch.zeros(
-            def_shape[0],
-            len(class_list),
-            def_shape[2],
-            def_shape[3],
-            dtype=torch.float32,
-            device=segmask_tensor.device,
-        )
-    else:
-        batch_stack = torch.zeros(
-            def_shape[0],
-            len(class_list),
-            def_shape[2],
-            def_shape[3],
-            def_shape[4],
-            dtype=torch.float32,
-            device=segmask_tensor.device,
-        )
-
-    for b in range(batch_size):
-        # since the input tensor is 5D, with [batch_size, modality, x, y, z], we do not need to consider the modality dimension for labels
-        segmask_array_iter = segmask_tensor[b, 0, ...]
-        bin_mask = segmask_array_iter == 0  # initialize bin_mask
-
-        # this implementation allows users to combine logical operands
-        class_idx = 0
-        for _class in class_list:
-            if isinstance(_class, str):
-                for case in special_cases_to_check:
-                    if case in _class:
-                        special_class_split = _class.split(case)
-                        bin_mask = segmask_array_iter == int(special_class_split[0])
-                        for i in range(1, len(special_class_split)):
-                            bin_mask = torch.logical_or(
-                                bin_mask,
-                                (segmask_array_iter == int(special_class_split[i])),
-                            )
-                    else:
-                        # assume that it is a simple int
-                        bin_mask = segmask_array_iter == int(_class)
-            else:
-                bin_mask = segmask_array_iter == int(_class)
-            # we always ensure the append happens in dim 0
-            batch_stack[b, class_idx, ...] = bin_mask.long().unsqueeze(0)
-            class_idx += 1
+    values_per_class, single_valued, _ = _get_class_lookup(tuple(class_list))
+
+    # since the input tensor is [batch_size, modality, x, y, (z)], we do not need to consider the modality dimension for labels
+    segmask_array = segmask_tensor[:, 0, ...]
+
+    if single_valued:
+        # compare all voxels of the batch against all classes at once
+        class_values = torch.tensor(
+            [values[0] for values in values_per_class], device=segmask_array.device
+        ).view(1, -1, *([1] * (segmask_array.dim() - 1)))
+        return (segmask_array.unsqueeze(1) == class_values).to(torch.float32)
+
+    batch_stack = torch.empty(
+        segmask_array.shape[0],
+        len(values_per_class),
+        *segmask_array.shape[1:],
+        dtype=torch.float32,
+        device=segmask_array.device,
+    )
+    for class_idx, values in enumerate(values_per_class):
+        bin_mask = segmask_array == values[0]
+        for value in values[1:]:
+            bin_mask |= segmask_array == value
+        batch_stack[:, class_idx, ...] = bin_mask
 
     return batch_stack
 
@@ -91,35 +110,12 @@ def reverse_one_hot(predmask_tensor, class_list):
     Returns:
         numpy.array: The final mask as numpy array.
     """
+    _, _, output_values = _get_class_lookup(tuple(class_list))
     predmask_array = get_array_from_image_or_tensor(predmask_tensor)
-    special_case_detected = False
-
-    for _class in class_list:
-        for case in special_cases_to_check:
-            if isinstance(_class, str):
-                if case in _class:  # check if any of the special cases are present
-                    special_case_detected = True
-                    break
 
     final_mask = np.zeros(predmask_array[0, ...].shape).astype(np.int16)
     predmask_array_bool = predmask_array >= 0.5
-
-    # for special case, do not use '0' to initialize any value in final_mask in case it is absent
-    zero_present = False
-    if special_case_detected:
-        for _class in class_list:
-            if (_class == "0") or (_class == 0):
-                zero_present = True
-                break
-    for idx, i in enumerate(class_list):
-        output_value = i
-        # for special case, use the index as value
-        if special_case_detected:
-            output_value = idx
-            # if zero is not present, then don't use '0' as output value
-            if not (zero_present):
-                output_value += 1
-
+    for idx, output_value in enumerate(output_values):
         final_mask[predmask_array_bool[idx, ...]] = output_value
 
     return final_mask
@@ -140,7 +136,31 @@ def send_model_to_device(model, amp, device, optimizer):
         bool: Whether automatic mixed precision is to be used or not.
         torch.device: Device type.
     """
-    if device == "cuda":
+    if is_distributed():
+        # one process per device, launched with torchrun
+        if device == "cuda":
+            local_rank = get_local_rank()
+            torch.cuda.set_device(local_rank)
+            dev = str(local_rank)
+            device = torch.device("cuda", local_rank)
+            model = nn.parallel.DistributedDataParallel(
+                model.to(device), device_ids=[local_rank], output_device=local_rank
+            )
+            if not (optimizer is None):
+                # ensuring optimizer is in correct device - https://github.com/pytorch/pytorch/issues/8741
+                optimizer.load_state_dict(optimizer.state_dict())
+        else:
+            dev = -1
+            device = torch.device("cpu")
+            model = nn.parallel.DistributedDataParallel(model.cpu())
+            amp = False
+            print("Since Device is CPU, Mixed Precision Training is set to False")
+        print(
+            "Distributed training on rank %d of %d, device: %s"
+            % (get_rank(), get_world_size(), device)
+        )
+
+    elif device == "cuda":
         if os.environ.get("CUDA_VISIBLE_DEVICES") is None:
             sys.exit(
                 "Please set the environment variable 'CUDA_VISIBLE_DEVICES' correctly before trying to run GANDLF on GPU"
@@ -227,7 +247,7 @@ def get_model_dict(model, device_id):
     if isinstance(device_id, str):
         if "," in device_id:
             multi_gpu_flag = True
-    if multi_gpu_flag:
+    if multi_gpu_flag or isinstance(model, nn.parallel.DistributedDataParallel):
         model_dict = model.module.state_dict()
     else:
         model_dict = model.state_dict()
@@ -392,14 +412,23 @@ def get_class_imbalance_weights(training_df, params):
                 ) = get_class_imbalance_weights_classification(training_df, params)
             elif params["problem_type"] == "segmentation":
                 # Set up the dataloader for penalty calculation
-                from GANDLF.data.ImagesFromDataFrame import ImagesFromDataFrame
-
-                penalty_data = ImagesFromDataFrame(
-                    training_df,
-                    parameters=params,
-                    train=False,
-                    loader_type="penalty",
-                )
+                if params["wsi_patch_sampling"]:
+                    from GANDLF.data.training_dataloader_histopath import (
+                        get_train_wsi_patch_dataset,
+                    )
+
+                    penalty_data = get_train_wsi_patch_dataset(
+                        training_df, params, train=False
+                    )
+                else:
+                    from GANDLF.data.ImagesFromDataFrame import ImagesFromDataFrame
+
+                    penalty_data = ImagesFromDataFrame(
+                        training_df,
+                        parameters=params,
+                        train=False,
+                        loader_type="penalty",
+                    )
 
                 penalty_loader = DataLoader(
                     penalty_data,
@@ -476,6 +505,41 @@ def print_model_summary(
         print("Failed to generate model summary with error: ", e)
 
 
+def get_inference_batch_size(params, num_patches):
+    """
+    This function determines the number of patches that are stacked together for a single forward pass during patch-based inference.
+
+    Args:
+        params (dict): The parameters passed by the user yaml.
+        num_patches (int): The total number of patches that need to be processed for the current subject.
+
+    Returns:
+        int: The batch size to use for patch-based inference.
+    """
+    # openvino models are exported with a fixed batch size of 1
+    if params["model"]["type"] != "torch":
+        return 1
+
+    batch_size = params["inference_mechanism"].get("batch_size", 1)
+    if isinstance(batch_size, str) and batch_size.lower() == "auto":
+        device = torch.device(params["device"])
+        if device.type == "cuda":
+            available_memory = torch.cuda.mem_get_info(device)[0]
+        else:
+            available_memory = psutil.virtual_memory().available
+        # this is a conservative estimate of the memory needed for a single patch during inference
+        # (largest intermediate feature maps + input/output), keeping half of the available memory as a buffer
+        bytes_per_voxel = 4 * (
+            params["model"]["num_channels"]
+            + params["model"].get("num_classes", 1)
+            + 4 * params["model"].get("base_filters", 32)
+        )
+        bytes_per_patch = int(np.prod(params["patch_size"])) * bytes_per_voxel
+        batch_size = int(0.5 * available_memory // bytes_per_patch)
+
+    return int(max(1, min(int(batch_size), num_patches)))
+
+
 def get_ground_truths_and_predictions_tensor(params, loader_type):
     """
     This function is used to get the ground truths and predictions for a given loader type.
@@ -0,0 +1,110 @@
+"""
+Benchmark of the one-hot encoding of segmentation masks with the previous loop over the samples and classes, and with the
+vectorized one_hot, as done by the loss and metric calculations; the outputs of both are checked to be equal.
+
+Usage:
+    python testing/benchmark_one_hot.py --device cuda --repeats 50
+"""
+import argparse, time
+import torch
+
+from GANDLF.utils import one_hot
+
+
+def one_hot_with_per_class_loop(segmask_tensor, class_list):
+    """
+    Function with the previous implementation of one_hot, which loops over the samples and classes.
+
+    Args:
+        segmask_tensor (torch.Tensor): The segmentation mask Tensor.
+        class_list (list): The list of classes based on which one-hot encoding needs to happen.
+
+    Returns:
+        torch.Tensor: The one-hot encoded torch.Tensor
+    """
+    batch_stack = torch.zeros(
+        segmask_tensor.shape[0],
+        len(class_list),
+        *segmask_tensor.shape[2:],
+        dtype=torch.float32,
+        device=segmask_tensor.device,
+    )
+    for b in range(segmask_tensor.shape[0]):
+        segmask_array_iter = segmask_tensor[b, 0, ...]
+        for class_idx, _class in enumerate(class_list):
+            if isinstance(_class, str) and "||" in _class:
+                special_class_split = _class.split("||")
+                bin_mask = segmask_array_iter == int(special_class_split[0])
+                for i in range(1, len(special_class_split)):
+                    bin_mask = torch.logical_or(
+                        bin_mask, (segmask_array_iter == int(special_class_split[i]))
+                    )
+            else:
+                bin_mask = segmask_array_iter == int(_class)
+            batch_stack[b, class_idx, ...] = bin_mask.long().unsqueeze(0)
+    return batch_stack
+
+
+def time_function(function, segmask, class_list, repeats, device):
+    """
+    Function to time the encodings of a batch.
+
+    Args:
+        function (Callable): The one-hot encoding function.
+        segmask (torch.Tensor): The batch of segmentation masks.
+        class_list (list): The list of classes.
+        repeats (int): The number of timed encodings.
+        device (str): The device of the batch.
+
+    Returns:
+        float: The encodings per second.
+    """
+    # the first encoding warms up the allocator and kernels
+    function(segmask, class_list)
+    if "cuda" in device:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(segmask, class_list)
+    if "cuda" in device:
+        torch.cuda.synchronize()
+    return repeats / (time.perf_counter() - start)
+
+
+def benchmark(args):
+    """
+    Function to compare the previous and vectorized one-hot encodings of a batch of 3D masks.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    torch.manual_seed(0)
+    shape = (args.batch_size, 1) + (args.patch_size,) * 3
+    segmask = torch.randint(5, size=shape, device=args.device).to(torch.float16)
+    for class_list in [[0, 1, 2, 3, 4], ["0", "1||2||3", 4]]:
+        assert torch.equal(
+            one_hot(segmask, class_list),
+            one_hot_with_per_class_loop(segmask, class_list),
+        ), "The encodings should be equal"
+        results = {}
+        for name, function in [
+            ("loop (before)", one_hot_with_per_class_loop),
+            ("vectorized (after)", one_hot),
+        ]:
+            results[name] = time_function(
+                function, segmask, class_list, args.repeats, args.device
+            )
+            print(f"{class_list} {name}: {results[name]:.2f} batches/sec")
+        speedup = results["vectorized (after)"] / results["loop (before)"]
+        print(f"{class_list} speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the one-hot encoding of segmentation masks."
+    )
+    parser.add_argument("--device", default="cuda", help="cuda or cpu")
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--patch_size", type=int, default=64)
+    benchmark(parser.parse_args())
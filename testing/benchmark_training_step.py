@@ -0,0 +1,140 @@
+"""
+Benchmark of the training steps per second when the loss and metrics of every step are copied to the host and the nan
+check synchronizes before the backward pass, as was done before, and when they are accumulated on the device and the nan
+flag is only checked at the optimizer step, as done by train_network.
+
+Usage:
+    python testing/benchmark_training_step.py --device cuda --steps 200
+"""
+import argparse, os, time
+import torch
+
+from GANDLF.parseConfig import parseConfig
+from GANDLF.compute.step import step
+from GANDLF.compute.training_loop import forward_and_backward, get_metrics_on_host
+
+
+def get_parameters(device, metrics):
+    """
+    Function to get the parameters of a 2D segmentation with two classes.
+
+    Args:
+        device (str): The device to run on.
+        metrics (list): The metrics to compute in every step.
+
+    Returns:
+        dict: The parameters.
+    """
+    params = parseConfig(
+        os.path.join(os.path.dirname(__file__), "config_segmentation.yaml"),
+        version_check_flag=False,
+    )
+    params["device"] = device
+    params["verbose"] = False
+    params["problem_type"] = "segmentation"
+    params["weights"] = None
+    params["metrics"] = metrics
+    params["subject_spacing"] = None
+    params["model"].update(
+        {
+            "dimension": 2,
+            "amp": False,
+            "type": "torch",
+            "architecture": "benchmark",
+            "class_list": [0, 1],
+            "num_classes": 2,
+            "ignore_label_validation": None,
+        }
+    )
+    return params
+
+
+def run_epoch(model, optimizer, images, labels, params, on_device):
+    """
+    Function to run the training steps of an epoch, and to accumulate the loss and metrics.
+
+    Args:
+        model (torch.nn.Module): The model.
+        optimizer (torch.optim.Optimizer): The optimizer.
+        images (list): The input images of every step, on the device.
+        labels (list): The labels of every step, on the device.
+        params (dict): The parameters.
+        on_device (bool): Whether the loss and metrics are accumulated on the device.
+
+    Returns:
+        float, dict: The total loss and metrics of the epoch.
+    """
+    total_loss, total_metrics = 0, {metric: 0 for metric in params["metrics"]}
+    for image, label in zip(images, labels):
+        if on_device:
+            # as in train_network, the nan flag stays on the device until the optimizer step
+            loss, metrics, _, nan_loss = forward_and_backward(
+                model, image, label, params, torch.Tensor.backward
+            )
+            if not nan_loss:
+                optimizer.step()
+        else:
+            loss, metrics, _, _ = step(model, image, label, params)
+            if not torch.isnan(loss):
+                loss.backward()
+                optimizer.step()
+        optimizer.zero_grad()
+        loss = loss.detach()
+        if on_device:
+            total_loss += torch.where(torch.isnan(loss), 0.0, loss.float())
+        else:
+            total_loss += loss.cpu().item()
+        for metric, value in metrics.items():
+            total_metrics[metric] += value
+    return float(total_loss), get_metrics_on_host(total_metrics)
+
+
+def benchmark(args):
+    """
+    Function to time the epochs that accumulate the loss and metrics on the host and on the device.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    params = get_parameters(args.device, args.metrics)
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 16, 3, padding=1),
+        torch.nn.ReLU(),
+        torch.nn.Conv2d(16, 2, 3, padding=1),
+        torch.nn.Softmax(dim=1),
+    ).to(args.device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    shape = (args.batch_size, 3, args.patch_size, args.patch_size, 1)
+    images = [torch.rand(shape, device=args.device) for _ in range(args.steps)]
+    labels = [
+        (torch.rand(shape, device=args.device)[:, :1] > 0.5).float()
+        for _ in range(args.steps)
+    ]
+
+    results = {}
+    for name, on_device in [("host (before)", False), ("device (after)", True)]:
+        # the first epoch warms up the allocator and kernels
+        run_epoch(model, optimizer, images, labels, params, on_device)
+        if "cuda" in args.device:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        run_epoch(model, optimizer, images, labels, params, on_device)
+        if "cuda" in args.device:
+            torch.cuda.synchronize()
+        results[name] = args.steps / (time.perf_counter() - start)
+        print(f"Accumulation on the {name}: {results[name]:.2f} steps/sec")
+    speedup = results["device (after)"] / results["host (before)"]
+    print(f"Speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the accumulation of the training loss and metrics."
+    )
+    parser.add_argument("--device", default="cuda", help="cuda or cpu")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--patch_size", type=int, default=128)
+    parser.add_argument("--metrics", nargs="+", default=["dice"])
+    benchmark(parser.parse_args())
@@ -8,6 +8,13 @@ from pydicom.data import get_testdata_file
 import cv2
 
 from GANDLF.data.ImagesFromDataFrame import ImagesFromDataFrame
+from GANDLF.data import (
+    get_train_loader,
+    get_dataloader_kwargs,
+    BatchPrefetcher,
+    TrainingBatchCollator,
+)
+from GANDLF.data.training_dataloader_histopath import get_train_wsi_patch_dataset
 from GANDLF.utils import *
 from GANDLF.utils import parseTestingCSV, get_tensor_from_image
 from GANDLF.data.preprocessing import global_preprocessing_dict
@@ -18,6 +25,9 @@ from GANDLF.data.patch_miner.opm.utils import (
     get_nonzero_percent,
     get_patch_size_in_microns,
     convert_to_tiff,
+    patch_artifact_check,
+    patch_artifact_check_batch,
+    tissue_mask,
 )
 from GANDLF.parseConfig import parseConfig
 from GANDLF.training_manager import TrainingManager
@@ -308,6 +318,7 @@ def test_train_segmentation_sdnet_rad_2d(device):
     parameters["model"]["architecture"] = "sdnet"
     parameters["model"]["onnx_export"] = False
     parameters["model"]["print_summary"] = False
+    parameters["subject_construction_num_workers"] = 1
     parameters = populate_header_in_parameters(
         parameters, parameters["headers"]
     )
@@ -1228,6 +1239,7 @@ def test_train_metrics_segmentation_rad_2d(device):
     file_config_temp = write_temp_config_path(parameters)
 
     parameters = parseConfig(file_config_temp, version_check_flag=False)
+    parameters["metrics"]["hausdorff95"]["bbox"] = False
     training_data, parameters["headers"] = parseTrainingCSV(
         inputDir + "/train_2d_rad_segmentation.csv"
     )
@@ -1249,6 +1261,66 @@ def test_train_metrics_segmentation_rad_2d(device):
     print("passed")
 
 
+def test_generic_surface_distance_bbox_parity():
+    print("21.1: Starting testing surface distance metrics in the bounding box")
+    from GANDLF.metrics.segmentation import (
+        hd95_per_label,
+        hd100_per_label,
+        nsd_per_label,
+    )
+
+    np.random.seed(0)
+    shape = (24, 20, 16)
+    masks_pred, masks_target = [], []
+    # random masks that are sparse, dense, and restricted to a small region
+    for threshold in [0.9, 0.5]:
+        masks_pred.append(np.random.rand(*shape) > threshold)
+        masks_target.append(np.random.rand(*shape) > threshold)
+    mask_pred, mask_target = np.zeros(shape, bool), np.zeros(shape, bool)
+    mask_pred[5:12, 6:10, 4:9] = np.random.rand(7, 4, 5) > 0.3
+    mask_target[8:15, 3:9, 7:12] = np.random.rand(7, 6, 5) > 0.3
+    masks_pred.append(mask_pred)
+    masks_target.append(mask_target)
+    # masks that touch the border along every axis
+    mask_pred, mask_target = np.zeros(shape, bool), np.zeros(shape, bool)
+    mask_pred[:6, :5, :4] = True
+    mask_pred[-3:, 7:, -2:] = True
+    mask_target[:4, -6:, 3:] = True
+    mask_target[-1, :, 0] = True
+    masks_pred.append(mask_pred)
+    masks_target.append(mask_target)
+    # empty prediction, empty target, and both empty
+    masks_pred += [np.zeros(shape, bool), mask_pred, np.zeros(shape, bool)]
+    masks_target += [mask_target, np.zeros(shape, bool), np.zeros(shape, bool)]
+
+    def get_one_hot(masks):
+        masks = torch.from_numpy(np.stack(masks)).float().unsqueeze(1)
+        return torch.cat([1 - masks, masks], dim=1)
+
+    inp, target = get_one_hot(masks_pred), get_one_hot(masks_target)
+    for spacing in [[1.0, 1.0, 1.0], [0.5, 1.5, 2.0]]:
+        results = {}
+        for bbox in [True, False]:
+            parameters = {
+                "model": {"num_classes": 2, "ignore_label_validation": None},
+                "subject_spacing": torch.tensor([spacing] * len(masks_pred)),
+                "metrics": {
+                    metric: {"connectivity": 1, "threshold": None, "bbox": bbox}
+                    for metric in ["hausdorff95", "normalized_surface_dice"]
+                },
+            }
+            results[bbox] = [
+                metric(inp, target, parameters)
+                for metric in [hd95_per_label, hd100_per_label, nsd_per_label]
+            ]
+        for result_bbox, result_full in zip(results[True], results[False]):
+            assert torch.allclose(
+                result_bbox.double(), result_full.double()
+            ), "Surface distance metrics should not change in the bounding box"
+
+    print("passed")
+
+
 def test_train_metrics_regression_rad_2d(device):
     print("22: Starting 2D Rad regression tests for metrics")
     # read and parse csv
@@ -1346,6 +1418,46 @@ def test_train_losses_segmentation_rad_2d(device):
     print("passed")
 
 
+def test_generic_metrics_on_device():
+    print("23.5: Starting testing of the metrics kept on the device")
+    from GANDLF.compute.loss_and_metric import get_metric_output
+    from GANDLF.compute.training_loop import get_metrics_on_host
+
+    predicted, ground_truth = torch.tensor([1.0, 0.0]), torch.tensor([1.0, 1.0])
+
+    def accuracy(predicted, ground_truth, params):
+        return (predicted == ground_truth).float().mean()
+
+    def accuracy_per_label(predicted, ground_truth, params):
+        return (predicted == ground_truth).float()
+
+    # the metrics are only converted to numbers when requested
+    metric = get_metric_output(accuracy, predicted, ground_truth, {}, to_host=False)
+    assert torch.is_tensor(metric), "Metric should be kept as a tensor"
+    assert get_metric_output(accuracy, predicted, ground_truth, {}) == 0.5
+    assert get_metric_output(accuracy_per_label, predicted, ground_truth, {}) == [
+        1.0,
+        0.0,
+    ]
+
+    # the accumulated metrics are copied in the same format as the metrics on the host
+    host_metrics = get_metrics_on_host(
+        {
+            "accuracy": metric * 2,
+            "accuracy_per_label": get_metric_output(
+                accuracy_per_label, predicted, ground_truth, {}, to_host=False
+            ),
+            "missing": 0,
+        }
+    )
+    assert host_metrics["accuracy"] == 1.0
+    assert isinstance(host_metrics["accuracy_per_label"], np.ndarray)
+    assert host_metrics["accuracy_per_label"].tolist() == [1.0, 0.0]
+    assert host_metrics["missing"] == 0
+
+    print("passed")
+
+
 def test_generic_config_read():
     print("24: Starting testing reading configuration")
     parameters = parseConfig(
@@ -1644,6 +1756,12 @@ def test_dataloader_construction_train_segmentation_3d(device):
     parameters["data_postprocessing"]["mapping"] = {0: 0, 1: 1}
     parameters["data_postprocessing"]["fill_holes"] = True
     parameters["data_postprocessing"]["cca"] = True
+    parameters["inference_mechanism"]["batch_size"] = "auto"
+    parameters["inference_mechanism"]["num_workers"] = 1
+    parameters["cache_dir"] = os.path.join(outputDir, "subject_cache")
+    parameters["pin_memory_dataloader"] = True
+    parameters["num_workers_dataloader"] = 1
+    parameters["persistent_workers_dataloader"] = True
     parameters = populate_header_in_parameters(
         parameters, parameters["headers"]
     )
@@ -1663,6 +1781,208 @@ def test_dataloader_construction_train_segmentation_3d(device):
     print("passed")
 
 
+def test_inference_batched_grid_segmentation_rad_2d(device, monkeypatch):
+    print("27.1: Starting 2D Rad segmentation tests for batched grid inference")
+    import torchio
+
+    parameters = parseConfig(
+        testingDir + "/config_segmentation.yaml", version_check_flag=False
+    )
+    training_data, parameters["headers"] = parseTrainingCSV(
+        inputDir + "/train_2d_rad_segmentation.csv"
+    )
+    parameters["patch_size"] = patch_size["2D"]
+    parameters["modality"] = "rad"
+    parameters["model"]["dimension"] = 2
+    parameters["model"]["class_list"] = [0, 255]
+    parameters["model"]["amp"] = False
+    parameters["save_output"] = True
+    parameters["model"]["num_channels"] = 3
+    parameters["metrics"] = ["dice"]
+    parameters["model"]["architecture"] = "unet"
+    parameters["model"]["onnx_export"] = False
+    parameters["model"]["print_summary"] = False
+    parameters = populate_header_in_parameters(
+        parameters, parameters["headers"]
+    )
+    sanitize_outputDir()
+    TrainingManager(
+        dataframe=training_data,
+        outputDir=outputDir,
+        parameters=parameters,
+        device=device,
+        resume=False,
+        reset=True,
+    )
+
+    # overlapping patches, so that a 256x256 image has 9 patches that do not fill the last batch
+    parameters["inference_mechanism"]["patch_overlap"] = 64
+    parameters["inference_mechanism"]["grid_aggregator_overlap"] = "average"
+    parameters["model"]["type"] = "torch"
+    assert (
+        1 < get_inference_batch_size(dict(parameters, device=device), 9) <= 9
+    ), "Automatic inference batch size should stack several patches"
+
+    # record the aggregated output of every subject
+    aggregated_outputs = {}
+    get_output_tensor = torchio.inference.GridAggregator.get_output_tensor
+
+    def record_output_tensor(self):
+        output = get_output_tensor(self)
+        aggregated_outputs[batch_size].append(output.clone())
+        return output
+
+    monkeypatch.setattr(
+        torchio.inference.GridAggregator, "get_output_tensor", record_output_tensor
+    )
+    for batch_size in [1, 4, "auto"]:
+        aggregated_outputs[batch_size] = []
+        parameters["inference_mechanism"]["batch_size"] = batch_size
+        InferenceManager(
+            dataframe=training_data,
+            modelDir=outputDir,
+            parameters=parameters,
+            device=device,
+            outputDir=os.path.join(outputDir, "inference_" + str(batch_size)),
+        )
+    assert len(aggregated_outputs[1]) == len(
+        training_data
+    ), "Every subject should be aggregated"
+    for batch_size in [4, "auto"]:
+        assert len(aggregated_outputs[batch_size]) == len(aggregated_outputs[1])
+        for output, output_reference in zip(
+            aggregated_outputs[batch_size], aggregated_outputs[1]
+        ):
+            assert torch.allclose(
+                output, output_reference, atol=1e-5
+            ), "Batched grid inference should match inference with a batch size of 1"
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def test_generic_subject_cache(monkeypatch):
+    print("27.2: Starting testing the subject cache")
+    import sys
+
+    sanitize_outputDir()
+    # copy the images, so that their modification time can be changed
+    cache_data_dir = os.path.join(outputDir, "cache_data")
+    input_df = pd.read_csv(inputDir + "/train_2d_rad_segmentation.csv").head(2)
+    for index, row in input_df.iterrows():
+        subject_dir = os.path.join(cache_data_dir, str(row["SubjectID"]))
+        Path(subject_dir).mkdir(parents=True, exist_ok=True)
+        for column in ["Channel_0", "Label"]:
+            input_df.loc[index, column] = shutil.copy(row[column], subject_dir)
+    file_data = os.path.join(cache_data_dir, "data.csv")
+    input_df.to_csv(file_data, index=False)
+
+    parameters = parseConfig(
+        testingDir + "/config_segmentation.yaml", version_check_flag=False
+    )
+    training_data, parameters["headers"] = parseTrainingCSV(file_data)
+    parameters["patch_size"] = patch_size["2D"]
+    parameters["model"]["dimension"] = 2
+    parameters["data_preprocessing"] = {"normalize": None}
+    parameters = populate_header_in_parameters(
+        parameters, parameters["headers"]
+    )
+    parameters_cache = copy.deepcopy(parameters)
+    parameters_cache["cache_dir"] = os.path.join(outputDir, "subject_cache")
+    channel_key = str(parameters["headers"]["channelHeaders"][0])
+
+    def get_cache_entries():
+        # temporary directories of partially written subjects start with "."
+        return set(
+            entry
+            for entry in os.listdir(parameters_cache["cache_dir"])
+            if not entry.startswith(".")
+        )
+
+    def get_images(subjects):
+        return [
+            [subject[key]["data"] for key in [channel_key, "label"]]
+            for subject in subjects
+        ]
+
+    def assert_images_equal(images, images_reference, message):
+        for subject_images, subject_images_reference in zip(images, images_reference):
+            for image, image_reference in zip(subject_images, subject_images_reference):
+                assert torch.allclose(image.float(), image_reference.float()), message
+
+    images_reference = get_images(
+        ImagesFromDataFrame(training_data, parameters, train=False)
+    )
+    images = get_images(
+        ImagesFromDataFrame(training_data, parameters_cache, train=False)
+    )
+    assert_images_equal(
+        images, images_reference, "Cached subjects should match the uncached subjects"
+    )
+    cache_entries = get_cache_entries()
+    assert len(cache_entries) == len(training_data), "Every subject should be cached"
+
+    # the second call loads all subjects from the cache, without caching them again
+    def save_subject_to_cache_disabled(*args, **kwargs):
+        raise AssertionError("Cached subjects should not be cached again")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(
+            sys.modules[ImagesFromDataFrame.__module__],
+            "save_subject_to_cache",
+            save_subject_to_cache_disabled,
+        )
+        images_cached = get_images(
+            ImagesFromDataFrame(training_data, parameters_cache, train=False)
+        )
+    for subject_images, subject_images_cached in zip(images, images_cached):
+        for image, image_cached in zip(subject_images, subject_images_cached):
+            assert torch.equal(
+                image, image_cached
+            ), "Subjects loaded from the cache should be identical"
+    assert get_cache_entries() == cache_entries, "No new entry should be cached"
+
+    # modifying an image only invalidates the entry of its subject
+    image_file = input_df["Channel_0"].iloc[0]
+    file_stat = os.stat(image_file)
+    os.utime(
+        image_file, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 10**9)
+    )
+    images = get_images(
+        ImagesFromDataFrame(training_data, parameters_cache, train=False)
+    )
+    assert_images_equal(
+        images,
+        images_reference,
+        "Re-cached subjects should match the uncached subjects",
+    )
+    assert (
+        len(get_cache_entries() - cache_entries) == 1
+    ), "The subject with a modified image should be cached again"
+    cache_entries = get_cache_entries()
+
+    # changing the pre-processing invalidates the entries of all subjects
+    parameters["data_preprocessing"] = {}
+    parameters_cache["data_preprocessing"] = {}
+    images_reference = get_images(
+        ImagesFromDataFrame(training_data, parameters, train=False)
+    )
+    images = get_images(
+        ImagesFromDataFrame(training_data, parameters_cache, train=False)
+    )
+    assert_images_equal(
+        images, images_reference, "Cached subjects should use the new pre-processing"
+    )
+    assert len(get_cache_entries() - cache_entries) == len(
+        training_data
+    ), "All subjects should be cached again when the pre-processing changes"
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
 def test_generic_preprocess_functions():
     print("28: Starting testing preprocessing functions")
     # initialize an input which has values between [-1,1]
@@ -1908,6 +2228,79 @@ def test_generic_preprocess_functions():
     temp_filename_tiff = convert_to_tiff(temp_filename, outputDir)
     assert os.path.exists(temp_filename_tiff), "Tiff file should be created"
 
+    # tests for histology patch artifact check
+    input_patches = np.random.randint(0, 256, size=(4, 32, 32, 3), dtype=np.uint8)
+    # saturated bright and dark patches are artifacts, flat gray patches are not rejected
+    input_patches[1] = (255, 0, 0)
+    input_patches[2] = (100, 0, 0)
+    input_patches[3] = 200
+    patch_validity = patch_artifact_check_batch(input_patches, patch_size=(32, 32))
+    assert list(patch_validity) == [
+        patch_artifact_check(patch, patch_size=(32, 32)) for patch in input_patches
+    ], "Batched artifact check should match the per-patch check"
+    assert list(patch_validity) == [
+        True,
+        False,
+        False,
+        True,
+    ], "Batched artifact check should reject artifact patches"
+    input_array = np.full((64, 64, 3), 255, dtype=np.uint8)
+    input_array[16:48, 16:48] = (200, 100, 180)
+    input_mask = tissue_mask(input_array)
+    assert input_mask[32, 32] and not (
+        input_mask[0, 0]
+    ), "Tissue mask should only contain the stained region"
+
+    # the hue range mask matches the previous skimage implementation
+    from skimage.color import rgb2hsv
+    from skimage.filters import gaussian
+    from GANDLF.data.patch_miner.opm.utils import hue_range_mask
+
+    def hue_range_mask_skimage(image, min_hue, max_hue, sat_min=0.05):
+        hsv_image = rgb2hsv(image)
+        h_channel = gaussian(hsv_image[:, :, 0])
+        above_min = h_channel > min_hue
+        below_max = h_channel < max_hue
+
+        s_channel = gaussian(hsv_image[:, :, 1])
+        above_sat = s_channel > sat_min
+        return np.logical_and(np.logical_and(above_min, below_max), above_sat)
+
+    import tiffslide
+
+    slide_path = os.path.join(inputDir, "2d_histo_segmentation", "1", "image.tiff")
+    with tiffslide.open_slide(slide_path) as slide:
+        thumbnail = np.asarray(slide.get_thumbnail((512, 512)).convert("RGB"))
+    input_images = [
+        np.random.randint(0, 256, size=(97, 113, 3), dtype=np.uint8),
+        input_array,
+        thumbnail,
+    ]
+    for input_image in input_images:
+        for hue_range in [(0.8, 0.99), (0.1, 0.6)]:
+            mask = hue_range_mask(input_image, *hue_range)
+            mask_reference = hue_range_mask_skimage(input_image, *hue_range)
+            assert mask.shape == mask_reference.shape, "Mask shape should match"
+            # float32 rounding can only flip the pixels that are right at the thresholds
+            assert (
+                np.mean(mask != mask_reference) < 1e-3
+            ), "Hue range mask should match the skimage implementation"
+
+    # regions stitched from the cached tiles are identical to the regions read from the slide
+    from GANDLF.data.patch_miner.opm.tile_cache import CachedSlideReader, TileCache
+
+    with tiffslide.open_slide(slide_path) as slide:
+        reader = CachedSlideReader(slide, slide_path, TileCache(), tile_size=256)
+        size_x, size_y = slide.dimensions
+        # unaligned regions that span several tiles in both directions, and overlap each other
+        for location in [(37, 53), (301, 290)]:
+            size = (min(600, size_x - location[0]), min(500, size_y - location[1]))
+            assert np.array_equal(
+                reader.read_region(location, 0, size),
+                np.asarray(slide.read_region(location, 0, size)),
+            ), "Regions read from the cached tiles should match the slide"
+        assert reader.cache.hits > 0, "Overlapping regions should share tiles"
+
     # resize tests
     input_tensor = np.random.randint(0, 255, size=(20, 20, 20))
     input_image = sitk.GetImageFromArray(input_tensor)
@@ -2083,6 +2476,20 @@ def test_train_checkpointing_segmentation_rad_2d(device):
         resume=False,
         reset=True,
     )
+    # the best and latest checkpoints of the single epoch are written once
+    best_model = load_model(os.path.join(outputDir, "unet" + best_model_path_end), "cpu")
+    latest_model = load_model(
+        os.path.join(outputDir, "unet" + latest_model_path_end), "cpu"
+    )
+    assert best_model["epoch"] == latest_model["epoch"] == 0, "Incorrect epoch saved"
+    assert best_model["timestamp"] == latest_model["timestamp"], "Checkpoints differ"
+    for key in ["training_data", "validation_data", "subject_spacing"]:
+        assert (
+            key not in latest_model["parameters"]
+        ), "Runtime objects should not be saved with the model"
+    assert not any(
+        filename.endswith(".tmp") for filename in os.listdir(outputDir)
+    ), "Temporary checkpoint files should be renamed"
     parameters["num_epochs"] = 2
     parameters["nested_training"]["validation"] = -2
     parameters["nested_training"]["testing"] = 1
@@ -2100,6 +2507,383 @@ def test_train_checkpointing_segmentation_rad_2d(device):
     print("passed")
 
 
+def test_train_distributed_segmentation_rad_2d(device):
+    print("30.5: Starting 2D Rad segmentation tests for distributed training")
+    # nothing is reduced or sharded without a process group
+    assert not is_distributed()
+    assert reduce_across_processes({"loss": 1.5, "name": "a"}) == {
+        "loss": 1.5,
+        "name": "a",
+    }, "Values should not change without distributed training"
+    assert get_distributed_sampler(list(range(4))) is None
+
+    # a single process group on the cpu, as launched by torchrun with the gloo backend
+    torch.distributed.init_process_group(
+        "gloo", init_method="tcp://127.0.0.1:29512", rank=0, world_size=1
+    )
+    try:
+        assert is_distributed() and is_main_process()
+        reduced = reduce_across_processes(
+            {"loss": 1.5, "per_label": np.array([0.5, 1.0]), "name": "a"}
+        )
+        assert reduced["loss"] == 1.5, "Reduced float is incorrect"
+        assert np.allclose(reduced["per_label"], [0.5, 1.0]), "Reduced array incorrect"
+        assert reduced["name"] == "a", "Strings should not be reduced"
+
+        parameters = parseConfig(
+            testingDir + "/config_segmentation.yaml", version_check_flag=False
+        )
+        training_data, parameters["headers"] = parseTrainingCSV(
+            inputDir + "/train_2d_rad_segmentation.csv"
+        )
+        parameters["modality"] = "rad"
+        parameters["patch_size"] = patch_size["2D"]
+        parameters["num_epochs"] = 1
+        parameters["nested_training"]["testing"] = 1
+        parameters["nested_training"]["validation"] = -5
+        parameters["model"]["dimension"] = 2
+        parameters["model"]["class_list"] = [0, 255]
+        parameters["model"]["amp"] = False
+        parameters["model"]["num_channels"] = 3
+        parameters["model"]["architecture"] = "unet"
+        parameters["model"]["onnx_export"] = False
+        parameters["model"]["print_summary"] = False
+        parameters = populate_header_in_parameters(
+            parameters, parameters["headers"]
+        )
+        sanitize_outputDir()
+        TrainingManager(
+            dataframe=training_data,
+            outputDir=outputDir,
+            parameters=parameters,
+            device=device,
+            resume=False,
+            reset=True,
+        )
+        # the models are saved without the distributed wrapper
+        saved_model = torch.load(
+            os.path.join(outputDir, "unet" + best_model_path_end),
+            map_location="cpu",
+        )
+        assert not any(
+            key.startswith("module.") for key in saved_model["model_state_dict"]
+        ), "Saved model should not contain the distributed wrapper"
+        assert os.path.isfile(os.path.join(outputDir, "logs_training.csv"))
+    finally:
+        torch.distributed.destroy_process_group()
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def _run_distributed_worker(rank, world_size, init_method):
+    """
+    Function that runs the checks of test_train_distributed_two_processes in every process.
+    """
+    from importlib import import_module
+    from GANDLF.metrics.classification import (
+        initialize_overall_stats,
+        update_overall_stats,
+        compute_overall_stats,
+        overall_stats,
+        get_overall_stats_names,
+    )
+
+    # the package exports the training_loop function under the name of its module
+    training_loop = import_module("GANDLF.compute.training_loop")
+    torch.distributed.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    try:
+        assert get_world_size() == world_size
+        assert reduce_across_processes(float(rank + 1)) == 1.5
+        assert reduce_across_processes(float(rank + 1), average=False) == 3.0
+        assert torch.equal(
+            gather_across_processes(torch.full((rank + 1,), rank)),
+            torch.tensor([0, 1, 1]),
+        ), "Tensors of different lengths should be gathered in the order of the ranks"
+        assert broadcast_from_main_process(
+            {"loss": float(rank)} if rank == 0 else None
+        ) == {"loss": 0.0}, "Every process should get the value of the main process"
+
+        # every process gets a different, equally sized share of the subjects
+        indices = list(get_distributed_sampler(list(range(5)), shuffle=False))
+        all_indices = [None] * world_size
+        torch.distributed.all_gather_object(all_indices, indices)
+        assert len(all_indices[0]) == len(all_indices[1]) == 3
+        assert set(all_indices[0] + all_indices[1]) == set(range(5))
+
+        def mse_step(model, image, label, params, metrics_to_host=True):
+            output = model(image)
+            loss = torch.nn.functional.mse_loss(output, label)
+            return loss, {"mse": loss.detach()}, output, None
+
+        step = training_loop.step
+        training_loop.step = mse_step
+        torch.manual_seed(0)
+        model = torch.nn.parallel.DistributedDataParallel(torch.nn.Linear(4, 1))
+        # every process has a different half of the data, and the reference is all of it
+        all_images, all_labels = torch.randn(8, 4), torch.randn(8, 1)
+        image = all_images[4 * rank : 4 * (rank + 1)]
+        label = all_labels[4 * rank : 4 * (rank + 1)]
+        reference = copy.deepcopy(model.module)
+        torch.nn.functional.mse_loss(reference(all_images), all_labels).backward()
+        params = {"subject_spacing": None}
+
+        def check_gradients(message):
+            for parameter, expected in zip(model.parameters(), reference.parameters()):
+                assert torch.allclose(parameter.grad, expected.grad, atol=1e-6), message
+
+        # the micro-batches only synchronize the gradients in the last backward pass
+        model.zero_grad()
+        _, _, _, nan_loss = training_loop.forward_and_backward(
+            model, image, label, params, torch.Tensor.backward, num_micro_batches=2
+        )
+        assert not nan_loss
+        check_gradients("Gradients of the micro-batches should be synchronized")
+
+        # the gradients that are not synchronized during accumulation are averaged by hand
+        model.zero_grad()
+        training_loop.forward_and_backward(
+            model,
+            image,
+            label,
+            params,
+            torch.Tensor.backward,
+            synchronize_gradients=False,
+        )
+        local_gradients = gather_across_processes(model.module.weight.grad)
+        assert not torch.allclose(
+            local_gradients[0], local_gradients[1]
+        ), "Gradients should not be synchronized during accumulation"
+        average_gradients(model)
+        check_gradients("Gradients should be averaged after accumulation")
+
+        # a nan loss in any process makes the synchronized gradients nan in all of them, and
+        # every process skips the optimizer step from the reduced flag
+        model.zero_grad()
+        nan_label = label.clone()
+        if rank == 1:
+            nan_label[0] = float("nan")
+        _, _, _, nan_loss = training_loop.forward_and_backward(
+            model, image, nan_label, params, torch.Tensor.backward
+        )
+        assert bool(nan_loss) == (rank == 1), "Only the local loss should be flagged"
+        assert (
+            reduce_across_processes(nan_loss, average=False) > 0
+        ), "The step should be skipped in every process"
+        assert torch.isnan(
+            model.module.weight.grad
+        ).any(), "The nan gradients should be synchronized"
+        training_loop.step = step
+
+        # the classification stats are computed over the predictions of all processes
+        stats_params = {
+            "problem_type": "classification",
+            "model": {"num_classes": 3},
+            "device": "cpu",
+        }
+        all_predictions = torch.tensor([0, 1, 2, 2, 1, 0, 1, 1])
+        all_targets = torch.tensor([0, 1, 1, 2, 0, 0, 2, 1])
+        calculators = initialize_overall_stats(stats_params)
+        update_overall_stats(
+            calculators,
+            all_predictions[4 * rank : 4 * (rank + 1)],
+            all_targets[4 * rank : 4 * (rank + 1)],
+            stats_params,
+        )
+        distributed_stats = compute_overall_stats(calculators)
+
+        # training end to end, with the subjects of the queue sharded across processes
+        parameters = parseConfig(
+            testingDir + "/config_classification.yaml", version_check_flag=False
+        )
+        training_data, parameters["headers"] = parseTrainingCSV(
+            inputDir + "/train_2d_rad_classification.csv"
+        )
+        parameters["modality"] = "rad"
+        parameters["patch_size"] = patch_size["2D"]
+        parameters["num_epochs"] = 1
+        parameters["nested_training"]["testing"] = -5
+        parameters["nested_training"]["validation"] = -5
+        parameters["model"]["dimension"] = 2
+        parameters["model"]["amp"] = False
+        parameters["model"]["num_channels"] = 3
+        parameters["model"]["architecture"] = "resnet18"
+        parameters["model"]["onnx_export"] = False
+        parameters["model"]["print_summary"] = False
+        parameters = populate_header_in_parameters(
+            parameters, parameters["headers"]
+        )
+        validate_network = training_loop.validate_network
+        validation_modes = []
+
+        def recording_validate_network(*args, **kwargs):
+            validation_modes.append(kwargs["mode"])
+            return validate_network(*args, **kwargs)
+
+        training_loop.validate_network = recording_validate_network
+        TrainingManager(
+            dataframe=training_data,
+            outputDir=outputDir,
+            parameters=parameters,
+            device="cpu",
+            resume=False,
+            reset=True,
+        )
+        training_loop.validate_network = validate_network
+        # only the main process validates and tests, and the others get its results
+        if rank == 0:
+            assert validation_modes == ["validation", "testing"]
+        else:
+            assert validation_modes == [], "Only the main process should validate"
+    finally:
+        torch.distributed.destroy_process_group()
+
+    # the reference is computed without the process group
+    reference_stats = overall_stats(all_predictions, all_targets, stats_params)
+    assert list(reference_stats) == get_overall_stats_names()
+    for metric in reference_stats:
+        assert np.allclose(
+            distributed_stats[metric], reference_stats[metric]
+        ), "The stats should be computed over all processes"
+
+
+def test_train_distributed_two_processes():
+    print("30.6: Starting distributed training tests with two processes")
+    sanitize_outputDir()
+    torch.multiprocessing.spawn(
+        _run_distributed_worker,
+        args=(2, "tcp://127.0.0.1:29513"),
+        nprocs=2,
+    )
+    # only the main process writes the outputs
+    assert os.path.isfile(os.path.join(outputDir, "logs_training.csv"))
+    assert os.path.isfile(os.path.join(outputDir, "resnet18" + best_model_path_end))
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def _get_toy_training_loader(params, pin_memory=False):
+    # patches of two channels, a label map and a value, queued as in ImagesFromDataFrame
+    import torchio
+
+    subjects = []
+    for index in range(4):
+        subjects.append(
+            torchio.Subject(
+                {
+                    "1": torchio.ScalarImage(tensor=torch.rand(1, 16, 16, 1)),
+                    "2": torchio.ScalarImage(tensor=torch.rand(1, 16, 16, 1)),
+                    "label": torchio.LabelMap(
+                        tensor=(torch.rand(1, 16, 16, 1) > 0.5).int()
+                    ),
+                    "value_0": torch.tensor(float(index)),
+                    "subject_id": str(index),
+                }
+            )
+        )
+    queue = torchio.Queue(
+        torchio.SubjectsDataset(subjects),
+        max_length=8,
+        samples_per_volume=2,
+        sampler=torchio.data.UniformSampler((8, 8, 1)),
+        num_workers=0,
+    )
+    return torch.utils.data.DataLoader(
+        queue,
+        batch_size=params["batch_size"],
+        num_workers=0,
+        pin_memory=pin_memory,
+        collate_fn=TrainingBatchCollator(params),
+    )
+
+
+def _get_toy_image_batch_reference(batch):
+    return torch.cat([batch["1"]["data"], batch["2"]["data"]], dim=1).float()
+
+
+def test_generic_training_batch_prefetcher():
+    print("30.7: Starting testing the training batch collator and prefetcher")
+    # the keys are inferred from the batch before the validation loader populates them
+    parameters = {"batch_size": 2}
+    loader = _get_toy_training_loader(parameters)
+    assert len(BatchPrefetcher(loader, "cpu")) == len(loader) == 4
+    num_batches = 0
+    for batch in BatchPrefetcher(loader, "cpu"):
+        assert batch["image_batch"].shape == (2, 2, 8, 8, 1)
+        assert torch.equal(
+            batch["image_batch"], _get_toy_image_batch_reference(batch)
+        ), "The collator should concatenate the channels of the batch"
+        assert (
+            batch["image_batch"].device.type == "cpu"
+        ), "The prefetcher should return the batches as-is on the cpu"
+        assert torch.equal(
+            batch["label_batch"], batch["value_0"].reshape(2, 1)
+        ), "The collator should use the values as labels"
+        num_batches += 1
+    assert num_batches == len(loader), "All batches should be returned"
+
+    # keys populated by the validation loader, for segmentation
+    parameters.update({"channel_keys": ["1", "2"], "value_keys": None})
+    for batch in BatchPrefetcher(_get_toy_training_loader(parameters), "cpu"):
+        assert torch.equal(
+            batch["image_batch"], _get_toy_image_batch_reference(batch)
+        ), "The collator should concatenate the channels of the batch"
+        assert torch.equal(
+            batch["label_batch"], batch["label"]["data"]
+        ), "The collator should add the label maps of the batch"
+
+    # the training batches are pinned by default for cuda devices, with an opt-out
+    parameters = parseConfig(
+        testingDir + "/config_segmentation.yaml", version_check_flag=False
+    )
+    parameters["device"] = "cuda"
+    assert get_dataloader_kwargs(parameters, train=True)["pin_memory"] == (
+        torch.cuda.is_available()
+    ), "Training batches should be pinned by default on cuda"
+    assert "pin_memory" not in get_dataloader_kwargs(
+        parameters, train=False
+    ), "Validation subjects should not be pinned"
+    parameters["pin_memory_dataloader"] = False
+    assert not get_dataloader_kwargs(parameters, train=True)[
+        "pin_memory"
+    ], "Pinning should be disabled when opted out"
+    parameters["pin_memory_dataloader"] = True
+    parameters["device"] = "cpu"
+    assert not get_dataloader_kwargs(parameters, train=True)[
+        "pin_memory"
+    ], "Training batches should not be pinned on the cpu"
+
+    print("passed")
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires a GPU")
+def test_generic_training_batch_prefetcher_cuda():
+    print("30.8: Starting testing the training batch prefetcher on the GPU")
+    parameters = {"batch_size": 2, "channel_keys": ["1", "2"], "value_keys": None}
+    for pin_memory in [False, True]:
+        loader = _get_toy_training_loader(parameters, pin_memory)
+        num_batches = 0
+        for batch in BatchPrefetcher(loader, "cuda"):
+            assert batch["image_batch"].is_cuda and batch["label_batch"].is_cuda
+            # the other entries stay on the host, and the copies from the side stream
+            # are compared after computing on the current stream
+            assert torch.equal(
+                (batch["image_batch"] * 2).cpu(),
+                _get_toy_image_batch_reference(batch) * 2,
+            ), "The prefetched images should match the batch"
+            assert torch.equal(
+                batch["label_batch"].cpu(), batch["label"]["data"]
+            ), "The prefetched labels should match the batch"
+            num_batches += 1
+        assert num_batches == len(loader), "All batches should be prefetched"
+
+    print("passed")
+
+
 def test_generic_model_patch_divisibility():
     print("31: Starting patch divisibility tests")
     parameters = parseConfig(
@@ -2142,8 +2926,44 @@ def test_generic_model_patch_divisibility():
     print("passed")
 
 
+def _one_hot_with_per_class_loop(segmask_tensor, class_list):
+    """
+    The previous implementation of one_hot, which loops over the samples and classes; kept as the reference for parity.
+    """
+    batch_stack = torch.zeros(
+        segmask_tensor.shape[0],
+        len(class_list),
+        *segmask_tensor.shape[2:],
+        dtype=torch.float32,
+        device=segmask_tensor.device,
+    )
+    for b in range(segmask_tensor.shape[0]):
+        segmask_array_iter = segmask_tensor[b, 0, ...]
+        for class_idx, _class in enumerate(class_list):
+            if isinstance(_class, str) and "||" in _class:
+                special_class_split = _class.split("||")
+                bin_mask = segmask_array_iter == int(special_class_split[0])
+                for i in range(1, len(special_class_split)):
+                    bin_mask = torch.logical_or(
+                        bin_mask, (segmask_array_iter == int(special_class_split[i]))
+                    )
+            else:
+                bin_mask = segmask_array_iter == int(_class)
+            batch_stack[b, class_idx, ...] = bin_mask.long().unsqueeze(0)
+    return batch_stack
+
+
 def test_generic_one_hot_logic():
     print("32: Starting one hot logic tests")
+    # the vectorized encoding matches the previous loop over samples and classes, for 2D and 3D batches
+    for shape in [(3, 1, 16, 16), (2, 1, 8, 8, 8)]:
+        segmask = torch.randint(5, size=shape).to(torch.float16)
+        for class_list in [[0, 1, 2, 3, 4], [0, "1||2", 4], ["0", "1||2||3", 4], [4, 2]]:
+            assert torch.equal(
+                one_hot(segmask, class_list),
+                _one_hot_with_per_class_loop(segmask, class_list),
+            ), "One-hot encoding should match the per-class loop"
+
     random_array = np.random.randint(5, size=(20, 20, 20))
     img = sitk.GetImageFromArray(random_array)
     img_tensor = get_tensor_from_image(img).to(torch.float16)
@@ -2156,6 +2976,14 @@ def test_generic_one_hot_logic():
     assert comparison.all(), "Arrays are not equal"
 
     class_list = ["0", "1||2||3", np.max(random_array)]
+    # check that batched encoding is the same as encoding each sample separately
+    img_tensor_batch = torch.cat([img_tensor, torch.flip(img_tensor, [2])], dim=0)
+    img_tensor_batch_oh = one_hot(img_tensor_batch, class_list)
+    for i in range(img_tensor_batch.shape[0]):
+        assert torch.equal(
+            img_tensor_batch_oh[i], one_hot(img_tensor_batch[i : i + 1], class_list)[0]
+        ), "Batched one-hot encoding is not consistent"
+
     img_tensor_oh = one_hot(img_tensor, class_list)
     img_tensor_oh_rev_array = reverse_one_hot(img_tensor_oh[0], class_list)
 
@@ -2320,11 +3148,37 @@ def test_train_inference_segmentation_histology_2d(device):
         inputDir + "/train_2d_histo_segmentation.csv",
         output_dir_patches_output,
         file_config_temp,
+        num_workers=2,
     )
 
     file_for_Training = os.path.join(
         output_dir_patches_output, "opm_train.csv"
     )
+    # the completed slides are skipped when resuming
+    patches_df = pd.read_csv(file_for_Training)
+    patch_extraction(
+        inputDir + "/train_2d_histo_segmentation.csv",
+        output_dir_patches_output,
+        file_config_temp,
+        resume=True,
+    )
+    pd.testing.assert_frame_equal(patches_df, pd.read_csv(file_for_Training))
+    # the slides of a subject with several slides are kept apart
+    input_df = pd.read_csv(inputDir + "/train_2d_histo_segmentation.csv")
+    input_df["SubjectID"] = 1
+    file_same_subject = os.path.join(output_dir_patches, "same_subject.csv")
+    input_df.to_csv(file_same_subject, index=False)
+    output_dir_same_subject = os.path.join(output_dir_patches, "same_subject")
+    patch_extraction(
+        file_same_subject, output_dir_same_subject, file_config_temp
+    )
+    same_subject_df = pd.read_csv(
+        os.path.join(output_dir_same_subject, "opm_train.csv")
+    )
+    assert len(same_subject_df) == len(
+        patches_df
+    ), "The patches of every slide of a subject should be kept"
+    assert set(same_subject_df["SubjectID"]) == {1}
     # read and parse csv
     parameters = parseConfig(
         testingDir + "/config_segmentation.yaml", version_check_flag=False
@@ -2339,6 +3193,130 @@ def test_train_inference_segmentation_histology_2d(device):
     parameters = populate_header_in_parameters(
         parameters, parameters["headers"]
     )
+    # the same patches written to tar shards are read back identically
+    output_dir_patches_shards = os.path.join(
+        output_dir_patches, "histo_patches_shards"
+    )
+    parameters_patch["patch_format"] = "tar"
+    parameters_patch["patches_per_shard"] = 4
+    patch_extraction(
+        inputDir + "/train_2d_histo_segmentation.csv",
+        output_dir_patches_shards,
+        write_temp_config_path(parameters_patch),
+    )
+    shards_df = pd.read_csv(
+        os.path.join(output_dir_patches_shards, "opm_train.csv")
+    )
+    pd.testing.assert_frame_equal(
+        patches_df[["PatchCoordinatesX", "PatchCoordinatesY"]],
+        shards_df[["PatchCoordinatesX", "PatchCoordinatesY"]],
+    )
+    assert all(
+        "::" in path for path in shards_df["Channel_0"]
+    ), "Patches should be written to shards"
+    shards_data, _ = parseTrainingCSV(
+        os.path.join(output_dir_patches_shards, "opm_train.csv")
+    )
+    subjects_png = ImagesFromDataFrame(
+        training_data.head(2), parameters, train=False
+    )
+    subjects_shards = ImagesFromDataFrame(
+        shards_data.head(2), parameters, train=False
+    )
+    for subject_png, subject_shard in zip(subjects_png, subjects_shards):
+        for key in [str(parameters["headers"]["channelHeaders"][0]), "label"]:
+            assert torch.equal(
+                subject_png[key]["data"], subject_shard[key]["data"]
+            ), "Patches read from shards should be identical to the PNG patches"
+    # patches inside shards are not cached, but still need to be pre-processed
+    parameters_preprocessed = copy.deepcopy(parameters)
+    parameters_preprocessed["data_preprocessing"] = {"normalize": None}
+    parameters_shard_cache = copy.deepcopy(parameters_preprocessed)
+    parameters_shard_cache["cache_dir"] = os.path.join(outputDir, "shard_cache")
+    subjects_preprocessed = ImagesFromDataFrame(
+        shards_data.head(2), parameters_preprocessed, train=False
+    )
+    subjects_cached = ImagesFromDataFrame(
+        shards_data.head(2), parameters_shard_cache, train=False
+    )
+    key = str(parameters["headers"]["channelHeaders"][0])
+    for subject_shard, subject_preprocessed, subject_cached in zip(
+        subjects_shards, subjects_preprocessed, subjects_cached
+    ):
+        assert not torch.equal(
+            subject_shard[key]["data"].float(), subject_cached[key]["data"]
+        ), "Patches inside shards should be pre-processed when caching"
+        assert torch.allclose(
+            subject_preprocessed[key]["data"], subject_cached[key]["data"]
+        ), "Patches inside shards should be pre-processed as without caching"
+
+    # patches read from the slides during training, without extracting them
+    parameters_wsi = copy.deepcopy(parameters)
+    slides_data, parameters_wsi["headers"] = parseTrainingCSV(
+        inputDir + "/train_2d_histo_segmentation.csv"
+    )
+    parameters_wsi["training_data"] = slides_data
+    parameters_wsi["problem_type"] = "segmentation"
+    parameters_wsi["wsi_patch_sampling"] = True
+    parameters_wsi["q_samples_per_volume"] = 2
+    parameters_wsi["q_num_workers"] = 2
+    parameters_wsi["cache_dir"] = os.path.join(outputDir, "wsi_cache")
+    wsi_loader = get_train_loader(parameters_wsi)
+    assert len(wsi_loader.dataset) == 2 * len(
+        slides_data
+    ), "Every slide should be sampled q_samples_per_volume times per epoch"
+    assert (
+        len(os.listdir(os.path.join(parameters_wsi["cache_dir"], "wsi_coordinates")))
+        == 2
+    ), "The patch locations should be cached per slide"
+    for subject in wsi_loader:
+        assert list(subject["1"]["data"].shape[2:]) == list(
+            parameters_wsi["patch_size"]
+        ), "Patches read from slides should have the patch size"
+        assert (
+            subject["label"]["data"].shape[2:] == subject["1"]["data"].shape[2:]
+        ), "Labels read from slides should match the patches"
+        assert torch.equal(
+            subject["image_batch"], subject["1"]["data"].float()
+        ), "The collator should concatenate the channels of the batch"
+        assert torch.equal(
+            subject["label_batch"], subject["label"]["data"]
+        ), "The collator should add the labels of the batch"
+    assert len(BatchPrefetcher(wsi_loader, "cpu")) == len(wsi_loader)
+    for subject in BatchPrefetcher(wsi_loader, "cpu"):
+        assert (
+            subject["image_batch"].device.type == "cpu"
+        ), "The prefetcher should return the batches as-is on the cpu"
+    # the validation slides are evaluated on a fixed patch per slide
+    wsi_validation_data = get_train_wsi_patch_dataset(
+        slides_data, parameters_wsi, train=False
+    )
+    assert len(wsi_validation_data) == len(slides_data)
+    assert torch.equal(
+        wsi_validation_data[0]["1"]["data"], wsi_validation_data[0]["1"]["data"]
+    ), "The validation patches should be the same in every epoch"
+    # training end to end on the slides
+    parameters_wsi["model"]["architecture"] = "unet"
+    parameters_wsi["model"]["onnx_export"] = False
+    parameters_wsi["model"]["print_summary"] = False
+    parameters_wsi["nested_training"]["testing"] = 1
+    parameters_wsi["nested_training"]["validation"] = -2
+    parameters_wsi["num_epochs"] = 1
+    modelDir_wsi = os.path.join(outputDir, "modelDir_wsi")
+    Path(modelDir_wsi).mkdir(parents=True, exist_ok=True)
+    TrainingManager(
+        dataframe=slides_data,
+        outputDir=modelDir_wsi,
+        parameters=parameters_wsi,
+        device=device,
+        resume=False,
+        reset=True,
+    )
+    assert any(
+        file.endswith(best_model_path_end)
+        for _, _, files in os.walk(modelDir_wsi)
+        for file in files
+    ), "A model should be trained on the patches read from the slides"
     parameters["model"]["architecture"] = "resunet"
     parameters["nested_training"]["testing"] = 1
     parameters["nested_training"]["validation"] = -2
@@ -2360,6 +3338,26 @@ def test_train_inference_segmentation_histology_2d(device):
         inputDir + "/train_2d_histo_segmentation.csv", train=False
     )
     inference_data.drop(index=inference_data.index[-1], axis=0, inplace=True)
+    parameters["inference_mechanism"]["batch_size"] = 4
+    InferenceManager(
+        dataframe=inference_data,
+        modelDir=modelDir,
+        parameters=parameters,
+        device=device,
+    )
+    # tiled maps at a lower resolution, accumulated on disk
+    parameters["probability_map_downsample"] = 2
+    parameters["probability_map_storage"] = "disk"
+    parameters["probability_map_format"] = "tiff"
+    InferenceManager(
+        dataframe=inference_data,
+        modelDir=modelDir,
+        parameters=parameters,
+        device=device,
+    )
+    # heatmaps without blending
+    parameters["probability_map_format"] = "png"
+    parameters["blend_heatmaps"] = False
     InferenceManager(
         dataframe=inference_data,
         modelDir=modelDir,
@@ -2986,6 +3984,197 @@ def test_train_gradient_clipping_classification_rad_2d(device):
     print("passed")
 
 
+def test_train_gradient_accumulation_classification_rad_2d(device):
+    print("42.5: Testing gradient accumulation")
+    # read and initialize parameters for specific data dimension
+    parameters = parseConfig(
+        testingDir + "/config_classification.yaml", version_check_flag=False
+    )
+    parameters["modality"] = "rad"
+    parameters["patch_size"] = patch_size["2D"]
+    parameters["model"]["dimension"] = 2
+    # read and parse csv
+    training_data, parameters["headers"] = parseTrainingCSV(
+        inputDir + "/train_2d_rad_classification.csv"
+    )
+    parameters["model"]["num_channels"] = 3
+    parameters["model"]["onnx_export"] = False
+    parameters["model"]["print_summary"] = False
+    parameters["model"]["architecture"] = "densenet121"
+    parameters["nested_training"]["testing"] = -5
+    parameters["nested_training"]["validation"] = -5
+    parameters["batch_size"] = 2
+    parameters["gradient_accumulation_steps"] = 3
+    parameters["clip_mode"] = "norm"
+    parameters["clip_grad"] = 0.1
+    parameters = populate_header_in_parameters(
+        parameters, parameters["headers"]
+    )
+    sanitize_outputDir()
+    TrainingManager(
+        dataframe=training_data,
+        outputDir=outputDir,
+        parameters=parameters,
+        device=device,
+        resume=False,
+        reset=True,
+    )
+    sanitize_outputDir()
+
+    # only the memory errors lead to splitting the batches
+    from GANDLF.compute.training_loop import is_out_of_memory_error
+
+    assert is_out_of_memory_error(
+        RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+    )
+    assert is_out_of_memory_error(
+        RuntimeError("DefaultCPUAllocator: can't allocate memory")
+    )
+    assert not is_out_of_memory_error(RuntimeError("shape mismatch"))
+
+    # the number of accumulated batches needs to be positive
+    with open(testingDir + "/config_classification.yaml", "r") as file:
+        config = yaml.safe_load(file)
+    config["gradient_accumulation_steps"] = 0
+    file_config_temp = write_temp_config_path(config)
+    with pytest.raises(AssertionError):
+        parseConfig(file_config_temp, version_check_flag=False)
+    sanitize_outputDir()
+
+    print("passed")
+
+
+def test_train_gradient_accumulation_parity(monkeypatch):
+    print("42.6: Testing that accumulated gradients match a single step")
+    from importlib import import_module
+
+    # the package exports the training_loop function under the name of its module
+    training_loop = import_module("GANDLF.compute.training_loop")
+
+    def mse_step(model, image, label, params, metrics_to_host=True):
+        output = model(image)
+        loss = torch.nn.functional.mse_loss(output, label)
+        return loss, {"mse": loss.detach()}, output, None
+
+    monkeypatch.setattr(training_loop, "step", mse_step)
+    torch.manual_seed(0)
+    model = torch.nn.Linear(4, 1)
+    image, label = torch.randn(6, 4), torch.randn(6, 1)
+    params = {"subject_spacing": torch.ones(6, 2)}
+
+    def get_gradients(batches, num_micro_batches=1):
+        model.zero_grad()
+        for start, end in batches:
+            training_loop.forward_and_backward(
+                model,
+                image[start:end],
+                label[start:end],
+                params,
+                torch.Tensor.backward,
+                num_micro_batches=num_micro_batches,
+                loss_divisor=len(batches),
+            )
+        return [parameter.grad.clone() for parameter in model.parameters()]
+
+    expected_gradients = get_gradients([(0, 6)])
+    for batches, num_micro_batches in [
+        ([(0, 2), (2, 4), (4, 6)], 1),
+        ([(0, 6)], 3),
+        ([(0, 3), (3, 6)], 2),
+    ]:
+        for gradient, expected_gradient in zip(
+            get_gradients(batches, num_micro_batches), expected_gradients
+        ):
+            assert torch.allclose(
+                gradient, expected_gradient, atol=1e-6
+            ), "Accumulated gradients should match those of the whole batch"
+
+    # a nan loss is backpropagated and flagged, so that the optimizer step can be skipped once per window
+    nan_label = label.clone()
+    nan_label[4] = float("nan")
+    model.zero_grad()
+    _, _, _, nan_loss = training_loop.forward_and_backward(
+        model, image, nan_label, params, torch.Tensor.backward, num_micro_batches=3
+    )
+    assert nan_loss, "A nan loss in any micro-batch should be flagged"
+    assert torch.isnan(model.weight.grad).any()
+
+    # the spacing of the whole batch is restored if a micro-batch fails
+    def out_of_memory_step(model, image, label, params, metrics_to_host=True):
+        raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+
+    monkeypatch.setattr(training_loop, "step", out_of_memory_step)
+    with pytest.raises(RuntimeError):
+        training_loop.forward_and_backward(
+            model, image, label, params, torch.Tensor.backward, num_micro_batches=2
+        )
+    assert torch.equal(
+        params["subject_spacing"], torch.ones(6, 2)
+    ), "The spacing of the whole batch should be restored"
+
+    print("passed")
+
+
+def test_train_out_of_memory_classification_rad_2d(device, monkeypatch):
+    print("42.7: Testing the micro-batches after running out of memory")
+    # read and initialize parameters for specific data dimension
+    parameters = parseConfig(
+        testingDir + "/config_classification.yaml", version_check_flag=False
+    )
+    parameters["modality"] = "rad"
+    parameters["patch_size"] = patch_size["2D"]
+    parameters["model"]["dimension"] = 2
+    # read and parse csv
+    training_data, parameters["headers"] = parseTrainingCSV(
+        inputDir + "/train_2d_rad_classification.csv"
+    )
+    parameters["model"]["num_channels"] = 3
+    parameters["model"]["onnx_export"] = False
+    parameters["model"]["print_summary"] = False
+    parameters["model"]["architecture"] = "resnet18"
+    parameters["nested_training"]["testing"] = -5
+    parameters["nested_training"]["validation"] = -5
+    parameters["batch_size"] = 2
+    parameters = populate_header_in_parameters(
+        parameters, parameters["headers"]
+    )
+
+    # every batch of more than one sample is out of memory
+    from importlib import import_module
+
+    # the package exports the training_loop function under the name of its module
+    training_loop = import_module("GANDLF.compute.training_loop")
+
+    step = training_loop.step
+    batch_sizes = []
+
+    def out_of_memory_step(model, image, label, params, **kwargs):
+        batch_sizes.append(image.shape[0])
+        if image.shape[0] > 1:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return step(model, image, label, params, **kwargs)
+
+    monkeypatch.setattr(training_loop, "step", out_of_memory_step)
+    sanitize_outputDir()
+    TrainingManager(
+        dataframe=training_data,
+        outputDir=outputDir,
+        parameters=parameters,
+        device=device,
+        resume=False,
+        reset=True,
+    )
+    # the first batch is tried as a whole, and then split for the rest of the epoch
+    assert batch_sizes[:3] == [
+        2,
+        1,
+        1,
+    ], "The batches should be split into micro-batches after running out of memory"
+    sanitize_outputDir()
+
+    print("passed")
+
+
 def test_train_segmentation_unet_conversion_rad_3d(device):
     print(
         "43: Starting 3D Rad segmentation tests for unet with ACS conversion"
@@ -3266,6 +4455,70 @@ def test_generic_random_numbers_are_deterministic_on_cpu():
     print("passed")
 
 
+def test_generic_prediction_writer():
+    print("48.1: Testing the buffered prediction writer")
+    from GANDLF.logger import PredictionWriter
+
+    sanitize_outputDir()
+    columns = ["Epoch", "SubjectID", "PredictedValue"]
+    expected = pd.DataFrame(
+        {
+            "Epoch": [0] * 5,
+            "SubjectID": ["a", "b", "c", "d", "e"],
+            "PredictedValue": [0.5, 1.5, 2.5, 3.5, 4.5],
+        }
+    )
+    output_formats = ["csv"]
+    try:
+        import pyarrow
+
+        output_formats.append("parquet")
+    except ImportError:
+        print("pyarrow is not installed, skipping the parquet format")
+
+    for output_format in output_formats:
+        read_output = pd.read_csv if output_format == "csv" else pd.read_parquet
+        filename = os.path.join(outputDir, "predictions_" + output_format + ".txt")
+        # the extension is replaced, and the rows are flushed every three rows and on close
+        writer = PredictionWriter(filename, columns, output_format, buffer_size=3)
+        filename = os.path.splitext(filename)[0] + "." + output_format
+        # a batch of three rows, and then single rows with a scalar epoch
+        writer.write(
+            {
+                "Epoch": 0,
+                "SubjectID": expected["SubjectID"][:3].tolist(),
+                "PredictedValue": torch.tensor([0.5, 1.5, 2.5], dtype=torch.float64),
+            }
+        )
+        for index in [3, 4]:
+            writer.write(
+                {
+                    "Epoch": 0,
+                    "SubjectID": expected["SubjectID"][index],
+                    "PredictedValue": expected["PredictedValue"][index],
+                }
+            )
+        # the single rows are still buffered; parquet files can only be read once closed
+        if output_format == "csv":
+            assert len(pd.read_csv(filename)) == 3, "Full buffers should be flushed"
+        writer.close()
+        pd.testing.assert_frame_equal(
+            read_output(filename), expected, check_dtype=False
+        )
+
+        # the file is created with the columns even if no predictions are written
+        filename = os.path.join(outputDir, "empty_predictions." + output_format)
+        writer = PredictionWriter(filename, columns, output_format)
+        writer.close()
+        empty_output = read_output(filename)
+        assert list(empty_output.columns) == columns
+        assert len(empty_output) == 0
+
+    sanitize_outputDir()
+
+    print("passed")
+
+
 def test_generic_cli_function_metrics_cli_rad_nd():
     print("49: Starting metric calculation tests")
     for dim in ["2d", "3d"]:
@@ -3324,6 +4577,30 @@ def test_generic_cli_function_metrics_cli_rad_nd():
                 output_file
             ), "Metrics output file was not generated"
 
+            if problem_type == "segmentation":
+                with open(output_file, "r") as file:
+                    serial_output = yaml.safe_load(file)
+                # parallel calculation should give the same results
+                output_file_parallel = os.path.join(outputDir, "output_parallel.yaml")
+                generate_metrics_dict(
+                    temp_infer_csv, temp_config, output_file_parallel, num_workers=2
+                )
+                with open(output_file_parallel, "r") as file:
+                    assert (
+                        yaml.safe_load(file) == serial_output
+                    ), "Parallel metrics do not match serial metrics"
+                # resuming from a partial output should only calculate the missing subjects
+                with open(output_file_parallel, "w") as file:
+                    first_subject = list(serial_output.keys())[0]
+                    yaml.dump({first_subject: serial_output[first_subject]}, file)
+                generate_metrics_dict(
+                    temp_infer_csv, temp_config, output_file_parallel, resume=True
+                )
+                with open(output_file_parallel, "r") as file:
+                    assert (
+                        yaml.safe_load(file) == serial_output
+                    ), "Resumed metrics do not match serial metrics"
+
             sanitize_outputDir()
 
 def test_generic_deploy_metrics_docker():